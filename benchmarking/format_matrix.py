@@ -0,0 +1,571 @@
+"""
+Sweep the formats, encodings and writer options of the buildings of one country, and
+record for each variant its file size, its conversion time, and the latency of a full
+scan and of bbox queries.
+
+The variants are:
+  - GeoParquet, for every combination of compression codec and level, row group size,
+    bbox covering column or not, WKB or GeoArrow-native geometries, and original or
+    Hilbert-sorted rows,
+  - Arrow IPC (Feather), with the same options where they apply: the codecs of IPC,
+    record batches of the row group sizes, covering, encoding and order,
+  - FlatGeoBuf, with and without its packed Hilbert R-tree, in both orders,
+  - GeoPackage with its R-tree, as distributed today, for reference.
+
+The input is read once in memory and every variant is written from it, so that the
+conversion time is the cost of the writer, without the read of the input. A full scan
+reads every column and builds the geometries. A bbox query counts the geometries that
+intersect random boxes, skipping the row groups outside them with the statistics of
+the bbox column, prefiltering the rows with it, and going through the spatial index of
+FlatGeoBuf and GeoPackage.
+
+The default sweep includes the zstd level 15 and the row groups of 100k rows of the
+converters of main.py, to compare them with the other choices.
+
+Usage:
+    python format_matrix.py -i CYP.gpkg -o matrix.json
+    python format_matrix.py -i CYP.gpkg --format parquet --codec zstd:15 \
+        --codec zstd:3 --row_group_size 100000 --row_group_size 500000
+"""
+
+import itertools
+import logging
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Annotated, Callable, Dict, List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+import typer
+
+from harness import (
+    CacheMode,
+    Measurement,
+    drop_file_cache,
+    format_measurements,
+    report_regressions,
+    run_context,
+    summarize,
+    time_runs,
+    write_csv,
+    write_json,
+)
+from scenarios import BBOX_SIZES, ITERATIONS, BBox, make_bbox_scenarios
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "data_conversions"))
+
+from parquet_index import (  # noqa: E402
+    BBOX_COLUMN,
+    bbox_array,
+    bbox_mask,
+    row_group_bboxes,
+)
+
+app = typer.Typer()
+
+GEOMETRY_COLUMN = "geometry"
+# Codecs of the Arrow IPC format, the others only exist in Parquet
+IPC_CODECS = {"none", "lz4", "zstd"}
+
+
+class Format(Enum):
+    GeoParquet = "parquet"
+    ArrowIPC = "arrow"
+    FlatGeobuf = "fgb"
+    GeoPackage = "gpkg"
+
+
+class Encoding(Enum):
+    WKB = "wkb"
+    GeoArrow = "geoarrow"
+
+
+class Order(Enum):
+    Original = "original"
+    Hilbert = "hilbert"
+
+
+class Covering(Enum):
+    BBox = "bbox"
+    NoCovering = "none"
+
+
+@dataclass(frozen=True)
+class Codec:
+    name: str = "none"
+    # None for the default level of the codec
+    level: int | None = None
+
+    @classmethod
+    def parse(cls, value: str) -> "Codec":
+        name, _, level = value.lower().partition(":")
+        try:
+            return cls(name, int(level) if level else None)
+        except ValueError:
+            raise typer.BadParameter(f"Codecs are NAME or NAME:LEVEL, got {value!r}.")
+
+    @property
+    def label(self) -> str:
+        return self.name if self.level is None else f"{self.name}{self.level}"
+
+
+@dataclass(frozen=True)
+class Variant:
+    format: Format
+    codec: Codec = Codec()
+    # Rows per row group, or per record batch for Arrow IPC
+    row_group_size: int | None = None
+    covering: bool = False
+    encoding: Encoding = Encoding.WKB
+    order: Order = Order.Original
+    spatial_index: bool = False
+
+    @property
+    def label(self) -> str:
+        parts = [self.format.value]
+        if self.format in (Format.GeoParquet, Format.ArrowIPC):
+            rows = self.row_group_size
+            parts += [
+                self.codec.label,
+                f"rg{rows // 1000}k" if rows % 1000 == 0 else f"rg{rows}",
+                "bbox" if self.covering else "nobbox",
+                self.encoding.value,
+            ]
+        if self.format is Format.FlatGeobuf:
+            parts.append("index" if self.spatial_index else "noindex")
+        parts.append(self.order.value)
+        return "-".join(parts)
+
+    @property
+    def suffix(self) -> str:
+        return f".{self.format.value}"
+
+
+@dataclass
+class VariantResult:
+    variant: Variant
+    path: Path
+    ok: bool
+    bytes: int = 0
+    convert_s: float = 0.0
+
+    def to_json(self) -> Dict:
+        variant = asdict(self.variant)
+        return {
+            "label": self.variant.label,
+            **{k: v.value if isinstance(v, Enum) else v for k, v in variant.items()},
+            "path": str(self.path),
+            "ok": self.ok,
+            "bytes": self.bytes,
+            "convert_s": self.convert_s,
+        }
+
+
+def build_matrix(
+    formats: List[Format],
+    codecs: List[Codec],
+    row_group_sizes: List[int],
+    coverings: List[Covering],
+    encodings: List[Encoding],
+    orders: List[Order],
+) -> List[Variant]:
+    variants = []
+    if Format.GeoPackage in formats:
+        variants.append(Variant(Format.GeoPackage, spatial_index=True))
+    if Format.FlatGeobuf in formats:
+        for order, index in itertools.product(orders, [True, False]):
+            variants.append(
+                Variant(Format.FlatGeobuf, order=order, spatial_index=index)
+            )
+    for format in (Format.GeoParquet, Format.ArrowIPC):
+        if format not in formats:
+            continue
+        format_codecs = codecs
+        if format is Format.ArrowIPC:
+            format_codecs = [c for c in codecs if c.name in IPC_CODECS]
+            skipped = sorted({c.name for c in codecs} - IPC_CODECS)
+            if skipped:
+                logging.info(f"Arrow IPC has no codec {', '.join(skipped)}.")
+        for codec, rows, covering, encoding, order in itertools.product(
+            format_codecs, row_group_sizes, coverings, encodings, orders
+        ):
+            variants.append(
+                Variant(
+                    format,
+                    codec=codec,
+                    row_group_size=rows,
+                    covering=covering is Covering.BBox,
+                    encoding=encoding,
+                    order=order,
+                )
+            )
+    # The same codec and level can be given twice, under different spellings
+    return list(dict.fromkeys(variants))
+
+
+# Writing
+def write_variant(gdf: gpd.GeoDataFrame, variant: Variant, path: Path):
+    if variant.order is Order.Hilbert:
+        gdf = gdf.iloc[gdf.hilbert_distance().argsort()].reset_index(drop=True)
+    if variant.format is Format.GeoParquet:
+        gdf.to_parquet(
+            path,
+            geometry_encoding=variant.encoding.value,
+            write_covering_bbox=variant.covering,
+            schema_version="1.1.0",
+            compression=variant.codec.name,
+            compression_level=variant.codec.level,
+            row_group_size=variant.row_group_size,
+        )
+    elif variant.format is Format.ArrowIPC:
+        encoding = "WKB" if variant.encoding is Encoding.WKB else "geoarrow"
+        table = pa.table(gdf.to_arrow(geometry_encoding=encoding, index=False))
+        if variant.covering:
+            table = table.append_column(
+                BBOX_COLUMN, bbox_array(shapely.bounds(gdf.geometry.values))
+            )
+        feather.write_feather(
+            table,
+            path,
+            compression=(
+                "uncompressed" if variant.codec.name == "none" else variant.codec.name
+            ),
+            compression_level=variant.codec.level,
+            chunksize=variant.row_group_size,
+        )
+    else:
+        driver = "FlatGeobuf" if variant.format is Format.FlatGeobuf else "GPKG"
+        pyogrio.write_dataframe(
+            gdf,
+            path,
+            driver=driver,
+            layer_options={"SPATIAL_INDEX": "YES" if variant.spatial_index else "NO"},
+        )
+
+
+def convert_variant(
+    gdf: gpd.GeoDataFrame, variant: Variant, output_dir: Path
+) -> VariantResult:
+    """Write a variant through a temporary file, and time it."""
+    path = output_dir / f"{variant.label}{variant.suffix}"
+    # The prefix keeps the extension, from which GDAL picks the driver
+    tmp_path = path.with_name(f"tmp-{path.name}")
+    start = time.perf_counter()
+    try:
+        write_variant(gdf, variant, tmp_path)
+        tmp_path.replace(path)
+    except Exception as exc:
+        logging.error(f"Failed to write {variant.label} → {exc}")
+        tmp_path.unlink(missing_ok=True)
+        return VariantResult(variant, path, ok=False)
+    seconds = time.perf_counter() - start
+    return VariantResult(variant, path, True, path.stat().st_size, seconds)
+
+
+# Reading
+def decode_geometries(table: pa.Table, column: str = GEOMETRY_COLUMN) -> np.ndarray:
+    """Shapely geometries of a WKB or GeoArrow-native column."""
+    if pa.types.is_binary(table.schema.field(column).type) or pa.types.is_large_binary(
+        table.schema.field(column).type
+    ):
+        return shapely.from_wkb(table.column(column).to_numpy())
+    return np.asarray(gpd.GeoDataFrame.from_arrow(table.select([column])).geometry)
+
+
+def _count_intersecting(table: pa.Table, box: shapely.Geometry, bbox: BBox) -> int:
+    if BBOX_COLUMN in table.schema.names:
+        table = table.filter(bbox_mask(table, bbox))
+    if table.num_rows == 0:
+        return 0
+    return int(shapely.intersects(box, decode_geometries(table)).sum())
+
+
+def full_scan(variant: Variant, path: Path) -> int:
+    if variant.format is Format.GeoParquet:
+        table = pq.read_table(path)
+        geometries = decode_geometries(table)
+    elif variant.format is Format.ArrowIPC:
+        with pa.memory_map(str(path)) as source:
+            table = pa.ipc.open_file(source).read_all()
+            geometries = decode_geometries(table)
+    else:
+        meta, table = pyogrio.read_arrow(path)
+        geometries = decode_geometries(table, meta["geometry_name"] or "wkb_geometry")
+    return len(geometries)
+
+
+def bbox_count(variant: Variant, path: Path, bbox: BBox) -> int:
+    box = shapely.box(*bbox)
+    shapely.prepare(box)
+    if variant.format is Format.GeoParquet:
+        parquet_file = pq.ParquetFile(path)
+        row_groups = list(range(parquet_file.metadata.num_row_groups))
+        bboxes = row_group_bboxes(parquet_file.metadata)
+        if bboxes is not None:
+            row_groups = [rg.row_group for rg in bboxes if rg.intersects(bbox)]
+        if not row_groups:
+            return 0
+        columns = [GEOMETRY_COLUMN]
+        if variant.covering:
+            columns.append(BBOX_COLUMN)
+        table = parquet_file.read_row_groups(row_groups, columns=columns)
+        return _count_intersecting(table, box, bbox)
+    if variant.format is Format.ArrowIPC:
+        count = 0
+        with pa.memory_map(str(path)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                count += _count_intersecting(pa.Table.from_batches([batch]), box, bbox)
+        return count
+    _, table = pyogrio.read_arrow(path, bbox=bbox, columns=[])
+    return table.num_rows
+
+
+def benchmark_variant(
+    country: str,
+    result: VariantResult,
+    scenarios: Dict[int, List[BBox]],
+    cache_modes: List[CacheMode],
+    warmup: int,
+    iterations: int,
+) -> List[Measurement]:
+    variant, path = result.variant, result.path
+    runs: List[Tuple[str, Callable[[int], int]]] = [
+        ("full_scan", lambda i: full_scan(variant, path))
+    ]
+    for size, boxes in scenarios.items():
+        runs.append(
+            (
+                f"bbox_{size}",
+                lambda i, boxes=boxes: bbox_count(variant, path, boxes[i % len(boxes)]),
+            )
+        )
+
+    measurements = []
+    for name, run in runs:
+        for mode in cache_modes:
+            try:
+                times, value = time_runs(
+                    run,
+                    iterations,
+                    warmup=warmup if mode is CacheMode.Warm else 0,
+                    before=(
+                        (lambda: drop_file_cache([path]))
+                        if mode is CacheMode.Cold
+                        else None
+                    ),
+                )
+            except Exception as exc:
+                logging.error(f"{variant.label} {name} ({mode.value}) → {exc}")
+                continue
+            measurements.append(
+                summarize(
+                    times,
+                    value,
+                    country=country,
+                    file=variant.label,
+                    query=name,
+                    cache=mode.value,
+                )
+            )
+    logging.info(f"Benchmarked {variant.label}.")
+    return measurements
+
+
+def format_matrix(
+    results: List[VariantResult],
+    measurements: List[Measurement],
+    queries: List[str],
+    cache: CacheMode,
+) -> str:
+    """One line per variant, with the medians of its queries in one cache mode."""
+    medians = {
+        (m.file, m.query): m.median_s for m in measurements if m.cache == cache.value
+    }
+    lines = [
+        f"{'variant':<48}{'MB':>9}{'convert s':>11}"
+        + "".join(f"{query + ' s':>16}" for query in queries)
+    ]
+    for result in results:
+        label = result.variant.label
+        if not result.ok:
+            lines.append(f"{label:<48}{'failed':>9}")
+            continue
+        cells = [medians.get((label, query)) for query in queries]
+        lines.append(
+            f"{label:<48}{result.bytes / 1024**2:>9.2f}{result.convert_s:>11.2f}"
+            + "".join(f"{c:>16.4f}" if c is not None else f"{'':>16}" for c in cells)
+        )
+    return "\n".join(lines)
+
+
+@app.command()
+def main(
+    input_path: Annotated[
+        Path,
+        typer.Option(
+            "-i",
+            "--input",
+            help="Buildings to convert, in any GDAL format.",
+            exists=True,
+        ),
+    ],
+    work_dir: Annotated[
+        Path | None,
+        typer.Option(
+            "-w",
+            "--work_dir",
+            help="Directory where the variants are kept (default: a temporary one).",
+        ),
+    ] = None,
+    max_rows: Annotated[
+        int | None,
+        typer.Option("--max_rows", help="Only convert the first rows of the input."),
+    ] = None,
+    formats: Annotated[
+        List[Format], typer.Option("--format", help="Formats to sweep (default: all).")
+    ] = list(Format),
+    codecs: Annotated[
+        List[str],
+        typer.Option(
+            "--codec", help="Compression as NAME or NAME:LEVEL, e.g. zstd:15."
+        ),
+    ] = ["zstd:15", "zstd:3", "snappy", "lz4"],
+    row_group_sizes: Annotated[
+        List[int],
+        typer.Option("--row_group_size", help="Rows per row group or record batch."),
+    ] = [50_000, 100_000, 250_000],
+    coverings: Annotated[
+        List[Covering],
+        typer.Option("--covering", help="With a bbox covering column or without."),
+    ] = list(Covering),
+    encodings: Annotated[
+        List[Encoding],
+        typer.Option("--encoding", help="Encodings of the geometries."),
+    ] = list(Encoding),
+    orders: Annotated[
+        List[Order], typer.Option("--order", help="Orders of the rows.")
+    ] = list(Order),
+    bbox_sizes: Annotated[
+        List[int],
+        typer.Option("--bbox_size", help="Sizes in metres of the bbox queries."),
+    ] = BBOX_SIZES,
+    cache_modes: Annotated[
+        List[CacheMode],
+        typer.Option("--cache", help="Run the queries warm, cold or both."),
+    ] = [CacheMode.Warm],
+    warmup: Annotated[
+        int, typer.Option("--warmup", help="Untimed runs before the warm runs.")
+    ] = 1,
+    iterations: Annotated[
+        int, typer.Option("--iterations", help="Timed runs of every query.")
+    ] = ITERATIONS,
+    seed: Annotated[
+        int, typer.Option("--seed", help="Seed of the bbox scenarios.")
+    ] = 0,
+    output: Annotated[
+        Path | None, typer.Option("-o", "--output", help="JSON file of the results.")
+    ] = None,
+    csv_output: Annotated[
+        Path | None, typer.Option("--csv", help="CSV file of the query results.")
+    ] = None,
+    baseline: Annotated[
+        Path | None,
+        typer.Option(
+            "--baseline", help="JSON of a previous run to compare to.", exists=True
+        ),
+    ] = None,
+    threshold: Annotated[
+        float,
+        typer.Option(
+            "--threshold", help="Slowdown of the median flagged as a regression."
+        ),
+    ] = 0.1,
+    min_delta: Annotated[
+        float,
+        typer.Option(
+            "--min_delta", help="Slowdown in seconds below which nothing is flagged."
+        ),
+    ] = 0.005,
+    fail_on_regression: Annotated[
+        bool,
+        typer.Option("--fail_on_regression", help="Exit with 1 on a regression."),
+    ] = False,
+):
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    variants = build_matrix(
+        formats,
+        [Codec.parse(c) for c in codecs],
+        row_group_sizes,
+        coverings,
+        encodings,
+        orders,
+    )
+    country = input_path.name.removesuffix("".join(input_path.suffixes))
+    gdf = gpd.read_file(input_path, max_features=max_rows)
+    if gdf.geometry.name != GEOMETRY_COLUMN:
+        gdf = gdf.rename_geometry(GEOMETRY_COLUMN)
+    logging.info(f"Read {len(gdf)} buildings, sweeping {len(variants)} variants.")
+    scenarios = make_bbox_scenarios(
+        tuple(gdf.total_bounds), bbox_sizes, iterations, seed
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = work_dir or Path(tmp_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        results: List[VariantResult] = []
+        measurements: List[Measurement] = []
+        for variant in variants:
+            result = convert_variant(gdf, variant, output_dir)
+            results.append(result)
+            if result.ok:
+                measurements += benchmark_variant(
+                    country, result, scenarios, cache_modes, warmup, iterations
+                )
+
+    queries = ["full_scan", *(f"bbox_{size}" for size in bbox_sizes)]
+    for mode in cache_modes:
+        print(f"{mode.value}:")
+        print(format_matrix(results, measurements, queries, mode))
+        print()
+    print(format_measurements(measurements))
+
+    context = run_context(
+        input=str(input_path),
+        rows=len(gdf),
+        pyarrow=pa.__version__,
+        geopandas=gpd.__version__,
+        gdal=pyogrio.__gdal_version_string__,
+        bbox_sizes=bbox_sizes,
+        cache=[m.value for m in cache_modes],
+        warmup=warmup,
+        iterations=iterations,
+        seed=seed,
+    )
+    if output is not None:
+        write_json(
+            output, measurements, context, variants=[r.to_json() for r in results]
+        )
+    if csv_output is not None:
+        write_csv(csv_output, measurements)
+
+    if baseline is not None:
+        regressed = report_regressions(measurements, baseline, threshold, min_delta)
+        if regressed and fail_on_regression:
+            raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
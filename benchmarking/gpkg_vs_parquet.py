@@ -1,251 +1,481 @@
-import duckdb
-import os
-import time
-import random
-
-#TODO add a code to replace '-' with '_' and atomatically switch to other countries/maybe not necessary
-gpkg_file = "v0_1-CYP.gpkg"
-zipped_gpkg_file = "v0_1-CYP.zip"
-ogr_parquet_file = "v0_1-CYP_ogr2ogr.parquet"
-gpio_parquet_file = "v0_1-CYP_gpio.parquet"
-
-files = [
-    ("gpkg", gpkg_file),
-    ("zipped gpkg", zipped_gpkg_file),
-    ("ogr parquet", ogr_parquet_file),
-    ("gpio parquet", gpio_parquet_file)
-]
-
-con = duckdb.connect()
-con.sql("INSTALL spatial; LOAD spatial;")
-
-"""
-Test 1: Storage size test
-    - See how much smaller Geoparquet is in comparison to Geopackage
-"""
-
-print("Test 1: Storage Size Test")
-
-baseline_size = 0
-
-for name, path in files:
-    if os.path.exists(path):
-        # convert bytes to megabytes, divide the byte value by (1024 * 1024)
-        size_mb = os.path.getsize(path)/(1024 * 1024)
-        if name == "gpkg":
-            baseline_size = size_mb
-            print(f"{name:<20} : {size_mb:.2f} MB")
-        else: 
-            difference = ((baseline_size - size_mb)/baseline_size)*100
-            print(f"{name:<20} : {size_mb:.2f} MB ({difference:.1f}% smaller)")
-    else: 
-        print(f"File {name:<20} not found.")
-
-"""
-Test 2: Counting all rows
-    - See how long it takes to read the whole file. 
-"""
-print()
-print("Test 2: Counting all rows")
-
-for name, path in files:
-    if not os.path.exists(path): 
-        continue
-
-    start_time = time.time()
-
-    if path.endswith(".zip"):
-        continue
-
-    if path.endswith(".gpkg"):
-        con.sql(f"SELECT count(*) FROM ST_Read('{path}')").fetchall()
-    else: 
-        con.sql(f"SELECT count(*) FROM '{path}'").fetchall()
-
-    end_time = time.time()
-    print(f"{name:<20} : {end_time - start_time:.25f} seconds.")
-
-"""
-Test 3: File export as CSV
-    - See how long it takes to read every single cell and convert geometry to WKT by exporting it to CSV
-"""
-print()
-print("Test 3: Reading the full file - exporting it as CSV")
-
-output_csv = "benchmark.csv"
-
-for name, path in files:
-    if not os.path.exists(path):
-        continue
-
-    if path.endswith(".zip"):
-        continue
-
-    if path.endswith(".gpkg"):
-        columns = con.sql(f"DESCRIBE SELECT * FROM ST_Read('{path}')").df()['column_name'].tolist()
-    else:
-        columns = con.sql(f"DESCRIBE SELECT * FROM '{path}'").df()['column_name'].tolist()
-    
-    if 'geometry' in columns:
-        geo_col = 'geometry'
-    else:
-        geo_col = 'geom'
-
-    start_time = time.time()
-
-    if path.endswith(".gpkg"):
-        con.sql(f"""
-                COPY( 
-                    SELECT
-                        * EXCLUDE {geo_col}, 
-                        ST_AsText({geo_col}) AS wkt 
-                    FROM ST_Read('{path}')
-                ) TO '{output_csv}' WITH (HEADER, DELIMITER ';')
-            """)
-    else:
-        con.sql(f"""
-                COPY(
-                    SELECT
-                        * EXCLUDE {geo_col},
-                        ST_AsText({geo_col}) AS wkt
-                    FROM '{path}'
-                ) TO '{output_csv}' WITH (HEADER, DELIMITER ';')
-        """)
-    
-    end_time = time.time()
-    csv_size = os.path.getsize(output_csv) / (1024 * 1024)
-
-    print(f"{name:<20} : {end_time - start_time:.6f} seconds (wrote CSV file of {csv_size:.1f} MB)")
-
-    if os.path.exists(output_csv):
-        os.remove(output_csv)
-
-"""
-Test 4: Attribute access
-    - See how long it takes to read only certain attributes, e.g. only get age or height
-    - Use case example: Useful when wanting to visualize the data in graphs on the hosting website
 """
-print()
-print("Test 4: Attribute access")
-
-for name, path in files:
-    if not os.path.exists(path): 
-        continue
-
-    if path.endswith(".zip"):
-        continue
-
-    start_time = time.time()
-
-    # for Cyprus age and type is NULL, so I only did height
-    if path.endswith(".gpkg"):
-        con.sql(f"SELECT min(height), max(height) FROM ST_Read('{path}')").fetchall()
-    else:
-        con.sql(f"SELECT min(height), max(height) FROM '{path}'").fetchall()   
-
-    end_time = time.time()
-    print(f"{name:<20} : min-max in {end_time - start_time:.10f} seconds.")
-
-for name, path in files:
-    if not os.path.exists(path): 
-        continue
-
-    if path.endswith(".zip"):
-        continue
-
-    start_time = time.time()
-
-    if path.endswith(".gpkg"):
-        con.sql(f"SELECT avg(height) FROM ST_Read('{path}')").fetchall()
-    else:
-        con.sql(f"SELECT avg(height) FROM '{path}'").fetchall()   
-
-    end_time = time.time()
-
-    print(f"{name:<20} : avg in {end_time - start_time:.10f} seconds")
-
-
-"""
-Test 5: BBox filtering
-    - See how long it takes to find data withing a certain bounding box (centered based on the data).
+Compare the storage size and the query latency of the buildings in several formats
+with DuckDB: GeoPackage (zipped or not), FlatGeoBuf, GeoParquet files and partitioned
+GeoParquet datasets.
+
+Each query runs warm, after `--warmup` untimed runs on the same connection, and cold,
+after dropping the files from the page cache and opening a new connection, and is
+timed `--iterations` times. The bbox queries use the same random boxes in every file
+of a country, reprojected to the CRS of each file. The results can be written as JSON
+or CSV, and compared to the JSON of a previous run to flag regressions.
+
+Usage:
+    python gpkg_vs_parquet.py -d <data_dir> -c CYP -o results.json
+    python gpkg_vs_parquet.py -f v0_1-CYP.gpkg -f gpio=v0_1-CYP_gpio.parquet \
+        --baseline results.json
 """
 
-print()
-print("Test 5: BBox filtering")
-
-ref_bbox_file = files[0][1] # Reference file (GPKG)
-if not os.path.exists(ref_bbox_file):
-    print("Reference file missing")
-    exit()
-
-bounds = con.sql(f"""
-    SELECT ST_XMin(geom), ST_YMin(geom), ST_XMax(geom), ST_YMax(geom)
-    FROM (SELECT ST_Extent(geom) AS geom FROM ST_Read('{ref_bbox_file}'))
-""").fetchone()
-
-global_minx, global_miny, global_maxx, global_maxy = bounds
-
-bbox_sizes = [500, 5000, 20000] # 500m, 5km, 20km
-iterations = 10
-
-#make same test scenarios for every file type
-test_scenarios = {}
+import json
+import logging
+import sys
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Annotated, Dict, List, Tuple
 
-for size in bbox_sizes:
-    scenarios = []
-    for _ in range(iterations):
-        # ensure the box within bounds by subtracting 'size'
-        rand_x = random.uniform(global_minx, global_maxx - size)
-        rand_y = random.uniform(global_miny, global_maxy - size)
-        
-        box = (rand_x, rand_y, rand_x + size, rand_y + size) #minx, miny, maxx, maxy
-        scenarios.append(box)
-    test_scenarios[size] = scenarios
-
-print(f"Generated {len(bbox_sizes) * iterations} test scenarios.")
-
-for name, path in files:
-    if not os.path.exists(path):
-        continue
-
-    if path.endswith(".zip"):
-        continue
-
-    if path.endswith(".gpkg"):
-        columns = con.sql(f"DESCRIBE SELECT * FROM ST_Read('{path}')").df()['column_name'].tolist()
-    else:
-        columns = con.sql(f"DESCRIBE SELECT * FROM '{path}'").df()['column_name'].tolist()
-    
-    if 'geometry' in columns:
-        geo_col = 'geometry'
+import duckdb
+import pyarrow.parquet as pq
+import pyogrio
+import typer
+from pyproj import Transformer
+
+from harness import (
+    CacheMode,
+    Measurement,
+    drop_file_cache,
+    format_measurements,
+    parse_labeled_path,
+    report_regressions,
+    run_context,
+    summarize,
+    time_runs,
+    write_csv,
+    write_json,
+)
+from scenarios import BBOX_SIZES, ITERATIONS, BBox, make_bbox_scenarios
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "data_conversions"))
+
+from parquet_index import BBOX_COLUMN  # noqa: E402
+from utils import init_db_con  # noqa: E402
+
+app = typer.Typer()
+
+# Files of a country in the data directory, by label
+COUNTRY_FILES = {
+    "gpkg.zip": "buildings/gpkg/{code}.gpkg.zip",
+    "flatgeobuf": "buildings/flatgeobuf/{code}.fgb",
+    "admin parquet": "buildings/admin/{code}.parquet",
+}
+# Partitioned datasets of a country, labelled by their scheme
+COUNTRY_DATASETS = "partition/*/country={code}"
+# Group of the files given on the command line
+FILES_GROUP = "files"
+# The bbox sizes are in metres, so the boxes are drawn in the EUBUCCO CRS
+SCENARIO_CRS = "EPSG:3035"
+
+GEOMETRY_NAMES = ["geometry", "geom", "wkb_geometry"]
+
+
+class Query(Enum):
+    Count = "count"
+    FullScan = "full_scan"
+    HeightMinMax = "height_minmax"
+    HeightAvg = "height_avg"
+    BBox = "bbox"
+
+
+# Only identifiers are formatted in, the values are bound as parameters
+QUERIES = {
+    Query.Count: "SELECT count(*) FROM {relation}",
+    # Reads every cell, with the geometries converted to WKT
+    Query.FullScan: (
+        "SELECT * EXCLUDE ({geometry_column}), ST_AsText({geometry}) AS wkt "
+        "FROM {relation}"
+    ),
+    Query.HeightMinMax: "SELECT min(height), max(height) FROM {relation}",
+    Query.HeightAvg: "SELECT avg(height) FROM {relation}",
+    Query.BBox: (
+        "SELECT count(*) FROM {relation} WHERE {bbox_filter}"
+        "ST_Intersects({geometry}, ST_MakeEnvelope($xmin, $ymin, $xmax, $ymax))"
+    ),
+}
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+@dataclass
+class Source:
+    country: str
+    label: str
+    path: Path
+    crs: str | None = None
+    geometry_column: str = ""
+    # SQL of the geometry, decoded from WKB if the column is a blob
+    geometry: str = ""
+    # GeoParquet with a bbox column, whose statistics prune the row groups
+    has_bbox: bool = False
+
+    @property
+    def is_parquet(self) -> bool:
+        return self.path.is_dir() or self.path.suffix == ".parquet"
+
+    @property
+    def size(self) -> int:
+        if self.path.is_dir():
+            return sum(p.stat().st_size for p in self.path.rglob("*") if p.is_file())
+        return self.path.stat().st_size
+
+    def path_param(self) -> str:
+        if self.path.is_dir():
+            return str(self.path / "**" / "*.parquet")
+        if self.path.suffix == ".zip":
+            return f"/vsizip/{self.path}"
+        return str(self.path)
+
+    def relation(self, bbox: bool = False) -> str:
+        """SQL of the table, read through GDAL with its spatial index for bboxes."""
+        if self.path.is_dir():
+            return "read_parquet($path, hive_partitioning = false)"
+        if self.is_parquet:
+            return "read_parquet($path)"
+        if bbox:
+            return (
+                "st_read($path, spatial_filter_box := "
+                "ST_MakeBox2D(ST_Point($xmin, $ymin), ST_Point($xmax, $ymax)))"
+            )
+        return "st_read($path)"
+
+
+def file_crs(path: Path) -> str | None:
+    """CRS of a file, from the GeoParquet metadata or GDAL, None if unknown."""
+    if path.is_dir():
+        path = next(path.rglob("*.parquet"), path)
+    if path.suffix != ".parquet":
+        return pyogrio.read_info(path)["crs"]
+    geo = (pq.read_schema(path).metadata or {}).get(b"geo")
+    if geo is None:
+        return None
+    geo = json.loads(geo)
+    # A missing CRS means OGC:CRS84 in GeoParquet, a null one that it is unknown
+    crs = geo["columns"][geo["primary_column"]].get("crs", "OGC:CRS84")
+    return json.dumps(crs) if isinstance(crs, dict) else crs
+
+
+def inspect_source(con, source: Source):
+    """Find the geometry and bbox columns and the CRS of `source`."""
+    columns = con.execute(
+        f"DESCRIBE SELECT * FROM {source.relation()}", {"path": source.path_param()}
+    ).fetchall()
+    types = {name: type_ for name, type_, *_ in columns}
+    name = next((n for n, t in types.items() if t == "GEOMETRY"), None)
+    if name is not None:
+        source.geometry_column = name
+        source.geometry = _quote(name)
     else:
-        geo_col = 'geom'
-
-    # Iterate through pre-defined scenarios:
-    for size, boxes in test_scenarios.items():
-
-        times = []
-
-        for box in boxes:
-            local_minx, local_miny, local_maxx, local_maxy = box
-            
-            start_time = time.time()
-
-            if path.endswith(".gpkg"):
-                con.sql(f"""
-                    SELECT count(*) FROM ST_Read('{path}')
-                    WHERE ST_Intersects({geo_col}, ST_MakeEnvelope({local_minx}, {local_miny}, {local_maxx}, {local_maxy}))
-                """).fetchall()
-            else:
-                con.sql(f"""
-                    SELECT count(*) FROM '{path}'
-                    WHERE ST_Intersects({geo_col}, ST_MakeEnvelope({local_minx}, {local_miny}, {local_maxx}, {local_maxy}))
-                """).fetchall()
-            
-            times.append(time.time() - start_time)
-
-        avg_time = sum(times) / len(times)
-        min_time = min(times)
-        max_time = max(times)
-
-        print(f"{name:<20} | Size: {size:<6}m | Avg: {avg_time:.4f} s | (Min: {min_time:.4f} s | Max: {max_time:.4f}) s")
\ No newline at end of file
+        name = next((n for n in GEOMETRY_NAMES if types.get(n) == "BLOB"), None)
+        if name is None:
+            raise RuntimeError(f"No geometry column found in {source.path}.")
+        source.geometry_column = name
+        source.geometry = f"ST_GeomFromWKB({_quote(name)})"
+    source.has_bbox = types.get(BBOX_COLUMN, "").startswith("STRUCT")
+    source.crs = file_crs(source.path)
+
+
+def find_sources(
+    data_dir: Path | None, country_codes: List[str], files: List[str]
+) -> Dict[str, List[Source]]:
+    """
+    Sources to compare by group: the files of each country in the data directory, and
+    the files given as `PATH` or `LABEL=PATH`.
+    """
+    groups: Dict[str, List[Source]] = {}
+    for code in country_codes:
+        sources = []
+        for label, pattern in COUNTRY_FILES.items():
+            path = data_dir / pattern.format(code=code)
+            if path.exists():
+                sources.append(Source(code, label, path))
+        for path in sorted(data_dir.glob(COUNTRY_DATASETS.format(code=code))):
+            sources.append(Source(code, f"partition/{path.parent.name}", path))
+        if not sources:
+            logging.warning(f"No files found for {code} in {data_dir}.")
+            continue
+        groups[code] = sources
+    for file in files:
+        label, path = parse_labeled_path(file)
+        if not path.exists():
+            raise typer.BadParameter(f"{path} does not exist.")
+        groups.setdefault(FILES_GROUP, []).append(Source(FILES_GROUP, label, path))
+    return groups
+
+
+def source_bounds(con, source: Source) -> BBox:
+    return con.execute(
+        f"""
+        SELECT
+            min(ST_XMin({source.geometry})), min(ST_YMin({source.geometry})),
+            max(ST_XMax({source.geometry})), max(ST_YMax({source.geometry}))
+        FROM {source.relation()}
+        """,
+        {"path": source.path_param()},
+    ).fetchone()
+
+
+def reproject_bbox(box: BBox, from_crs: str | None, to_crs: str | None) -> BBox:
+    if from_crs is None or to_crs is None or from_crs == to_crs:
+        return box
+    return Transformer.from_crs(from_crs, to_crs, always_xy=True).transform_bounds(*box)
+
+
+def reproject_scenarios(
+    scenarios: Dict[int, List[BBox]], from_crs: str | None, to_crs: str | None
+) -> Dict[int, List[BBox]]:
+    if from_crs is None or to_crs is None or from_crs == to_crs:
+        return scenarios
+    transformer = Transformer.from_crs(from_crs, to_crs, always_xy=True)
+    return {
+        size: [transformer.transform_bounds(*box) for box in boxes]
+        for size, boxes in scenarios.items()
+    }
+
+
+def run_query(con, source: Source, query: Query, box: BBox | None = None):
+    """Run a query to completion and return its first value, or its rows."""
+    bbox_filter = ""
+    if query is Query.BBox and source.has_bbox:
+        # Lets DuckDB skip the row groups from their statistics
+        bbox_filter = (
+            f"{BBOX_COLUMN}.xmin <= $xmax AND {BBOX_COLUMN}.xmax >= $xmin AND "
+            f"{BBOX_COLUMN}.ymin <= $ymax AND {BBOX_COLUMN}.ymax >= $ymin AND "
+        )
+    sql = QUERIES[query].format(
+        relation=source.relation(bbox=query is Query.BBox),
+        geometry=source.geometry,
+        geometry_column=_quote(source.geometry_column),
+        bbox_filter=bbox_filter,
+    )
+    params = {"path": source.path_param()}
+    if query is Query.BBox:
+        params.update(zip(["xmin", "ymin", "xmax", "ymax"], box))
+    cursor = con.execute(sql, params)
+    if query is Query.FullScan:
+        return sum(batch.num_rows for batch in cursor.fetch_record_batch())
+    value = cursor.fetchone()[0]
+    return float(value) if value is not None else None
+
+
+def benchmark_source(
+    source: Source,
+    queries: List[Query],
+    scenarios: Dict[int, List[BBox]],
+    cache_modes: List[CacheMode],
+    warmup: int,
+    iterations: int,
+) -> List[Measurement]:
+    measurements = []
+    runs: List[Tuple[str, Query, List[BBox | None]]] = []
+    for query in queries:
+        if query is Query.BBox:
+            for size, boxes in scenarios.items():
+                runs.append((f"bbox_{size}", query, boxes))
+        else:
+            runs.append((query.value, query, [None]))
+
+    for name, query, boxes in runs:
+        for mode in cache_modes:
+            state = {"con": init_db_con(read_only=True)}
+
+            def reconnect():
+                state["con"].close()
+                drop_file_cache([source.path])
+                state["con"] = init_db_con(read_only=True)
+
+            def run(i: int):
+                return run_query(state["con"], source, query, boxes[i % len(boxes)])
+
+            try:
+                times, result = time_runs(
+                    run,
+                    iterations,
+                    warmup=warmup if mode is CacheMode.Warm else 0,
+                    before=reconnect if mode is CacheMode.Cold else None,
+                )
+            except Exception as exc:
+                logging.error(f"{source.label} {name} ({mode.value}) → {exc}")
+                continue
+            finally:
+                state["con"].close()
+            measurements.append(
+                summarize(
+                    times,
+                    result,
+                    country=source.country,
+                    file=source.label,
+                    query=name,
+                    cache=mode.value,
+                )
+            )
+            logging.info(
+                f"{source.country} {source.label} {name} ({mode.value}): "
+                f"median {measurements[-1].median_s:.4f} s"
+            )
+    return measurements
+
+
+def format_sizes(groups: Dict[str, List[Source]]) -> str:
+    lines = [f"{'country':<8}{'file':<24}{'MB':>10}{'vs first':>10}"]
+    for sources in groups.values():
+        reference = sources[0].size
+        for source in sources:
+            size = source.size
+            change = (size - reference) / reference * 100 if reference else 0.0
+            lines.append(
+                f"{source.country:<8}{source.label:<24}{size / 1024**2:>10.2f}"
+                f"{change:>9.1f}%"
+            )
+    return "\n".join(lines)
+
+
+@app.command()
+def main(
+    data_dir: Annotated[
+        Path | None,
+        typer.Option(
+            "-d", "--data_dir", help="Main directory of the data.", exists=True
+        ),
+    ] = None,
+    country_codes: Annotated[
+        List[str],
+        typer.Option("-c", "--country_code", help="Countries whose files to compare."),
+    ] = [],
+    files: Annotated[
+        List[str],
+        typer.Option(
+            "-f", "--file", help="Other file to compare, as PATH or LABEL=PATH."
+        ),
+    ] = [],
+    queries: Annotated[
+        List[Query],
+        typer.Option("-q", "--query", help="Queries to run (default: all)."),
+    ] = list(Query),
+    bbox_sizes: Annotated[
+        List[int],
+        typer.Option("--bbox_size", help="Sizes in metres of the bbox queries."),
+    ] = BBOX_SIZES,
+    cache_modes: Annotated[
+        List[CacheMode],
+        typer.Option("--cache", help="Run the queries warm, cold or both."),
+    ] = list(CacheMode),
+    warmup: Annotated[
+        int, typer.Option("--warmup", help="Untimed runs before the warm runs.")
+    ] = 1,
+    iterations: Annotated[
+        int, typer.Option("--iterations", help="Timed runs of every query.")
+    ] = ITERATIONS,
+    seed: Annotated[
+        int, typer.Option("--seed", help="Seed of the bbox scenarios.")
+    ] = 0,
+    output: Annotated[
+        Path | None, typer.Option("-o", "--output", help="JSON file of the results.")
+    ] = None,
+    csv_output: Annotated[
+        Path | None, typer.Option("--csv", help="CSV file of the results.")
+    ] = None,
+    baseline: Annotated[
+        Path | None,
+        typer.Option(
+            "--baseline", help="JSON of a previous run to compare to.", exists=True
+        ),
+    ] = None,
+    threshold: Annotated[
+        float,
+        typer.Option(
+            "--threshold", help="Slowdown of the median flagged as a regression."
+        ),
+    ] = 0.1,
+    min_delta: Annotated[
+        float,
+        typer.Option(
+            "--min_delta", help="Slowdown in seconds below which nothing is flagged."
+        ),
+    ] = 0.005,
+    fail_on_regression: Annotated[
+        bool,
+        typer.Option("--fail_on_regression", help="Exit with 1 on a regression."),
+    ] = False,
+):
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    if country_codes and data_dir is None:
+        raise typer.BadParameter("--data_dir is needed to find the countries.")
+    groups = find_sources(data_dir, country_codes, files)
+    if not groups:
+        raise typer.BadParameter("Nothing to compare, give countries or files.")
+    if CacheMode.Cold in cache_modes and not drop_file_cache([]):
+        logging.warning(
+            "The page cache cannot be dropped here, cold runs only reconnect."
+        )
+
+    measurements: List[Measurement] = []
+    con = init_db_con(read_only=True)
+    try:
+        for group, sources in groups.items():
+            for source in sources:
+                inspect_source(con, source)
+            # The same boxes for every file, drawn in metres around the first one,
+            # or in its own units if its CRS is unknown
+            reference = sources[0]
+            scenario_crs = SCENARIO_CRS if reference.crs is not None else None
+            scenarios = {}
+            if Query.BBox in queries:
+                bounds = reproject_bbox(
+                    source_bounds(con, reference), reference.crs, scenario_crs
+                )
+                scenarios = make_bbox_scenarios(bounds, bbox_sizes, iterations, seed)
+                logging.info(
+                    f"Generated {len(bbox_sizes) * iterations} test scenarios "
+                    f"for {group}."
+                )
+            for source in sources:
+                measurements += benchmark_source(
+                    source,
+                    queries,
+                    reproject_scenarios(scenarios, scenario_crs, source.crs),
+                    cache_modes,
+                    warmup,
+                    iterations,
+                )
+    finally:
+        con.close()
+
+    print(format_sizes(groups))
+    print()
+    print(format_measurements(measurements))
+
+    files_info = [
+        {
+            "country": s.country,
+            "file": s.label,
+            "path": str(s.path),
+            "bytes": s.size,
+            "crs": s.crs,
+        }
+        for sources in groups.values()
+        for s in sources
+    ]
+    context = run_context(
+        duckdb=duckdb.__version__,
+        queries=[q.value for q in queries],
+        bbox_sizes=bbox_sizes,
+        cache=[m.value for m in cache_modes],
+        warmup=warmup,
+        iterations=iterations,
+        seed=seed,
+    )
+    if output is not None:
+        write_json(output, measurements, context, files=files_info)
+    if csv_output is not None:
+        write_csv(csv_output, measurements)
+
+    if baseline is not None:
+        regressed = report_regressions(measurements, baseline, threshold, min_delta)
+        if regressed and fail_on_regression:
+            raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,270 @@
+"""
+Timing, statistics and reporting shared by the benchmarks.
+
+A benchmark measures a callable a number of times, either warm, after some untimed
+runs on the same state, or cold, after dropping its files from the page cache before
+every run. The measurements are written as JSON with the context of the run, or as
+CSV, and can be compared to those of a previous run to flag regressions.
+"""
+
+import csv
+import json
+import logging
+import os
+import platform
+import statistics
+import time
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime, timezone
+from enum import Enum
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Type
+
+import numpy as np
+
+
+class CacheMode(Enum):
+    Warm = "warm"
+    Cold = "cold"
+
+
+@dataclass
+class Measurement:
+    country: str
+    file: str
+    query: str
+    cache: str
+    iterations: int
+    median_s: float
+    p95_s: float
+    min_s: float
+    max_s: float
+    mean_s: float
+    # Value returned by the last run, such as a count, to check the files agree
+    result: float | None = None
+
+    @property
+    def key(self) -> Tuple[str, str, str, str]:
+        return self.country, self.file, self.query, self.cache
+
+
+def summarize(
+    times: List[float], result: float | None = None, **key: str
+) -> Measurement:
+    return Measurement(
+        **key,
+        iterations=len(times),
+        median_s=statistics.median(times),
+        p95_s=float(np.percentile(times, 95)),
+        min_s=min(times),
+        max_s=max(times),
+        mean_s=statistics.fmean(times),
+        result=result,
+    )
+
+
+def drop_file_cache(paths: Iterable[Path]) -> bool:
+    """
+    Evict the pages of `paths`, or of the files under them for directories, from the
+    page cache so that the next read hits the disk. This needs no privileges but only
+    works on Linux, returns False elsewhere.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for path in paths:
+        files = path.rglob("*") if path.is_dir() else [path]
+        for file in files:
+            if not file.is_file():
+                continue
+            fd = os.open(file, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    return True
+
+
+def time_runs(
+    run: Callable[[int], Any],
+    iterations: int,
+    warmup: int = 0,
+    before: Callable[[], None] | None = None,
+) -> Tuple[List[float], Any]:
+    """
+    Time `iterations` calls of `run(i)` after `warmup` untimed ones, calling `before`
+    untimed before each timed call. Returns the times and the last result.
+    """
+    for i in range(warmup):
+        run(i)
+    times = []
+    result = None
+    for i in range(iterations):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        result = run(i)
+        times.append(time.perf_counter() - start)
+    return times, result
+
+
+def run_context(**params: Any) -> Dict[str, Any]:
+    """Context of a run written next to its measurements."""
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "params": params,
+    }
+
+
+def write_json(
+    path: Path,
+    measurements: List[Measurement],
+    context: Dict[str, Any],
+    **extra: Any,
+):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        json.dumps(
+            {
+                "context": context,
+                **extra,
+                "measurements": [asdict(m) for m in measurements],
+            },
+            indent=2,
+            default=str,
+        )
+    )
+
+
+def write_csv(path: Path, measurements: List[Measurement]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # The columns of the benchmarks that record more than the times
+    kind = type(measurements[0]) if measurements else Measurement
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=[f.name for f in fields(kind)])
+        writer.writeheader()
+        for measurement in measurements:
+            writer.writerow(asdict(measurement))
+
+
+def load_measurements(
+    path: Path, kind: Type[Measurement] = Measurement
+) -> List[Measurement]:
+    """Read the measurements of a JSON written by `write_json`."""
+    return [kind(**m) for m in json.loads(path.read_text())["measurements"]]
+
+
+@dataclass
+class Comparison:
+    measurement: Measurement
+    baseline: Measurement
+    status: str
+
+    @property
+    def ratio(self) -> float:
+        if self.baseline.median_s == 0:
+            return float("inf") if self.measurement.median_s > 0 else 1.0
+        return self.measurement.median_s / self.baseline.median_s
+
+
+def compare(
+    measurements: List[Measurement],
+    baseline: List[Measurement],
+    threshold: float = 0.1,
+    min_delta: float = 0.005,
+) -> List[Comparison]:
+    """
+    Compare the medians to those of the same country, file, query and cache mode in
+    `baseline`. A run is a regression if it is more than `threshold` slower and by at
+    least `min_delta` seconds, so that the noise of very fast queries is ignored.
+    """
+    baseline_by_key = {m.key: m for m in baseline}
+    comparisons = []
+    for measurement in measurements:
+        base = baseline_by_key.get(measurement.key)
+        if base is None:
+            continue
+        delta = measurement.median_s - base.median_s
+        if delta > base.median_s * threshold and delta >= min_delta:
+            status = "regression"
+        elif -delta > base.median_s * threshold and -delta >= min_delta:
+            status = "improvement"
+        else:
+            status = "ok"
+        comparisons.append(Comparison(measurement, base, status))
+    missing = len(measurements) - len(comparisons)
+    if missing:
+        logging.info(f"{missing} measurement(s) are not in the baseline.")
+    return comparisons
+
+
+def report_regressions(
+    measurements: List[Measurement],
+    baseline: Path,
+    threshold: float = 0.1,
+    min_delta: float = 0.005,
+    kind: Type[Measurement] = Measurement,
+) -> bool:
+    """
+    Print the comparison of `measurements` to the JSON of a previous run, and warn
+    about the regressions. Returns whether there is any.
+    """
+    comparisons = compare(
+        measurements, load_measurements(baseline, kind), threshold, min_delta
+    )
+    print()
+    print(format_comparisons(comparisons))
+    regressions = [c for c in comparisons if c.status == "regression"]
+    if regressions:
+        logging.warning(f"{len(regressions)} regression(s) against {baseline}.")
+    return bool(regressions)
+
+
+def parse_labeled_path(value: str) -> Tuple[str, Path]:
+    """
+    Label and path of a file given as `PATH` or `LABEL=PATH`, labelled by its name by
+    default. Partitions have `=` in their path, so labels cannot contain a slash.
+    """
+    label, sep, path = value.partition("=")
+    if not sep or "/" in label:
+        label, path = "", value
+    path = Path(path)
+    return label or path.name, path
+
+
+def _file_width(measurements: List[Measurement]) -> int:
+    return max([24, *(len(m.file) + 2 for m in measurements)])
+
+
+def format_measurements(measurements: List[Measurement]) -> str:
+    w = _file_width(measurements)
+    lines = [
+        f"{'country':<8}{'file':<{w}}{'query':<16}{'cache':<6}{'n':>4}"
+        f"{'median s':>11}{'p95 s':>10}{'min s':>10}{'max s':>10}{'result':>12}"
+    ]
+    for m in measurements:
+        result = f"{m.result:>12.0f}" if m.result is not None else f"{'':>12}"
+        lines.append(
+            f"{m.country:<8}{m.file:<{w}}{m.query:<16}{m.cache:<6}{m.iterations:>4}"
+            f"{m.median_s:>11.4f}{m.p95_s:>10.4f}{m.min_s:>10.4f}{m.max_s:>10.4f}"
+            f"{result}"
+        )
+    return "\n".join(lines)
+
+
+def format_comparisons(comparisons: List[Comparison]) -> str:
+    w = _file_width([c.measurement for c in comparisons])
+    lines = [
+        f"{'country':<8}{'file':<{w}}{'query':<16}{'cache':<6}"
+        f"{'baseline s':>12}{'median s':>11}{'ratio':>8}  status"
+    ]
+    for c in comparisons:
+        m = c.measurement
+        lines.append(
+            f"{m.country:<8}{m.file:<{w}}{m.query:<16}{m.cache:<6}"
+            f"{c.baseline.median_s:>12.4f}{m.median_s:>11.4f}{c.ratio:>8.2f}  {c.status}"
+        )
+    return "\n".join(lines)
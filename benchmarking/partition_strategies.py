@@ -0,0 +1,483 @@
+"""
+Compare partitioning schemes of the buildings of one country: H3 cells at several
+resolutions, geoBoundaries ADM1/ADM2 regions, quadkey tiles and a size-balanced
+KD-split. Every scheme partitions the same rows with the same row group size, and
+is queried with the same bbox scenarios as gpkg_vs_parquet.py.
+
+For each scheme it reports the number of files, the distribution of the partition
+sizes, and the latency and bytes read of the bbox queries. The partitions to read are
+picked from the extent of each partition, like a catalog would, so that all the
+schemes are pruned the same way.
+
+Usage: python partition_strategies.py -d <data_dir> -c CYP
+"""
+
+import json
+import logging
+import shutil
+import statistics
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Annotated, Dict, List, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+import typer
+from pyproj import Transformer
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "data_conversions"))
+
+from parquet_index import (  # noqa: E402
+    BBOX_COLUMN,
+    BBox,
+    geometry_column,
+    row_group_bboxes,
+)
+from partition import _source_layer  # noqa: E402
+from partition_query import ScanStats, scan_parquet_files  # noqa: E402
+from scenarios import BBOX_SIZES, ITERATIONS, make_bbox_scenarios  # noqa: E402
+from utils import init_db_con, load_h3  # noqa: E402
+
+app = typer.Typer()
+
+PART_COLUMN = "part"
+ROW_GROUP_SIZE = 100_000
+
+
+@dataclass
+class Scheme:
+    name: str
+    kind: str
+    # H3 resolution, quadkey zoom, admin level or max rows per KD leaf
+    param: str
+
+
+@dataclass
+class SizeStats:
+    min: int
+    median: float
+    p95: float
+    max: int
+    # Coefficient of variation, std / mean
+    cv: float
+
+
+@dataclass
+class QueryStats:
+    bbox_size: int
+    median_ms: float
+    p95_ms: float
+    partitions: float
+    files: float
+    bytes_read: float
+    rows_matched: float
+
+
+@dataclass
+class SchemeResult:
+    scheme: str
+    build_s: float
+    partitions: int
+    files: int
+    total_bytes: int
+    partition_bytes: SizeStats
+    partition_rows: SizeStats
+    queries: List[QueryStats] = field(default_factory=list)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def size_stats(values: List[int]) -> SizeStats:
+    mean = statistics.fmean(values)
+    return SizeStats(
+        min=min(values),
+        median=statistics.median(values),
+        p95=_percentile(values, 95),
+        max=max(values),
+        cv=statistics.pstdev(values) / mean if mean else 0.0,
+    )
+
+
+def prepare_base(con, gpkg_path: Path, base_path: Path) -> str:
+    """
+    Reproject the buildings to EPSG:4326 once into a Parquet file with their bbox and
+    centroid, which every scheme then partitions. Returns the CRS of the source.
+    """
+    geom_column, source_crs = _source_layer(con, gpkg_path)
+    if base_path.exists():
+        return source_crs
+    logging.info(f"Reprojecting {gpkg_path} ({source_crs})...")
+    con.execute(
+        f"""
+        COPY (
+            WITH reprojected AS (
+                SELECT * EXCLUDE ("{geom_column}"),
+                ST_Transform("{geom_column}", $source_crs, 'EPSG:4326', true) AS geometry
+                FROM st_read($input_path)
+            )
+            SELECT *,
+            ST_X(ST_Centroid(geometry)) AS cx,
+            ST_Y(ST_Centroid(geometry)) AS cy,
+            struct_pack(
+                xmin := ST_XMin(geometry),
+                ymin := ST_YMin(geometry),
+                xmax := ST_XMax(geometry),
+                ymax := ST_YMax(geometry)
+            ) AS {BBOX_COLUMN}
+            FROM reprojected
+        )
+        TO $base_path (FORMAT parquet, COMPRESSION zstd);
+        """,
+        {
+            "input_path": str(gpkg_path),
+            "source_crs": source_crs,
+            "base_path": str(base_path),
+        },
+    )
+    return source_crs
+
+
+def kd_split(x: np.ndarray, y: np.ndarray, max_rows: int) -> np.ndarray:
+    """
+    Split the points at the median of their widest axis until every leaf has at most
+    `max_rows` points. Returns the leaf of each point.
+    """
+    leaves = np.zeros(len(x), dtype=np.int32)
+    stack = [np.arange(len(x))]
+    n_leaves = 0
+    while stack:
+        idx = stack.pop()
+        xs, ys = x[idx], y[idx]
+        if len(idx) > max_rows:
+            values = xs if np.ptp(xs) >= np.ptp(ys) else ys
+            median = np.partition(values, len(values) // 2)[len(values) // 2]
+            left = values < median
+            # Points all on the median cannot be split further
+            if left.any():
+                stack.append(idx[~left])
+                stack.append(idx[left])
+                continue
+        leaves[idx] = n_leaves
+        n_leaves += 1
+    return leaves
+
+
+def quadkey_sql(zoom: int) -> str:
+    """SQL key of the web mercator tile containing the centroid, as z_x_y."""
+    n = 2**zoom
+    x = f"least({n - 1}, greatest(0, floor((cx + 180) / 360 * {n})))::INTEGER"
+    y = (
+        f"least({n - 1}, greatest(0, floor((1 - ln(tan(radians(cy)) "
+        f"+ 1 / cos(radians(cy))) / pi()) / 2 * {n})))::INTEGER"
+    )
+    return f"concat('{zoom}_', {x}, '_', {y})"
+
+
+def partition_query(con, scheme: Scheme, base_path: Path, admin_path: Path) -> str:
+    """SELECT of the base rows with the partition key of `scheme`."""
+    base = f"read_parquet('{base_path}')"
+    if scheme.kind == "h3":
+        return f"""
+            SELECT * EXCLUDE (cx, cy),
+            h3_latlng_to_cell_string(cy, cx, {int(scheme.param)}) AS {PART_COLUMN}
+            FROM {base}
+        """
+    if scheme.kind == "quadkey":
+        return f"""
+            SELECT * EXCLUDE (cx, cy), {quadkey_sql(int(scheme.param))} AS {PART_COLUMN}
+            FROM {base}
+        """
+    if scheme.kind == "admin":
+        # Buildings whose centroid falls outside the generalised boundaries go to
+        # their own partition
+        return f"""
+            SELECT b.* EXCLUDE (cx, cy), coalesce(a.shapeID, 'none') AS {PART_COLUMN}
+            FROM {base} b
+            LEFT JOIN (SELECT shapeID, geom FROM st_read('{admin_path}')) a
+            ON ST_Contains(a.geom, ST_Point(b.cx, b.cy))
+        """
+    if scheme.kind == "kd":
+        points = con.execute(
+            f"SELECT file_row_number, cx, cy "
+            f"FROM read_parquet('{base_path}', file_row_number = true)"
+        ).fetchnumpy()
+        leaves = kd_split(points["cx"], points["cy"], int(scheme.param))
+        leaves_path = base_path.with_name(f"kd_{scheme.param}.parquet")
+        pq.write_table(
+            pa.table(
+                {
+                    "file_row_number": points["file_row_number"],
+                    PART_COLUMN: pa.array(leaves).cast(pa.string()),
+                }
+            ),
+            leaves_path,
+        )
+        return f"""
+            SELECT b.* EXCLUDE (cx, cy, file_row_number), l.{PART_COLUMN}
+            FROM read_parquet('{base_path}', file_row_number = true) b
+            JOIN read_parquet('{leaves_path}') l USING (file_row_number)
+        """
+    raise ValueError(f"Unknown partitioning scheme {scheme.kind}.")
+
+
+def write_partitions(
+    con, scheme: Scheme, base_path: Path, admin_path: Path, output_dir: Path
+) -> float:
+    """Write the partitions of `scheme` to `output_dir`, returning the time it took."""
+    shutil.rmtree(output_dir, ignore_errors=True)
+    start = time.perf_counter()
+    con.execute(f"""
+        COPY ({partition_query(con, scheme, base_path, admin_path)})
+        TO '{output_dir}'
+        (FORMAT parquet, PARTITION_BY ({PART_COLUMN}), COMPRESSION zstd,
+        ROW_GROUP_SIZE {ROW_GROUP_SIZE});
+        """)
+    return time.perf_counter() - start
+
+
+def _file_extents(path: Path) -> List[BBox]:
+    """
+    Extents of the row groups of a file, from the statistics of its bbox covering
+    column, or else the extent of its geometries.
+    """
+    metadata = pq.read_metadata(path)
+    row_groups = row_group_bboxes(metadata)
+    if row_groups is not None:
+        return [(rg.xmin, rg.ymin, rg.xmax, rg.ymax) for rg in row_groups]
+    logging.warning(f"{path} has no bbox column, reading its geometries.")
+    if metadata.num_rows == 0:
+        return []
+    geometry = geometry_column(metadata)
+    geometries = pq.read_table(path, columns=[geometry]).column(geometry)
+    bounds = shapely.total_bounds(shapely.from_wkb(geometries.combine_chunks()))
+    return [tuple(float(v) for v in bounds)]
+
+
+def partition_catalog(output_dir: Path) -> Dict[str, Tuple[BBox, List[Path]]]:
+    """Extent and files of every partition, from the bbox statistics of the footers."""
+    catalog = {}
+    for part_dir in sorted(output_dir.glob(f"{PART_COLUMN}=*")):
+        files = sorted(part_dir.glob("*.parquet"))
+        extents = [extent for path in files for extent in _file_extents(path)]
+        if not extents:
+            logging.warning(f"Skipping the empty partition {part_dir.name}.")
+            continue
+        extent = (
+            min(e[0] for e in extents),
+            min(e[1] for e in extents),
+            max(e[2] for e in extents),
+            max(e[3] for e in extents),
+        )
+        catalog[part_dir.name.split("=", 1)[1]] = (extent, files)
+    return catalog
+
+
+def _intersects(a: BBox, b: BBox) -> bool:
+    return not (a[2] < b[0] or a[0] > b[2] or a[3] < b[1] or a[1] > b[3])
+
+
+def run_queries(
+    catalog: Dict[str, Tuple[BBox, List[Path]]],
+    scenarios: Dict[int, List[BBox]],
+) -> List[QueryStats]:
+    results = []
+    for bbox_size, boxes in scenarios.items():
+        latencies, stats = [], []
+        for bbox in boxes:
+            start = time.perf_counter()
+            scan = ScanStats()
+            scan.partitions = [
+                key for key, (extent, _) in catalog.items() if _intersects(extent, bbox)
+            ]
+            paths = [path for key in scan.partitions for path in catalog[key][1]]
+            for _ in scan_parquet_files(
+                paths, bbox=bbox, columns=["height"], stats=scan
+            ):
+                pass
+            latencies.append((time.perf_counter() - start) * 1000)
+            stats.append(scan)
+        results.append(
+            QueryStats(
+                bbox_size=bbox_size,
+                median_ms=statistics.median(latencies),
+                p95_ms=_percentile(latencies, 95),
+                partitions=statistics.fmean(len(s.partitions) for s in stats),
+                files=statistics.fmean(s.files for s in stats),
+                bytes_read=statistics.fmean(s.bytes_read for s in stats),
+                rows_matched=statistics.fmean(s.rows_matched for s in stats),
+            )
+        )
+    return results
+
+
+def benchmark_scheme(
+    con,
+    scheme: Scheme,
+    base_path: Path,
+    admin_dir: Path,
+    country_code: str,
+    scenarios: Dict[int, List[BBox]],
+) -> SchemeResult:
+    output_dir = base_path.parent / scheme.name
+    admin_path = admin_dir / f"{country_code}-{scheme.param}.geojson"
+    build_s = write_partitions(con, scheme, base_path, admin_path, output_dir)
+    catalog = partition_catalog(output_dir)
+
+    part_bytes, part_rows = [], []
+    for _, files in catalog.values():
+        part_bytes.append(sum(path.stat().st_size for path in files))
+        part_rows.append(sum(pq.read_metadata(path).num_rows for path in files))
+    return SchemeResult(
+        scheme=scheme.name,
+        build_s=build_s,
+        partitions=len(catalog),
+        files=sum(len(files) for _, files in catalog.values()),
+        total_bytes=sum(part_bytes),
+        partition_bytes=size_stats(part_bytes),
+        partition_rows=size_stats(part_rows),
+        queries=run_queries(catalog, scenarios),
+    )
+
+
+def make_schemes(
+    h3_resolutions: List[int],
+    admin_levels: List[str],
+    quadkey_zooms: List[int],
+    kd_rows: List[int],
+) -> List[Scheme]:
+    return [
+        *(Scheme(f"h3_res{r}", "h3", str(r)) for r in h3_resolutions),
+        *(Scheme(level.lower(), "admin", level) for level in admin_levels),
+        *(Scheme(f"quadkey_z{z}", "quadkey", str(z)) for z in quadkey_zooms),
+        *(Scheme(f"kd_{n}", "kd", str(n)) for n in kd_rows),
+    ]
+
+
+def scenarios_4326(
+    con, base_path: Path, source_crs: str, seed: int
+) -> Dict[int, List[BBox]]:
+    """
+    The bbox scenarios of gpkg_vs_parquet.py, drawn in the metric CRS of the source and
+    reprojected to EPSG:4326.
+    """
+    to_source = Transformer.from_crs("EPSG:4326", source_crs, always_xy=True)
+    to_4326 = Transformer.from_crs(source_crs, "EPSG:4326", always_xy=True)
+    bounds = con.execute(f"""
+        SELECT min(bbox.xmin), min(bbox.ymin), max(bbox.xmax), max(bbox.ymax)
+        FROM read_parquet('{base_path}')
+        """).fetchone()
+    scenarios = make_bbox_scenarios(to_source.transform_bounds(*bounds), seed=seed)
+    return {
+        size: [to_4326.transform_bounds(*bbox) for bbox in boxes]
+        for size, boxes in scenarios.items()
+    }
+
+
+def print_results(results: List[SchemeResult]):
+    print(
+        f"{'scheme':<14}{'files':>7}{'MB':>9}{'part MB p50':>13}{'p95':>9}"
+        f"{'max':>9}{'cv':>7}{'build s':>9}"
+    )
+    for r in results:
+        mb = r.partition_bytes
+        print(
+            f"{r.scheme:<14}{r.files:>7}{r.total_bytes / 1e6:>9.1f}"
+            f"{mb.median / 1e6:>13.2f}{mb.p95 / 1e6:>9.2f}{mb.max / 1e6:>9.2f}"
+            f"{mb.cv:>7.2f}{r.build_s:>9.1f}"
+        )
+    print()
+    print(
+        f"{'scheme':<14}{'bbox m':>8}{'p50 ms':>9}{'p95 ms':>9}{'parts':>7}"
+        f"{'MB read':>9}{'rows':>10}"
+    )
+    for r in results:
+        for q in r.queries:
+            print(
+                f"{r.scheme:<14}{q.bbox_size:>8}{q.median_ms:>9.1f}{q.p95_ms:>9.1f}"
+                f"{q.partitions:>7.1f}{q.bytes_read / 1e6:>9.2f}{q.rows_matched:>10.0f}"
+            )
+
+
+@app.command()
+def main(
+    data_dir: Annotated[
+        Path,
+        typer.Option(
+            "-d", "--data_dir", help="Main directory of the data.", exists=True
+        ),
+    ],
+    country_code: Annotated[
+        str, typer.Option("-c", "--country_code", help="Country to partition.")
+    ],
+    h3_resolutions: Annotated[
+        List[int], typer.Option("--h3", help="H3 resolutions to compare.")
+    ] = [4, 5, 6, 7],
+    admin_levels: Annotated[
+        List[str], typer.Option("--admin", help="geoBoundaries levels to compare.")
+    ] = ["ADM1", "ADM2"],
+    quadkey_zooms: Annotated[
+        List[int], typer.Option("--quadkey", help="Quadkey zooms to compare.")
+    ] = [6, 8, 10],
+    kd_rows: Annotated[
+        List[int],
+        typer.Option("--kd_rows", help="Max rows per partition of the KD-split."),
+    ] = [250_000, 1_000_000],
+    seed: Annotated[
+        int, typer.Option("--seed", help="Seed of the bbox scenarios.")
+    ] = 0,
+    memory_limit: Annotated[
+        float, typer.Option("--memory_limit", help="Memory in GB DuckDB can use.")
+    ] = 4,
+    output: Annotated[
+        Path | None, typer.Option("-o", "--output", help="JSON file of the results.")
+    ] = None,
+):
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    gpkg_path = data_dir / "buildings" / "gpkg" / f"{country_code}.gpkg.zip"
+    work_dir = data_dir / "benchmark" / "partition_strategies" / country_code
+    work_dir.mkdir(parents=True, exist_ok=True)
+    base_path = work_dir / "base.parquet"
+
+    con = init_db_con(read_only=False)
+    try:
+        load_h3(con)
+        con.execute(f"SET memory_limit = '{memory_limit}GB';")
+        con.execute(f"SET temp_directory = '{work_dir / 'spill'}';")
+        source_crs = prepare_base(con, gpkg_path, base_path)
+        scenarios = scenarios_4326(con, base_path, source_crs, seed)
+        logging.info(f"Generated {len(BBOX_SIZES) * ITERATIONS} test scenarios.")
+
+        results = []
+        for scheme in make_schemes(
+            h3_resolutions, admin_levels, quadkey_zooms, kd_rows
+        ):
+            logging.info(f"Partitioning with {scheme.name}...")
+            results.append(
+                benchmark_scheme(
+                    con,
+                    scheme,
+                    base_path,
+                    data_dir / "admin_boundaries",
+                    country_code,
+                    scenarios,
+                )
+            )
+    finally:
+        con.close()
+        shutil.rmtree(work_dir / "spill", ignore_errors=True)
+
+    print_results(results)
+    if output is not None:
+        output.write_text(json.dumps([asdict(r) for r in results], indent=2))
+
+
+if __name__ == "__main__":
+    app()
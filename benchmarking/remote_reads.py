@@ -0,0 +1,753 @@
+"""
+Compare what querying the buildings costs when the files are hosted on object storage,
+where the number of requests and the bytes transferred matter more than the local CPU
+time: GeoParquet files, FlatGeoBuf files and PMTiles archives.
+
+The files are served by a local HTTP server that answers range requests like S3 does,
+with an injectable latency before every response and a bandwidth limit on every
+response body, and that counts the requests and the bytes it sends. The attribute
+queries (min/max and average height) and the bbox queries of gpkg_vs_parquet.py are
+run over it by the clients a user would have:
+  - GeoParquet with pyarrow, which reads the footer and then only the column chunks of
+    the row groups that the statistics of the bbox covering column select,
+  - FlatGeoBuf with GDAL's /vsicurl/, which reads the packed R-tree for the bboxes,
+  - PMTiles with its directories, fetching every tile of the max zoom (or of
+    `--pmtiles_zoom`) that covers the bbox. Its result is the number of features in
+    these tiles, which also counts the features of the parts of the tiles outside the
+    bbox. The archives have no attribute query.
+
+Every run opens the file anew, like a one-off query of a user, so its requests include
+those for the metadata. Each query is timed `--iterations` times for every network
+profile, with the requests and bytes averaged over the runs.
+
+Usage:
+    python remote_reads.py -d <data_dir> -c CYP --network 0:0 --network 50:100
+    python remote_reads.py -f hilbert=CYP.parquet -f CYP.pmtiles -o remote.json
+"""
+
+import io
+import itertools
+import logging
+import math
+import re
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from enum import Enum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Annotated, Callable, Dict, Iterator, List, Tuple
+from urllib.parse import quote, unquote, urlsplit
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyogrio
+import requests
+import shapely
+import typer
+
+from gpkg_vs_parquet import (
+    SCENARIO_CRS,
+    file_crs,
+    reproject_bbox,
+    reproject_scenarios,
+)
+from harness import (
+    Measurement,
+    parse_labeled_path,
+    report_regressions,
+    run_context,
+    summarize,
+    time_runs,
+    write_csv,
+    write_json,
+)
+from scenarios import BBOX_SIZES, ITERATIONS, BBox, make_bbox_scenarios
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / "data_conversions"))
+
+from parquet_index import geometry_column, row_group_bboxes  # noqa: E402
+from partition_query import scan_parquet_files  # noqa: E402
+from pmtiles_archive import PMTilesReader, iter_fields, zxy_to_tileid  # noqa: E402
+
+app = typer.Typer()
+
+# Files of a country in the data directory, by label
+COUNTRY_FILES = {
+    "parquet": "buildings/parquet/{code}.parquet",
+    "admin parquet": "buildings/admin/{code}.parquet",
+    "flatgeobuf": "buildings/flatgeobuf/{code}.fgb",
+    "pmtiles": "pmtiles/country/{code}.pmtiles",
+}
+# Group of the files given on the command line
+FILES_GROUP = "files"
+
+# Size of the writes of a response body, between which the bandwidth is enforced
+CHUNK_SIZE = 64 * 1024
+# Latitude beyond which the web mercator tiles stop
+MAX_LATITUDE = 85.0511287798
+
+
+class Layout(Enum):
+    GeoParquet = "parquet"
+    FlatGeobuf = "fgb"
+    PMTiles = "pmtiles"
+
+
+class Query(Enum):
+    HeightMinMax = "height_minmax"
+    HeightAvg = "height_avg"
+    BBox = "bbox"
+
+
+@dataclass
+class NetworkProfile:
+    latency_ms: float = 0.0
+    # Bandwidth of every response in Mbit/s, 0 for no limit
+    bandwidth_mbps: float = 0.0
+
+    @classmethod
+    def parse(cls, value: str) -> "NetworkProfile":
+        latency, _, bandwidth = value.partition(":")
+        try:
+            return cls(float(latency), float(bandwidth or 0))
+        except ValueError:
+            raise typer.BadParameter(
+                f"Network profiles are LATENCY_MS:MBIT_S, got {value!r}."
+            )
+
+    @property
+    def label(self) -> str:
+        bandwidth = f"{self.bandwidth_mbps:g}Mbps" if self.bandwidth_mbps else "inf"
+        return f"{self.latency_ms:g}ms-{bandwidth}"
+
+    @property
+    def bytes_per_second(self) -> float | None:
+        return self.bandwidth_mbps * 1e6 / 8 if self.bandwidth_mbps else None
+
+
+@dataclass
+class RangeStats:
+    requests: int = 0
+    bytes: int = 0
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are separate writes, which would wait for a delayed ACK
+    disable_nagle_algorithm = True
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _file(self) -> Path | None:
+        return self.server.range_server.files.get(unquote(urlsplit(self.path).path))
+
+    def _range(self, size: int) -> Tuple[int, int] | None:
+        """First and last byte of the Range header, None for the whole file."""
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match is None or match.groups() == ("", ""):
+            return None
+        start, end = match.groups()
+        if start == "":
+            return max(0, size - int(end)), size - 1
+        return int(start), min(int(end), size - 1) if end else size - 1
+
+    def _send(self, head_only: bool):
+        range_server = self.server.range_server
+        range_server.count_request()
+        profile = range_server.profile
+        if profile.latency_ms:
+            time.sleep(profile.latency_ms / 1000)
+
+        path = self._file()
+        if path is None:
+            self.send_error(404)
+            return
+        size = path.stat().st_size
+        byte_range = self._range(size)
+        if byte_range is None:
+            start, end = 0, size - 1
+            self.send_response(200)
+        else:
+            start, end = byte_range
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if head_only:
+            return
+
+        rate = profile.bytes_per_second
+        began = time.perf_counter()
+        sent = 0
+        with open(path, "rb") as file:
+            file.seek(start)
+            while sent < end - start + 1:
+                chunk = file.read(min(CHUNK_SIZE, end - start + 1 - sent))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                range_server.count_bytes(len(chunk))
+                if rate is not None:
+                    ahead = sent / rate - (time.perf_counter() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def do_HEAD(self):
+        self._send(head_only=True)
+
+    def do_GET(self):
+        self._send(head_only=False)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    range_server: "RangeServer"
+
+
+class RangeServer:
+    """
+    HTTP server of some local files that answers single range requests like S3, with
+    the latency and the bandwidth of `profile`, and counts the requests and the bytes
+    of the response bodies.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.files: Dict[str, Path] = {}
+        self.profile = NetworkProfile()
+        self._stats = RangeStats()
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _RangeHandler)
+        self._server.range_server = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "RangeServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add(self, path: Path) -> str:
+        """Serve `path` and return its URL."""
+        url_path = f"/{len(self.files)}/{quote(path.name)}"
+        self.files[unquote(url_path)] = path
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{url_path}"
+
+    def count_request(self):
+        with self._lock:
+            self._stats.requests += 1
+
+    def count_bytes(self, sent: int):
+        with self._lock:
+            self._stats.bytes += sent
+
+    def reset(self) -> RangeStats:
+        """Return the counts since the last reset and start counting again."""
+        with self._lock:
+            stats, self._stats = self._stats, RangeStats()
+        return stats
+
+
+# Clients
+class HttpRangeFile(io.RawIOBase):
+    """Seekable file whose reads are HTTP range requests, for pyarrow."""
+
+    def __init__(self, session: requests.Session, url: str):
+        self.read_range = http_range(session, url)
+        response = session.head(url)
+        response.raise_for_status()
+        self.size = int(response.headers["Content-Length"])
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        data = self.read_range(self.position, length)
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def http_range(session: requests.Session, url: str) -> Callable[[int, int], bytes]:
+    def read(offset: int, length: int) -> bytes:
+        response = session.get(
+            url, headers={"Range": f"bytes={offset}-{offset + length - 1}"}
+        )
+        response.raise_for_status()
+        return response.content
+
+    return read
+
+
+class CachedPMTilesReader(PMTilesReader):
+    """Reader that keeps the directories it fetched, like the PMTiles clients do."""
+
+    def __init__(self, source: Callable[[int, int], bytes]):
+        self._directories = {}
+        super().__init__(source)
+
+    def _directory(self, offset: int, length: int):
+        if (offset, length) not in self._directories:
+            self._directories[offset, length] = super()._directory(offset, length)
+        return self._directories[offset, length]
+
+
+def tiles_covering(box: BBox, zoom: int) -> Iterator[Tuple[int, int]]:
+    """(x, y) of the web mercator tiles at `zoom` covering a lon/lat bbox."""
+    n = 2**zoom
+
+    def tile(lon: float, lat: float) -> Tuple[int, int]:
+        lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+        x = (lon + 180) / 360 * n
+        y = (1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n
+        return min(n - 1, max(0, int(x))), min(n - 1, max(0, int(y)))
+
+    xmin, ymin, xmax, ymax = box
+    min_x, min_y = tile(xmin, ymax)
+    max_x, max_y = tile(xmax, ymin)
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            yield x, y
+
+
+def count_features(tile: bytes) -> int:
+    """Number of features of all the layers of a decompressed vector tile."""
+    return sum(
+        1
+        for number, _, layer, _ in iter_fields(tile)
+        if number == 3
+        for layer_number, *_ in iter_fields(layer)
+        if layer_number == 2
+    )
+
+
+def _height_result(query: Query, heights: pa.ChunkedArray) -> float | None:
+    # The first value, like the queries of gpkg_vs_parquet.py
+    value = (
+        pc.min_max(heights)["min"] if query is Query.HeightMinMax else pc.mean(heights)
+    )
+    return value.as_py()
+
+
+def query_parquet(
+    session: requests.Session, url: str, query: Query, box: BBox | None, run: int
+) -> float | None:
+    file = HttpRangeFile(session, url)
+    if query is Query.BBox:
+        # No output column: the scan reads the geometry column the file declares
+        batches = scan_parquet_files([file], polygon=shapely.box(*box), columns=[])
+        return sum(batch.num_rows for batch in batches)
+    batches = scan_parquet_files([file], columns=["height"])
+    return _height_result(
+        query,
+        pa.chunked_array([b.column("height") for b in batches], type=pa.float64()),
+    )
+
+
+def query_flatgeobuf(
+    session: requests.Session, url: str, query: Query, box: BBox | None, run: int
+) -> float | None:
+    # GDAL caches what it read of a URL, the query string makes every run cold
+    path = f"/vsicurl/{url}?run={run}"
+    if query is Query.BBox:
+        _, table = pyogrio.read_arrow(path, bbox=box, columns=[])
+        return table.num_rows
+    _, table = pyogrio.read_arrow(path, columns=["height"], read_geometry=False)
+    return _height_result(query, table.column("height").cast(pa.float64()))
+
+
+def query_pmtiles(
+    session: requests.Session,
+    url: str,
+    query: Query,
+    box: BBox | None,
+    run: int,
+    zoom: int | None = None,
+) -> float | None:
+    reader = CachedPMTilesReader(http_range(session, url))
+    zoom = reader.header.max_zoom if zoom is None else zoom
+    # In tile ID order, like the tiles of a clustered archive
+    tiles = sorted(tiles_covering(box, zoom), key=lambda t: zxy_to_tileid(zoom, *t))
+    count = 0
+    for x, y in tiles:
+        tile = reader.get_tile(zoom, x, y)
+        if tile is not None:
+            count += count_features(tile)
+    return count
+
+
+@dataclass
+class RemoteMeasurement(Measurement):
+    # Means per run, without the warmup runs
+    requests: float = 0.0
+    bytes_fetched: float = 0.0
+
+
+@dataclass
+class RemoteSource:
+    country: str
+    label: str
+    path: Path
+    url: str = ""
+    crs: str | None = None
+
+    @property
+    def layout(self) -> Layout:
+        if self.path.suffix == ".parquet":
+            return Layout.GeoParquet
+        if self.path.suffix == ".fgb":
+            return Layout.FlatGeobuf
+        if self.path.suffix == ".pmtiles":
+            return Layout.PMTiles
+        raise typer.BadParameter(f"No remote client for {self.path}.")
+
+
+def find_sources(
+    data_dir: Path | None, country_codes: List[str], files: List[str]
+) -> Dict[str, List[RemoteSource]]:
+    """
+    Sources to compare by group: the files of each country in the data directory, and
+    the files given as `PATH` or `LABEL=PATH`.
+    """
+    groups: Dict[str, List[RemoteSource]] = {}
+    for code in country_codes:
+        sources = [
+            RemoteSource(code, label, data_dir / pattern.format(code=code))
+            for label, pattern in COUNTRY_FILES.items()
+        ]
+        sources = [s for s in sources if s.path.exists()]
+        if not sources:
+            logging.warning(f"No files found for {code} in {data_dir}.")
+            continue
+        groups[code] = sources
+    for file in files:
+        label, path = parse_labeled_path(file)
+        if not path.is_file():
+            raise typer.BadParameter(f"{path} is not a file.")
+        groups.setdefault(FILES_GROUP, []).append(
+            RemoteSource(FILES_GROUP, label, path)
+        )
+    for sources in groups.values():
+        for source in sources:
+            source.crs = (
+                "EPSG:4326"
+                if source.layout is Layout.PMTiles
+                else file_crs(source.path)
+            )
+    return groups
+
+
+def source_bounds(source: RemoteSource) -> BBox:
+    """Extent of a local file, from the metadata only."""
+    if source.layout is Layout.GeoParquet:
+        metadata = pq.ParquetFile(source.path).metadata
+        bboxes = row_group_bboxes(metadata)
+        if bboxes is None:
+            geometry = geometry_column(metadata)
+            table = pq.read_table(source.path, columns=[geometry])
+            return tuple(
+                shapely.total_bounds(
+                    shapely.from_wkb(table.column(geometry).combine_chunks())
+                )
+            )
+        return (
+            min(b.xmin for b in bboxes),
+            min(b.ymin for b in bboxes),
+            max(b.xmax for b in bboxes),
+            max(b.ymax for b in bboxes),
+        )
+    if source.layout is Layout.FlatGeobuf:
+        return tuple(pyogrio.read_info(source.path)["total_bounds"])
+    header = PMTilesReader.open(source.path).header
+    return (
+        header.min_lon_e7 / 1e7,
+        header.min_lat_e7 / 1e7,
+        header.max_lon_e7 / 1e7,
+        header.max_lat_e7 / 1e7,
+    )
+
+
+def benchmark_source(
+    server: RangeServer,
+    source: RemoteSource,
+    queries: List[Query],
+    scenarios: Dict[int, List[BBox]],
+    profiles: List[NetworkProfile],
+    warmup: int,
+    iterations: int,
+    pmtiles_zoom: int | None,
+) -> List[RemoteMeasurement]:
+    layout = source.layout
+    if layout is Layout.GeoParquet:
+        client = query_parquet
+    elif layout is Layout.FlatGeobuf:
+        client = query_flatgeobuf
+    else:
+
+        def client(*args):
+            return query_pmtiles(*args, zoom=pmtiles_zoom)
+
+    runs: List[Tuple[str, Query, List[BBox | None]]] = []
+    for query in queries:
+        if query is Query.BBox:
+            for size, boxes in scenarios.items():
+                runs.append((f"bbox_{size}", query, boxes))
+        elif layout is Layout.PMTiles:
+            logging.info(f"{source.label} has no attribute query, skipping {query}.")
+        else:
+            runs.append((query.value, query, [None]))
+
+    measurements = []
+    run_ids = itertools.count()
+    for name, query, boxes in runs:
+        for profile in profiles:
+            server.profile = profile
+            per_run: List[RangeStats] = []
+            session = requests.Session()
+
+            def run(i: int):
+                server.reset()
+                result = client(
+                    session, source.url, query, boxes[i % len(boxes)], next(run_ids)
+                )
+                per_run.append(server.reset())
+                return result
+
+            try:
+                times, result = time_runs(run, iterations, warmup=warmup)
+            except Exception as exc:
+                logging.error(f"{source.label} {name} ({profile.label}) → {exc}")
+                continue
+            finally:
+                session.close()
+            per_run = per_run[warmup:]
+            measurement = summarize(
+                times,
+                result,
+                country=source.country,
+                file=source.label,
+                query=name,
+                # The network profile takes the place of the cache mode in the key
+                cache=profile.label,
+            )
+            measurements.append(
+                RemoteMeasurement(
+                    **asdict(measurement),
+                    requests=sum(s.requests for s in per_run) / len(per_run),
+                    bytes_fetched=sum(s.bytes for s in per_run) / len(per_run),
+                )
+            )
+            logging.info(
+                f"{source.country} {source.label} {name} ({profile.label}): "
+                f"median {measurement.median_s:.4f} s, "
+                f"{measurements[-1].requests:.1f} requests"
+            )
+    return measurements
+
+
+def format_measurements(measurements: List[RemoteMeasurement]) -> str:
+    lines = [
+        f"{'country':<8}{'file':<24}{'query':<16}{'network':<16}{'n':>4}"
+        f"{'median s':>11}{'p95 s':>10}{'requests':>10}{'MB':>10}{'result':>12}"
+    ]
+    for m in measurements:
+        result = f"{m.result:>12.0f}" if m.result is not None else f"{'':>12}"
+        lines.append(
+            f"{m.country:<8}{m.file:<24}{m.query:<16}{m.cache:<16}{m.iterations:>4}"
+            f"{m.median_s:>11.4f}{m.p95_s:>10.4f}{m.requests:>10.1f}"
+            f"{m.bytes_fetched / 1024**2:>10.3f}{result}"
+        )
+    return "\n".join(lines)
+
+
+@app.command()
+def main(
+    data_dir: Annotated[
+        Path | None,
+        typer.Option(
+            "-d", "--data_dir", help="Main directory of the data.", exists=True
+        ),
+    ] = None,
+    country_codes: Annotated[
+        List[str],
+        typer.Option("-c", "--country_code", help="Countries whose files to compare."),
+    ] = [],
+    files: Annotated[
+        List[str],
+        typer.Option(
+            "-f", "--file", help="Other file to compare, as PATH or LABEL=PATH."
+        ),
+    ] = [],
+    queries: Annotated[
+        List[Query],
+        typer.Option("-q", "--query", help="Queries to run (default: all)."),
+    ] = list(Query),
+    bbox_sizes: Annotated[
+        List[int],
+        typer.Option("--bbox_size", help="Sizes in metres of the bbox queries."),
+    ] = BBOX_SIZES,
+    networks: Annotated[
+        List[str],
+        typer.Option(
+            "--network",
+            help="Network profile as LATENCY_MS:MBIT_S, 0 Mbit/s for no limit.",
+        ),
+    ] = ["20:100"],
+    pmtiles_zoom: Annotated[
+        int | None,
+        typer.Option(
+            "--pmtiles_zoom", help="Zoom of the PMTiles bbox queries (default: max)."
+        ),
+    ] = None,
+    warmup: Annotated[
+        int, typer.Option("--warmup", help="Untimed runs before the timed ones.")
+    ] = 1,
+    iterations: Annotated[
+        int, typer.Option("--iterations", help="Timed runs of every query.")
+    ] = ITERATIONS,
+    seed: Annotated[
+        int, typer.Option("--seed", help="Seed of the bbox scenarios.")
+    ] = 0,
+    output: Annotated[
+        Path | None, typer.Option("-o", "--output", help="JSON file of the results.")
+    ] = None,
+    csv_output: Annotated[
+        Path | None, typer.Option("--csv", help="CSV file of the results.")
+    ] = None,
+    baseline: Annotated[
+        Path | None,
+        typer.Option(
+            "--baseline", help="JSON of a previous run to compare to.", exists=True
+        ),
+    ] = None,
+    threshold: Annotated[
+        float,
+        typer.Option(
+            "--threshold", help="Slowdown of the median flagged as a regression."
+        ),
+    ] = 0.1,
+    min_delta: Annotated[
+        float,
+        typer.Option(
+            "--min_delta", help="Slowdown in seconds below which nothing is flagged."
+        ),
+    ] = 0.005,
+    fail_on_regression: Annotated[
+        bool,
+        typer.Option("--fail_on_regression", help="Exit with 1 on a regression."),
+    ] = False,
+):
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    if country_codes and data_dir is None:
+        raise typer.BadParameter("--data_dir is needed to find the countries.")
+    profiles = [NetworkProfile.parse(n) for n in networks]
+    groups = find_sources(data_dir, country_codes, files)
+    if not groups:
+        raise typer.BadParameter("Nothing to compare, give countries or files.")
+    # Opening a URL would otherwise list its "directory" first
+    pyogrio.set_gdal_config_options({"GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR"})
+
+    measurements: List[RemoteMeasurement] = []
+    with RangeServer() as server:
+        for group, sources in groups.items():
+            for source in sources:
+                source.url = server.add(source.path)
+            # The same boxes for every file, drawn in metres around the first one that
+            # is not tiled, since the extent of the archives is rounded
+            reference = next(
+                (s for s in sources if s.layout is not Layout.PMTiles), sources[0]
+            )
+            scenario_crs = SCENARIO_CRS if reference.crs is not None else None
+            scenarios = {}
+            if Query.BBox in queries:
+                bounds = reproject_bbox(
+                    source_bounds(reference), reference.crs, scenario_crs
+                )
+                scenarios = make_bbox_scenarios(bounds, bbox_sizes, iterations, seed)
+            for source in sources:
+                measurements += benchmark_source(
+                    server,
+                    source,
+                    queries,
+                    reproject_scenarios(scenarios, scenario_crs, source.crs),
+                    profiles,
+                    warmup,
+                    iterations,
+                    pmtiles_zoom,
+                )
+
+    print(format_measurements(measurements))
+
+    files_info = [
+        {
+            "country": s.country,
+            "file": s.label,
+            "path": str(s.path),
+            "bytes": s.path.stat().st_size,
+            "crs": s.crs,
+        }
+        for sources in groups.values()
+        for s in sources
+    ]
+    context = run_context(
+        pyarrow=pa.__version__,
+        gdal=pyogrio.__gdal_version_string__,
+        queries=[q.value for q in queries],
+        bbox_sizes=bbox_sizes,
+        networks=[asdict(p) for p in profiles],
+        pmtiles_zoom=pmtiles_zoom,
+        warmup=warmup,
+        iterations=iterations,
+        seed=seed,
+    )
+    if output is not None:
+        write_json(output, measurements, context, files=files_info)
+    if csv_output is not None:
+        write_csv(csv_output, measurements)
+
+    if baseline is not None:
+        regressed = report_regressions(
+            measurements, baseline, threshold, min_delta, RemoteMeasurement
+        )
+        if regressed and fail_on_regression:
+            raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,35 @@
+import random
+from typing import Dict, List, Tuple
+
+# minx, miny, maxx, maxy
+BBox = Tuple[float, float, float, float]
+
+BBOX_SIZES = [500, 5000, 20000]  # 500m, 5km, 20km
+ITERATIONS = 10
+
+
+def make_bbox_scenarios(
+    bounds: BBox,
+    bbox_sizes: List[int] = BBOX_SIZES,
+    iterations: int = ITERATIONS,
+    seed: int | None = None,
+) -> Dict[int, List[BBox]]:
+    """
+    Make the same random square bboxes for every file type, `iterations` of each size,
+    all within `bounds` (in the units of the CRS of the data, metres for EUBUCCO).
+    """
+    rng = random.Random(seed)
+    global_minx, global_miny, global_maxx, global_maxy = bounds
+
+    test_scenarios = {}
+    for size in bbox_sizes:
+        scenarios = []
+        for _ in range(iterations):
+            # ensure the box within bounds by subtracting 'size'
+            rand_x = rng.uniform(global_minx, global_maxx - size)
+            rand_y = rng.uniform(global_miny, global_maxy - size)
+
+            box = (rand_x, rand_y, rand_x + size, rand_y + size)
+            scenarios.append(box)
+        test_scenarios[size] = scenarios
+    return test_scenarios
@@ -0,0 +1,365 @@
+# External
+import concurrent.futures
+import logging
+import os
+import shutil
+from collections import deque
+from pathlib import Path
+from typing import Annotated, Dict, List, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+import typer
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+# Internal
+from gpkg_cache import GpkgCache, open_gpkg
+from job_pool import GB, Job, JobCost, ResourceBudget, default_workers, run_jobs
+from parquet_index import geo_metadata
+
+app = typer.Typer()
+
+JOIN_LEVELS = ["ADM1", "ADM2"]
+# Buildings on the coast can fall just outside the generalised boundaries, they are
+# given the nearest region within this distance (in the unit of their CRS, metres)
+DEFAULT_MAX_DISTANCE = 1000.0
+
+
+def region_columns(level: str) -> Tuple[str, str]:
+    return f"{level.lower()}_id", f"{level.lower()}_name"
+
+
+class AdminRegions:
+    """
+    Boundaries of one admin level in an STRtree, reprojected once to the CRS of the
+    buildings so that their points never have to be.
+    """
+
+    def __init__(self, geojson_path: Path, crs: str):
+        gdf = gpd.read_file(geojson_path, columns=["shapeID", "shapeName"]).to_crs(crs)
+        self.ids = gdf["shapeID"].to_numpy(dtype=object)
+        self.names = gdf["shapeName"].to_numpy(dtype=object)
+        self.tree = shapely.STRtree(gdf.geometry.to_numpy())
+
+    def locate(self, points: np.ndarray, max_distance: float) -> np.ndarray:
+        """Index of the region of each point, -1 for none within `max_distance`."""
+        regions = np.full(len(points), -1, dtype=np.int64)
+        point_idx, region_idx = self.tree.query(points, predicate="intersects")
+        # A point on a shared border is in both regions, keep the first one
+        _, first = np.unique(point_idx, return_index=True)
+        regions[point_idx[first]] = region_idx[first]
+
+        missing = np.flatnonzero((regions < 0) & ~shapely.is_missing(points))
+        if max_distance > 0 and len(missing) > 0:
+            point_idx, region_idx = self.tree.query_nearest(
+                points[missing], max_distance=max_distance, all_matches=False
+            )
+            regions[missing[point_idx]] = region_idx
+        return regions
+
+
+def join_batch(
+    batch: pa.RecordBatch,
+    geometry_column: str,
+    regions: Dict[str, AdminRegions],
+    max_distance: float,
+) -> pa.RecordBatch:
+    """Append the id and name of the region of every level to the buildings of `batch`."""
+    # Representative points are always inside their building, unlike centroids
+    points = shapely.point_on_surface(shapely.from_wkb(batch.column(geometry_column)))
+    for level, admin in regions.items():
+        idx = admin.locate(points, max_distance)
+        found = idx >= 0
+        id_column, name_column = region_columns(level)
+        batch = batch.append_column(
+            id_column, pa.array(np.where(found, admin.ids[idx], None), pa.string())
+        )
+        batch = batch.append_column(
+            name_column, pa.array(np.where(found, admin.names[idx], None), pa.string())
+        )
+    return batch
+
+
+def join_admin_regions(
+    input_path: Path,
+    output_path: Path,
+    admin_paths: Dict[str, Path],
+    batch_size: int = 65_536,
+    workers: int | None = None,
+    max_distance: float = DEFAULT_MAX_DISTANCE,
+    overwrite: bool = False,
+    cache: GpkgCache | None = None,
+) -> Tuple[Path, bool]:
+    """
+    Attach the region of each admin level of `admin_paths` to every building of
+    `input_path`, writing GeoParquet to `output_path`.
+
+    The buildings are streamed from GDAL in Arrow batches of `batch_size`, and the
+    batches are joined on `workers` threads, which run in parallel since shapely
+    releases the GIL, and written in order. With a cache, the extracted GeoPackage is
+    read instead of the zip.
+    Returns (output_path, success_flag).
+    """
+    if output_path.exists() and not overwrite:
+        logging.info(f"Skipping {output_path} which already exists.")
+        return output_path, True
+
+    workers = workers or default_workers()
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    try:
+        with (
+            open_gpkg(input_path, cache) as source_path,
+            pyogrio.open_arrow(
+                source_path, batch_size=batch_size, use_pyarrow=True
+            ) as (meta, reader),
+        ):
+            geometry_column = meta["geometry_name"] or "wkb_geometry"
+            regions = {
+                level: AdminRegions(path, meta["crs"])
+                for level, path in admin_paths.items()
+            }
+            schema = reader.schema
+            for level in admin_paths:
+                for column in region_columns(level):
+                    schema = schema.append(pa.field(column, pa.string()))
+            schema = schema.with_metadata(geo_metadata(geometry_column, meta["crs"]))
+
+            logging.info(f"Joining {input_path} to {', '.join(admin_paths)}...")
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with (
+                pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer,
+                concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool,
+            ):
+                # Bound the batches in flight so that memory does not grow with the
+                # size of the country
+                pending = deque()
+                for batch in reader:
+                    pending.append(
+                        pool.submit(
+                            join_batch, batch, geometry_column, regions, max_distance
+                        )
+                    )
+                    if len(pending) >= 2 * workers:
+                        writer.write_batch(pending.popleft().result())
+                while pending:
+                    writer.write_batch(pending.popleft().result())
+
+        os.replace(tmp_path, output_path)
+
+    except Exception as exc:
+        logging.error(f"Joining {input_path.name} → {exc}")
+        tmp_path.unlink(missing_ok=True)
+        return output_path, False
+
+    return output_path, True
+
+
+def partition_by_region(
+    input_path: Path, output_dir: Path, level: str
+) -> Tuple[Path, bool]:
+    """
+    Split a joined file into `output_dir/<level>_id=<id>/`, so that a region is read
+    without touching the others. Buildings without a region go to the
+    `__HIVE_DEFAULT_PARTITION__` directory.
+    """
+    id_column, _ = region_columns(level)
+    tmp_dir = output_dir.with_name(output_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    try:
+        dataset = ds.dataset(input_path, format="parquet")
+        ds.write_dataset(
+            dataset,
+            tmp_dir,
+            format="parquet",
+            schema=dataset.schema,
+            partitioning=[id_column],
+            partitioning_flavor="hive",
+            file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+        )
+        if output_dir.exists():
+            shutil.rmtree(output_dir)
+        os.replace(tmp_dir, output_dir)
+
+    except Exception as exc:
+        logging.error(f"Partitioning {input_path.name} by {level} → {exc}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return output_dir, False
+
+    return output_dir, True
+
+
+def join_admin_one_country(
+    gpkg_path: Path,
+    output_path: Path,
+    admin_paths: Dict[str, Path],
+    partition_dir: Path | None = None,
+    partition_level: str | None = None,
+    workers: int | None = None,
+    max_distance: float = DEFAULT_MAX_DISTANCE,
+    overwrite: bool = False,
+    cache: GpkgCache | None = None,
+) -> Tuple[Path, bool]:
+    output_path, ok = join_admin_regions(
+        gpkg_path,
+        output_path,
+        admin_paths,
+        workers=workers,
+        max_distance=max_distance,
+        overwrite=overwrite,
+        cache=cache,
+    )
+    if not ok or partition_dir is None:
+        return output_path, ok
+    if partition_dir.exists() and not overwrite:
+        logging.info(f"Skipping {partition_dir} which already exists.")
+        return partition_dir, True
+    return partition_by_region(output_path, partition_dir, partition_level)
+
+
+def join_admin_countries(
+    gpkg_paths: Dict[str, Path],
+    admin_dir: Path,
+    output_dir: Path,
+    levels: List[str] = JOIN_LEVELS,
+    partition_dir: Path | None = None,
+    partition_level: str | None = None,
+    max_workers: int | None = None,
+    max_distance: float = DEFAULT_MAX_DISTANCE,
+    overwrite: bool = False,
+    budget: ResourceBudget | None = None,
+    cache: GpkgCache | None = None,
+) -> List[Tuple[Path, bool]]:
+    """
+    Join the buildings of several countries to their admin regions in parallel, into
+    `output_dir/<code>.parquet`, and with `partition_dir` also split them by the
+    regions of `partition_level` into `partition_dir/country=<code>/`.
+    """
+    workers = max_workers or max(1, default_workers() // 4)
+    threads = max(1, default_workers() // workers)
+
+    jobs = []
+    for code, gpkg_path in gpkg_paths.items():
+        admin_paths = {level: admin_dir / f"{code}-{level}.geojson" for level in levels}
+        missing = [path for path in admin_paths.values() if not path.exists()]
+        if missing:
+            logging.error(f"Joining {code} → missing {', '.join(map(str, missing))}")
+            continue
+        size = gpkg_path.stat().st_size
+        jobs.append(
+            Job(
+                func=join_admin_one_country,
+                args=(
+                    gpkg_path,
+                    output_dir / f"{code}.parquet",
+                    admin_paths,
+                    partition_dir / f"country={code}" if partition_dir else None,
+                    partition_level,
+                    threads,
+                    max_distance,
+                    overwrite,
+                    cache,
+                ),
+                # Only a few batches are in memory, next to the boundaries, and the
+                # joined file is about as large as the unzipped GeoPackage
+                cost=JobCost(memory=1 * GB, disk=8 * size, size=size),
+            )
+        )
+    return run_jobs(jobs, budget=budget, max_workers=workers)
+
+
+@app.command("join_admin")
+def join_admin(
+    data_dir: Annotated[
+        Path,
+        typer.Option(
+            "-d", "--data_dir", help="Main directory of the data.", exists=True
+        ),
+    ],
+    country_codes: Annotated[
+        List[str] | None,
+        typer.Option(
+            "-c",
+            "--country_code",
+            help="Codes of the countries to process (default: all downloaded ones).",
+        ),
+    ] = None,
+    levels: Annotated[
+        List[str],
+        typer.Option("-l", "--level", help="Admin levels to attach to the buildings."),
+    ] = JOIN_LEVELS,
+    partition_level: Annotated[
+        str | None,
+        typer.Option(
+            "--partition_by", help="Admin level to also partition the output by."
+        ),
+    ] = None,
+    max_distance: Annotated[
+        float,
+        typer.Option(
+            "--max_distance",
+            help="Max distance in metres to the nearest region of buildings outside all.",
+        ),
+    ] = DEFAULT_MAX_DISTANCE,
+    jobs: Annotated[
+        int | None,
+        typer.Option("--jobs", help="Number of countries joined in parallel."),
+    ] = None,
+    overwrite: Annotated[
+        bool, typer.Option("--overwrite", help="Join again existing countries.")
+    ] = False,
+    gpkg_cache_size: Annotated[
+        float | None,
+        typer.Option(
+            "--gpkg_cache",
+            help="Size in GB of a cache of extracted GeoPackages (default: read the zips).",
+        ),
+    ] = None,
+):
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    if partition_level is not None and partition_level not in levels:
+        raise typer.BadParameter(f"{partition_level} is not one of the joined levels.")
+
+    gpkg_dir = data_dir / "buildings" / "gpkg"
+    gpkg_paths = {
+        path.name.removesuffix(".gpkg.zip"): path
+        for path in sorted(gpkg_dir.glob("*.gpkg.zip"))
+    }
+    if country_codes is not None:
+        gpkg_paths = {code: gpkg_paths[code] for code in country_codes}
+
+    gpkg_cache = None
+    if gpkg_cache_size is not None:
+        gpkg_cache = GpkgCache(data_dir / "cache" / "gpkg", int(gpkg_cache_size * GB))
+
+    partition_dir = None
+    if partition_level is not None:
+        partition_dir = data_dir / "partition" / partition_level.lower()
+
+    with logging_redirect_tqdm():
+        results = join_admin_countries(
+            gpkg_paths,
+            data_dir / "admin_boundaries",
+            data_dir / "buildings" / "admin",
+            levels=levels,
+            partition_dir=partition_dir,
+            partition_level=partition_level,
+            max_workers=jobs,
+            max_distance=max_distance,
+            overwrite=overwrite,
+            cache=gpkg_cache,
+        )
+    if gpkg_cache is not None:
+        typer.echo(gpkg_cache.stats().format())
+    if len(results) < len(gpkg_paths) or not all(ok for _, ok in results):
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,176 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List
+
+from pydantic import BaseModel, PrivateAttr
+
+
+class FileRecord(BaseModel):
+    path: Path
+    size: int
+    mtime_ns: int
+    sha256: str
+
+
+class ArtifactRecord(BaseModel):
+    output: FileRecord
+    inputs: List[FileRecord] = []
+    params: Dict[str, Any] = {}
+    tools: Dict[str, str] = {}
+
+
+def file_sha256(path: Path) -> str:
+    """Hash the content of a file."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+@functools.cache
+def tool_version(tool: str) -> str:
+    """Return the version string printed by `<tool> --version`."""
+    try:
+        result = subprocess.run(
+            [tool, "--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+    except FileNotFoundError:
+        return "missing"
+    lines = result.stdout.strip().splitlines()
+    return lines[0] if lines else "unknown"
+
+
+class BuildManifest(BaseModel):
+    """
+    Persisted record of how every artifact of the pipeline was built: hashes of the
+    inputs, command parameters and tool versions. An artifact is up to date only if
+    all of them are unchanged, so a rerun rebuilds the stale artifacts, and whatever is
+    downstream of them because the hash of their output changes.
+
+    File hashes are only recomputed when the size or modification time of the file
+    changed since it was last hashed. Outputs that exist without a record, because
+    they were built before the manifest, are adopted as built from their current
+    inputs, parameters and tools rather than rebuilt.
+    """
+
+    artifacts: Dict[str, ArtifactRecord] = {}
+    countries: Dict[str, Dict[str, Any]] = {}
+
+    _path: Path | None = PrivateAttr(default=None)
+    _lock: threading.RLock = PrivateAttr(default_factory=threading.RLock)
+    _hashes: Dict[str, FileRecord] = PrivateAttr(default_factory=dict)
+
+    @classmethod
+    def load(cls, path: Path) -> "BuildManifest":
+        if path.exists():
+            manifest = cls.model_validate_json(path.read_text())
+        else:
+            manifest = cls()
+        manifest._path = path
+        for artifact in manifest.artifacts.values():
+            for record in [artifact.output, *artifact.inputs]:
+                manifest._hashes[str(record.path)] = record
+        return manifest
+
+    def save(self):
+        if self._path is None:
+            raise RuntimeError("The manifest was not loaded from a path.")
+        with self._lock:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self._path.with_suffix(self._path.suffix + ".tmp")
+            tmp_path.write_text(self.model_dump_json(indent=2))
+            os.replace(tmp_path, self._path)
+
+    def file_record(self, path: Path) -> FileRecord:
+        stat = path.stat()
+        with self._lock:
+            cached = self._hashes.get(str(path))
+        if (
+            cached is not None
+            and cached.size == stat.st_size
+            and cached.mtime_ns == stat.st_mtime_ns
+        ):
+            return cached
+
+        record = FileRecord(
+            path=path,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            sha256=file_sha256(path),
+        )
+        with self._lock:
+            self._hashes[str(path)] = record
+        return record
+
+    def is_fresh(
+        self,
+        output: Path,
+        inputs: Iterable[Path] = (),
+        params: Dict[str, Any] | None = None,
+        tools: Iterable[str] = (),
+    ) -> bool:
+        """Check if `output` exists and was built from the same inputs, parameters and tools."""
+        if not output.exists():
+            return False
+        with self._lock:
+            artifact = self.artifacts.get(str(output))
+        if artifact is None:
+            inputs = list(inputs)
+            if not all(p.exists() for p in inputs):
+                return False
+            logging.info(f"Adopting {output}, which was built without a manifest.")
+            self.record(output, inputs, params, tools)
+            return True
+
+        if self.file_record(output).sha256 != artifact.output.sha256:
+            logging.info(f"{output} was modified since it was built.")
+            return False
+
+        current_inputs = [self.file_record(p).sha256 for p in inputs]
+        if current_inputs != [r.sha256 for r in artifact.inputs]:
+            logging.info(f"The inputs of {output} changed.")
+            return False
+
+        # Go through JSON to compare the parameters as they were stored
+        if json.loads(json.dumps(params or {}, default=str)) != artifact.params:
+            logging.info(f"The parameters of {output} changed.")
+            return False
+
+        if {tool: tool_version(tool) for tool in tools} != artifact.tools:
+            logging.info(f"The tools used to build {output} changed.")
+            return False
+
+        return True
+
+    def record(
+        self,
+        output: Path,
+        inputs: Iterable[Path] = (),
+        params: Dict[str, Any] | None = None,
+        tools: Iterable[str] = (),
+    ):
+        """Store how `output` was just built and save the manifest."""
+        artifact = ArtifactRecord(
+            output=self.file_record(output),
+            inputs=[self.file_record(p) for p in inputs],
+            params=json.loads(json.dumps(params or {}, default=str)),
+            tools={tool: tool_version(tool) for tool in tools},
+        )
+        with self._lock:
+            self.artifacts[str(output)] = artifact
+            if self._path is not None:
+                self.save()
+
+    def record_country(self, country_code: str, state: BaseModel):
+        """Store the state of a country after it went through the pipeline."""
+        with self._lock:
+            self.countries[country_code] = state.model_dump(mode="json")
+            if self._path is not None:
+                self.save()
@@ -0,0 +1,424 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from pathlib import Path
+from typing import Annotated, BinaryIO, Dict, Iterator, Tuple
+
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+import typer
+from aiohttp import web
+
+from parquet_index import BBOX_COLUMN
+from partition_query import AttributeFilter, PartitionedDataset
+
+app = typer.Typer()
+
+CHUNK_SIZE = 1024**2
+FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", ".parquet", None),
+    "fgb": ("application/octet-stream", ".fgb", "FlatGeoBuf"),
+    "gpkg": ("application/geopackage+sqlite3", ".gpkg", "GPKG"),
+}
+
+
+class ExtractCache:
+    """
+    Directory of finished extracts, evicted least recently used first once they take
+    more than `max_bytes`. Extracts are written to a temporary file and only added
+    once complete, so a failed or cancelled request never leaves a truncated entry.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: collections.OrderedDict[str, int] = collections.OrderedDict()
+
+        directory.mkdir(parents=True, exist_ok=True)
+        for path in directory.glob("tmp-*"):
+            path.unlink()
+        for path in sorted(directory.iterdir(), key=lambda p: p.stat().st_atime):
+            self._entries[path.name] = path.stat().st_size
+        self._evict()
+
+    def open(self, name: str) -> BinaryIO | None:
+        """
+        Open a cached extract. It is opened while holding the lock, so that evicting
+        it for another request cannot remove it before it is read.
+        """
+        with self._lock:
+            if name not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+            return open(self.directory / name, "rb")
+
+    def temp_path(self, name: str) -> Path:
+        # Keep the extension, which GDAL uses to decide how to write the file
+        return self.directory / f"tmp-{uuid.uuid4().hex}-{name}"
+
+    def commit(self, name: str, tmp_path: Path):
+        path = self.directory / name
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._entries[name] = path.stat().st_size
+            self._entries.move_to_end(name)
+            self._evict()
+
+    def _evict(self):
+        total = sum(self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            (self.directory / name).unlink(missing_ok=True)
+            total -= size
+            logging.debug(f"Evicted {name} from the extract cache.")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class _ChunkSink:
+    """
+    File-like object written by the Parquet writer in a worker thread, which forwards
+    every chunk to the response queue (waiting when the client is slow) and tees it
+    into the cache file.
+    """
+
+    def __init__(
+        self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop, tee_path: Path
+    ):
+        self.queue = queue
+        self.loop = loop
+        self.tee = open(tee_path, "wb")
+        self.buffer = bytearray()
+        self.closed = False
+        self.cancelled = False
+
+    def write(self, data) -> int:
+        self.buffer += data
+        if len(self.buffer) >= CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.cancelled:
+            raise RuntimeError("The client closed the connection.")
+        if self.buffer:
+            chunk = bytes(self.buffer)
+            self.buffer.clear()
+            self.tee.write(chunk)
+            asyncio.run_coroutine_threadsafe(self.queue.put(chunk), self.loop).result()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.tee.close()
+            self.closed = True
+
+
+@functools.lru_cache(maxsize=32)
+def _admin_boundaries(admin_dir: Path, country: str, level: str) -> gpd.GeoDataFrame:
+    path = admin_dir / f"{country}-{level}.geojson"
+    if not path.exists():
+        raise web.HTTPNotFound(text=f"No {level} boundaries for {country}.")
+    return gpd.read_file(path).to_crs(epsg=4326)
+
+
+class ExtractService:
+    def __init__(
+        self,
+        dataset: PartitionedDataset,
+        admin_dir: Path,
+        cache: ExtractCache,
+        workers: int = 4,
+        max_pending: int = 32,
+    ):
+        self.dataset = dataset
+        self.admin_dir = admin_dir
+        self.cache = cache
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.schema = self._dataset_schema()
+        self.version = self._dataset_version()
+
+    def _dataset_schema(self) -> pa.Schema:
+        first_path = next(iter(self.dataset.partitions.values()))[0]
+        return pq.read_schema(first_path)
+
+    def _dataset_version(self) -> str:
+        """
+        Fingerprint of the partition files, part of the cache keys so that the extracts
+        cached before the dataset was partitioned again are not served.
+        """
+        files = []
+        for paths in self.dataset.partitions.values():
+            for path in paths:
+                stat = path.stat()
+                files.append(
+                    [
+                        str(path.relative_to(self.dataset.root)),
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                    ]
+                )
+        return hashlib.sha256(json.dumps(sorted(files)).encode()).hexdigest()
+
+    async def _parse_query(self, request: web.Request) -> Tuple[
+        Tuple[float, float, float, float] | None,
+        shapely.Geometry | None,
+        AttributeFilter,
+        Dict,
+    ]:
+        """Parse the extent and the filters of the request, with a description of them."""
+        query = request.query
+        bbox = polygon = None
+        description: Dict = {}
+        if "bbox" in query:
+            try:
+                bbox = tuple(float(v) for v in query["bbox"].split(","))
+            except ValueError:
+                raise web.HTTPBadRequest(text="bbox must be xmin,ymin,xmax,ymax.")
+            if len(bbox) != 4:
+                raise web.HTTPBadRequest(text="bbox must be xmin,ymin,xmax,ymax.")
+            description["bbox"] = bbox
+        elif "region" in query:
+            country = query.get("country", "").upper()
+            level = query.get("level", "ADM1").upper()
+            boundaries = await asyncio.get_running_loop().run_in_executor(
+                None, _admin_boundaries, self.admin_dir, country, level
+            )
+            region = query["region"]
+            matches = boundaries[
+                (boundaries["shapeID"] == region) | (boundaries["shapeName"] == region)
+            ]
+            if matches.empty:
+                raise web.HTTPNotFound(text=f"No {level} region {region} in {country}.")
+            polygon = matches.geometry.union_all()
+            description["region"] = [country, level, region]
+        else:
+            raise web.HTTPBadRequest(text="A bbox or a region is needed.")
+
+        def number(name: str) -> float | None:
+            return float(query[name]) if name in query else None
+
+        filters = AttributeFilter(
+            min_height=number("min_height"),
+            max_height=number("max_height"),
+            min_age=number("min_age"),
+            max_age=number("max_age"),
+            types=query.getall("type") if "type" in query else None,
+        )
+        description["filters"] = vars(filters)
+        return bbox, polygon, filters, description
+
+    def _batches(self, bbox, polygon, filters) -> Iterator[pa.RecordBatch]:
+        for batch in self.dataset.query(bbox=bbox, polygon=polygon, filters=filters):
+            yield batch.cast(self.schema)
+
+    def _write_parquet(self, bbox, polygon, filters, sink: _ChunkSink):
+        with pq.ParquetWriter(sink, self.schema, compression="zstd") as writer:
+            for batch in self._batches(bbox, polygon, filters):
+                writer.write_batch(batch)
+        sink.close()
+
+    def _write_ogr(self, bbox, polygon, filters, driver: str, path: Path):
+        # GDAL cannot write struct columns, the bbox is only useful in Parquet anyway
+        schema = self.schema.remove(self.schema.get_field_index(BBOX_COLUMN))
+        batches = (
+            batch.drop_columns([BBOX_COLUMN]).cast(schema)
+            for batch in self._batches(bbox, polygon, filters)
+        )
+        pyogrio.write_arrow(
+            pa.RecordBatchReader.from_batches(schema, batches),
+            path,
+            layer="buildings",
+            driver=driver,
+            geometry_name="geometry",
+            geometry_type="Unknown",
+            crs="EPSG:4326",
+        )
+
+    async def _stream_file(self, request: web.Request, f: BinaryIO, response):
+        await response.prepare(request)
+        with f:
+            while chunk := await asyncio.get_running_loop().run_in_executor(
+                None, f.read, CHUNK_SIZE
+            ):
+                await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    async def extract(self, request: web.Request) -> web.StreamResponse:
+        file_format = request.query.get("format", "parquet")
+        if file_format not in FORMATS:
+            raise web.HTTPBadRequest(
+                text=f"format must be one of {', '.join(FORMATS)}."
+            )
+        content_type, suffix, driver = FORMATS[file_format]
+        bbox, polygon, filters, description = await self._parse_query(request)
+
+        key = hashlib.sha256(
+            json.dumps(
+                {
+                    **description,
+                    "format": file_format,
+                    "dataset": str(self.dataset.root),
+                    "version": self.version,
+                },
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()[:32]
+        name = f"{key}{suffix}"
+
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": content_type,
+                "Content-Disposition": f'attachment; filename="extract{suffix}"',
+            }
+        )
+        response.enable_chunked_encoding()
+
+        cached = self.cache.open(name)
+        if cached is not None:
+            response.headers["X-Cache"] = "hit"
+            return await self._stream_file(request, cached, response)
+        response.headers["X-Cache"] = "miss"
+
+        if self.pending.locked():
+            raise web.HTTPServiceUnavailable(
+                text="Too many extracts in progress.", headers={"Retry-After": "5"}
+            )
+
+        loop = asyncio.get_running_loop()
+        tmp_path = self.cache.temp_path(name)
+        async with self.pending:
+            if driver is not None:
+                # GeoPackage and FlatGeoBuf are written with seeks, so they are built
+                # in the cache directory first and then streamed from there
+                try:
+                    await loop.run_in_executor(
+                        self.pool,
+                        self._write_ogr,
+                        bbox,
+                        polygon,
+                        filters,
+                        driver,
+                        tmp_path,
+                    )
+                except BaseException:
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+                # Opened before the commit, so that it cannot be evicted before it is read
+                f = open(tmp_path, "rb")
+                self.cache.commit(name, tmp_path)
+                return await self._stream_file(request, f, response)
+
+            # Parquet is streamed while it is written, and tee'd into the cache
+            queue: asyncio.Queue = asyncio.Queue(maxsize=4)
+            sink = _ChunkSink(queue, loop, tmp_path)
+            future = loop.run_in_executor(
+                self.pool, self._write_parquet, bbox, polygon, filters, sink
+            )
+            future.add_done_callback(lambda _: asyncio.ensure_future(queue.put(None)))
+            try:
+                await response.prepare(request)
+                while (chunk := await queue.get()) is not None:
+                    await response.write(chunk)
+                await future
+                await response.write_eof()
+            except BaseException:
+                # Stop the writer if the client went away, then drop the entry
+                sink.cancelled = True
+                while not future.done():
+                    while not queue.empty():
+                        queue.get_nowait()
+                    await asyncio.sleep(0.01)
+                sink.tee.close()
+                tmp_path.unlink(missing_ok=True)
+                raise
+            self.cache.commit(name, tmp_path)
+            return response
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"partitions": len(self.dataset.partitions), "cache": self.cache.stats()}
+        )
+
+    def make_app(self) -> web.Application:
+        application = web.Application()
+        application.router.add_get("/extract", self.extract)
+        application.router.add_get("/health", self.health)
+        return application
+
+
+@app.command("serve")
+def serve(
+    data_dir: Annotated[
+        Path,
+        typer.Option(
+            "-d", "--data_dir", help="Main directory of the data.", exists=True
+        ),
+    ],
+    resolution: Annotated[
+        int,
+        typer.Option("-r", "--resolution", help="H3 resolution of the partitions."),
+    ] = 4,
+    host: Annotated[
+        str, typer.Option("--host", help="Address to listen on.")
+    ] = "127.0.0.1",
+    port: Annotated[int, typer.Option("--port", help="Port to listen on.")] = 8080,
+    workers: Annotated[
+        int, typer.Option("--workers", help="Number of extracts built in parallel.")
+    ] = 4,
+    max_pending: Annotated[
+        int,
+        typer.Option(
+            "--max_pending",
+            help="Number of extracts in progress beyond which requests are refused.",
+        ),
+    ] = 32,
+    cache_size: Annotated[
+        float, typer.Option("--cache_size", help="Size in GB of the extract cache.")
+    ] = 10,
+):
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    dataset = PartitionedDataset(data_dir / "partition" / f"h3_res{resolution}")
+    cache = ExtractCache(data_dir / "extracts", int(cache_size * 1024**3))
+
+    async def make_app() -> web.Application:
+        service = ExtractService(
+            dataset,
+            data_dir / "admin_boundaries",
+            cache,
+            workers=workers,
+            max_pending=max_pending,
+        )
+        return service.make_app()
+
+    web.run_app(make_app(), host=host, port=port)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,311 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Iterator
+
+from job_pool import GB
+
+# Buffer used to copy the GeoPackage out of the zip
+COPY_BUFFER = 16 * 1024**2
+# Held by the process that uses a cache directory
+LOCK_NAME = ".lock"
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Acquisitions that could not fit in the budget and read the zip directly
+    bypasses: int = 0
+    evictions: int = 0
+    extracted_bytes: int = 0
+    extract_seconds: float = 0.0
+    entries: int = 0
+    size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def format(self) -> str:
+        return (
+            f"GeoPackage cache: {self.hits} hits, {self.misses} misses "
+            f"({self.hit_rate:.0%} hit rate), {self.bypasses} bypasses, "
+            f"{self.evictions} evictions, {self.extracted_bytes / GB:.1f} GB extracted "
+            f"in {self.extract_seconds:.0f} s, {self.entries} entries "
+            f"of {self.size / GB:.1f} GB."
+        )
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), "hit_rate": self.hit_rate}
+
+
+@dataclass
+class _Entry:
+    path: Path
+    size: int
+    # Path, size and mtime of the zip it was extracted from
+    source: dict
+    refs: int = 0
+    # Set once the file is extracted, or the extraction failed
+    ready: threading.Event = field(default_factory=threading.Event)
+    error: Exception | None = None
+
+
+def _source_key(zip_path: Path) -> dict:
+    stat = zip_path.stat()
+    return {
+        "source": str(zip_path.resolve()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _gpkg_member(archive: zipfile.ZipFile) -> zipfile.ZipInfo:
+    members = [info for info in archive.infolist() if info.filename.endswith(".gpkg")]
+    if len(members) != 1:
+        raise RuntimeError(
+            f"Expected one GeoPackage in {archive.filename}, found {len(members)}."
+        )
+    return members[0]
+
+
+class GpkgCache:
+    """
+    Local cache of the GeoPackages extracted from their `.gpkg.zip`, shared by all the
+    stages that read a country, so that it is decompressed once. SQLite then gets fast
+    random access instead of seeking through a zip stream with `/vsizip`.
+
+    An extracted file is pinned while a reader holds it, and the least recently used
+    unpinned files are evicted to stay within `max_bytes`. If a GeoPackage cannot fit
+    even after evicting, the zip itself is handed out so that the reader still works.
+    Extracted files carry a sidecar JSON of their source, so that a new cache on the
+    same directory adopts them if the zip did not change.
+
+    The pins only live in this process, so a directory is used by one process at a
+    time, which holds a lock on it. A cache created on a directory that another
+    process uses hands out the zips, like for a GeoPackage that does not fit.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._stats = CacheStats()
+        self._size = 0
+        self._lock_file = open(self.directory / LOCK_NAME, "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            logging.warning(
+                f"The GeoPackage cache {self.directory} is used by another process, "
+                "reading the zips directly."
+            )
+            return
+        self._adopt()
+
+    @property
+    def active(self) -> bool:
+        """Whether this process holds the directory, and so extracts files to it."""
+        return not self._lock_file.closed
+
+    def close(self):
+        """Let another process use the directory, keeping the extracted files."""
+        self._lock_file.close()
+
+    def _meta_path(self, path: Path) -> Path:
+        return path.with_name(path.name + ".json")
+
+    def _adopt(self):
+        """Reuse the files left by a previous run, and clean up partial ones."""
+        for path in self.directory.glob("tmp-*"):
+            path.unlink(missing_ok=True)
+        for meta_path in sorted(
+            self.directory.glob("*.gpkg.json"), key=lambda p: p.stat().st_mtime
+        ):
+            path = meta_path.with_suffix("")
+            try:
+                meta = json.loads(meta_path.read_text())
+                source = Path(meta["source"])
+                if not path.exists() or _source_key(source) != meta:
+                    raise ValueError("stale")
+            except (OSError, ValueError, KeyError):
+                path.unlink(missing_ok=True)
+                meta_path.unlink(missing_ok=True)
+                continue
+            entry = _Entry(path=path, size=path.stat().st_size, source=meta)
+            entry.ready.set()
+            self._entries[meta["source"]] = entry
+            self._size += entry.size
+        self._evict(0)
+
+    def _drop(self, key: str):
+        """Remove an entry and its files. Lock must be held."""
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        entry.path.unlink(missing_ok=True)
+        self._meta_path(entry.path).unlink(missing_ok=True)
+
+    def _evict(self, needed: int) -> bool:
+        """Evict unpinned entries until `needed` more bytes fit. Lock must be held."""
+        pinned = sum(
+            entry.size
+            for entry in self._entries.values()
+            if entry.refs > 0 or not entry.ready.is_set()
+        )
+        if pinned + needed > self.max_bytes:
+            # Evicting would not make enough room, keep what is there
+            return False
+        for key in list(self._entries):
+            if self._size + needed <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry.refs > 0 or not entry.ready.is_set():
+                continue
+            self._drop(key)
+            self._stats.evictions += 1
+            logging.debug(f"Evicted {entry.path.name} from the GeoPackage cache.")
+        return self._size + needed <= self.max_bytes
+
+    def _extract(self, zip_path: Path, entry: _Entry):
+        start = time.perf_counter()
+        tmp_path = self.directory / f"tmp-{entry.path.name}"
+        try:
+            with zipfile.ZipFile(zip_path) as archive:
+                member = _gpkg_member(archive)
+                with archive.open(member) as src, open(tmp_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, COPY_BUFFER)
+            os.replace(tmp_path, entry.path)
+            self._meta_path(entry.path).write_text(json.dumps(entry.source))
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        with self._lock:
+            self._stats.extracted_bytes += entry.size
+            self._stats.extract_seconds += time.perf_counter() - start
+
+    def acquire(self, zip_path: Path) -> Path:
+        """
+        Return the path of the extracted GeoPackage of `zip_path`, extracting it on a
+        miss, and pin it until `release` is called.
+        """
+        if not self.active:
+            with self._lock:
+                self._stats.bypasses += 1
+            return zip_path
+        meta = _source_key(zip_path)
+        key = meta["source"]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.source != meta:
+                # The zip was downloaded again since it was extracted
+                if entry.refs > 0:
+                    self._stats.bypasses += 1
+                    return zip_path
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                entry.refs += 1
+                self._entries.move_to_end(key)
+                self._stats.hits += 1
+                miss = False
+            else:
+                with zipfile.ZipFile(zip_path) as archive:
+                    size = _gpkg_member(archive).file_size
+                if not self._evict(size):
+                    self._stats.bypasses += 1
+                    logging.warning(
+                        f"{zip_path.name} does not fit in the GeoPackage cache, "
+                        "reading it from the zip."
+                    )
+                    return zip_path
+                # Files of the same name can come from different directories
+                digest = hashlib.sha1(key.encode()).hexdigest()[:8]
+                name = zip_path.name.removesuffix(".gpkg.zip")
+                entry = _Entry(
+                    path=self.directory / f"{name}-{digest}.gpkg",
+                    size=size,
+                    source=meta,
+                    refs=1,
+                )
+                self._entries[key] = entry
+                self._size += size
+                self._stats.misses += 1
+                miss = True
+
+        if miss:
+            logging.info(f"Extracting {zip_path.name} to the GeoPackage cache...")
+            try:
+                self._extract(zip_path, entry)
+            except Exception as exc:
+                entry.error = exc
+                with self._lock:
+                    self._drop(key)
+                raise
+            finally:
+                entry.ready.set()
+        else:
+            entry.ready.wait()
+            if entry.error is not None:
+                raise RuntimeError(
+                    f"Extracting {zip_path.name} failed."
+                ) from entry.error
+        return entry.path
+
+    def release(self, zip_path: Path):
+        key = str(zip_path.resolve())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs = max(0, entry.refs - 1)
+            self._evict(0)
+
+    @contextmanager
+    def open(self, zip_path: Path) -> Iterator[Path]:
+        """
+        Context manager that yields the path to read instead of `zip_path`. Files that
+        are not zipped are read as they are.
+        """
+        if zip_path.suffix != ".zip":
+            yield zip_path
+            return
+        path = self.acquire(zip_path)
+        try:
+            yield path
+        finally:
+            if path != zip_path:
+                self.release(zip_path)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                **{
+                    **asdict(self._stats),
+                    "entries": len(self._entries),
+                    "size": self._size,
+                }
+            )
+
+
+@contextmanager
+def open_gpkg(zip_path: Path, cache: GpkgCache | None) -> Iterator[Path]:
+    """Path to read `zip_path` from, through `cache` if there is one."""
+    if cache is None:
+        yield zip_path
+    else:
+        with cache.open(zip_path) as path:
+            yield path
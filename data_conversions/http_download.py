@@ -0,0 +1,332 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from pathlib import Path
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+import aiofiles
+import aiohttp
+from tqdm import tqdm
+
+SEGMENT_THRESHOLD = 1024**3
+# aiohttp asks for gzip and decodes it, which breaks the byte counts and the ranges
+IDENTITY = {"Accept-Encoding": "identity"}
+
+
+class _RangesNotSupported(Exception):
+    pass
+
+
+class HostLimiter:
+    """Limit the number of concurrent connections to each host."""
+
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def __call__(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.max_connections)
+        return self._semaphores[host]
+
+
+async def _get_file_info(
+    session: aiohttp.ClientSession, url: str
+) -> Tuple[int, str | None]:
+    """
+    Issue a HEAD request to fetch the Content-Length header, and the strong ETag or the
+    Last-Modified date that identifies the version of the file for If-Range.
+    """
+    async with session.head(url, allow_redirects=True, headers=IDENTITY) as resp:
+        resp.raise_for_status()
+        etag = resp.headers.get("ETag")
+        if etag is not None and etag.startswith("W/"):
+            # Weak ETags cannot be used in If-Range
+            etag = None
+        validator = etag or resp.headers.get("Last-Modified")
+        return int(resp.headers.get("Content-Length", 0)), validator
+
+
+def _range_headers(byte_range: str, validator: str | None) -> Dict[str, str]:
+    """
+    Headers of a Range request, which the server answers with the whole file instead
+    if it changed since the version identified by `validator`.
+    """
+    headers = {**IDENTITY, "Range": f"bytes={byte_range}"}
+    if validator is not None:
+        headers["If-Range"] = validator
+    return headers
+
+
+def _is_transient(error: Exception) -> bool:
+    """Server errors, rate limiting and dropped connections are worth retrying."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return isinstance(
+        error,
+        (
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            asyncio.TimeoutError,
+        ),
+    )
+
+
+async def _with_retries(coro_func, description: str, max_retries: int, backoff: float):
+    """
+    Call `coro_func` until it succeeds, waiting exponentially longer between tries.
+    Client errors such as a 404 are raised right away.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return await coro_func()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == max_retries or not _is_transient(e):
+                raise
+            delay = backoff * 2**attempt * (1 + random.random())
+            logging.warning(
+                f"{description} failed ({e}), retrying in {delay:.1f} s "
+                f"({attempt + 1}/{max_retries})."
+            )
+            await asyncio.sleep(delay)
+
+
+async def _download_stream(
+    session: aiohttp.ClientSession,
+    url: str,
+    part_path: Path,
+    validator: str | None,
+    pbar: tqdm,
+    limiter: HostLimiter,
+    chunk_size: int,
+):
+    """Download `url` into `part_path` in one stream, resuming after its current size."""
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    headers = _range_headers(f"{offset}-", validator) if offset > 0 else IDENTITY
+
+    async with limiter(url), session.get(url, headers=headers) as resp:
+        if resp.status == 416:
+            # Nothing left to download
+            return
+        resp.raise_for_status()
+
+        mode = "ab"
+        if offset > 0 and resp.status != 206:
+            logging.info(
+                f"{url} changed or does not support ranges, downloading from the start."
+            )
+            pbar.reset(total=pbar.total)
+            mode = "wb"
+
+        async with aiofiles.open(part_path, mode=mode) as f:
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                await f.write(chunk)
+                pbar.update(len(chunk))
+
+
+async def _download_segment(
+    session: aiohttp.ClientSession,
+    url: str,
+    part_path: Path,
+    segment: List[int],
+    validator: str | None,
+    save_state,
+    pbar: tqdm,
+    limiter: HostLimiter,
+    chunk_size: int,
+):
+    """Download the byte range [start, end) of `segment`, which also holds the progress."""
+    start, end, done = segment
+    if start + done >= end:
+        return
+    headers = _range_headers(f"{start + done}-{end - 1}", validator)
+
+    async with limiter(url), session.get(url, headers=headers) as resp:
+        resp.raise_for_status()
+        if resp.status != 206:
+            raise _RangesNotSupported()
+
+        async with aiofiles.open(part_path, mode="r+b") as f:
+            await f.seek(start + done)
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                await f.write(chunk)
+                segment[2] += len(chunk)
+                pbar.update(len(chunk))
+                save_state()
+
+
+async def download_file(
+    session: aiohttp.ClientSession,
+    url: str,
+    save_path: Path,
+    desc: str,
+    limiter: HostLimiter,
+    segments: int = 1,
+    chunk_size: int = 64 * 1024,
+    max_retries: int = 5,
+    backoff: float = 1.0,
+) -> Path:
+    """
+    Download `url` to `save_path` through a `.part` file that is only renamed once the
+    download is complete, so a dropped connection never leaves a truncated file behind.
+
+    An interrupted download resumes with HTTP Range requests, and files larger than
+    SEGMENT_THRESHOLD are split into `segments` byte ranges downloaded in parallel.
+    The version of the file and the progress of the segments are kept in a `.part.json`
+    file next to the `.part` file, so that a partial file of a previous version of
+    the file is never resumed.
+    """
+    part_path = save_path.with_name(save_path.name + ".part")
+    state_path = save_path.with_name(save_path.name + ".part.json")
+
+    total_bytes, validator = await _with_retries(
+        lambda: _get_file_info(session, url), f"HEAD {url}", max_retries, backoff
+    )
+
+    pbar = tqdm(
+        total=total_bytes,
+        unit="B",
+        unit_scale=True,
+        desc=desc,
+        colour="green",
+        leave=True,
+    )
+
+    try:
+        if segments > 1 and total_bytes >= SEGMENT_THRESHOLD:
+            try:
+                await _download_segmented(
+                    session,
+                    url,
+                    part_path,
+                    state_path,
+                    total_bytes,
+                    validator,
+                    segments,
+                    pbar,
+                    limiter,
+                    chunk_size,
+                    max_retries,
+                    backoff,
+                )
+            except _RangesNotSupported:
+                logging.info(f"{url} does not support ranges, using a single stream.")
+                part_path.unlink(missing_ok=True)
+                state_path.unlink(missing_ok=True)
+                pbar.reset(total=total_bytes)
+                segments = 1
+
+        if segments <= 1 or total_bytes < SEGMENT_THRESHOLD:
+            state = {"url": url, "total_bytes": total_bytes, "validator": validator}
+            # A leftover of a segmented download cannot be resumed as a single stream,
+            # nor a partial file of another version of the file
+            if not state_path.exists() or json.loads(state_path.read_text()) != state:
+                part_path.unlink(missing_ok=True)
+                state_path.write_text(json.dumps(state))
+            if part_path.exists():
+                pbar.update(part_path.stat().st_size)
+
+            await _with_retries(
+                lambda: _download_stream(
+                    session, url, part_path, validator, pbar, limiter, chunk_size
+                ),
+                f"GET {url}",
+                max_retries,
+                backoff,
+            )
+    finally:
+        pbar.close()
+
+    size = part_path.stat().st_size
+    if total_bytes > 0 and size != total_bytes:
+        raise RuntimeError(
+            f"Downloaded {size} bytes from {url} instead of {total_bytes}, "
+            f"the partial file {part_path} will be resumed on the next run."
+        )
+    os.replace(part_path, save_path)
+    state_path.unlink(missing_ok=True)
+    return save_path
+
+
+async def _download_segmented(
+    session: aiohttp.ClientSession,
+    url: str,
+    part_path: Path,
+    state_path: Path,
+    total_bytes: int,
+    validator: str | None,
+    segments: int,
+    pbar: tqdm,
+    limiter: HostLimiter,
+    chunk_size: int,
+    max_retries: int,
+    backoff: float,
+):
+    state: Dict | None = None
+    if state_path.exists() and part_path.exists():
+        state = json.loads(state_path.read_text())
+        if (
+            state.get("url") != url
+            or state.get("total_bytes") != total_bytes
+            or state.get("validator") != validator
+            or "segments" not in state
+        ):
+            state = None
+
+    if state is None:
+        bounds = [total_bytes * i // segments for i in range(segments + 1)]
+        state = {
+            "url": url,
+            "total_bytes": total_bytes,
+            "validator": validator,
+            "segments": [[bounds[i], bounds[i + 1], 0] for i in range(segments)],
+        }
+        with open(part_path, "wb") as f:
+            f.truncate(total_bytes)
+    pbar.update(sum(done for _, _, done in state["segments"]))
+
+    # Only write the progress every few MB to keep the overhead low
+    last_saved = [0]
+
+    def save_state(force: bool = False):
+        done = sum(segment[2] for segment in state["segments"])
+        if force or done - last_saved[0] >= 16 * 1024**2:
+            state_path.write_text(json.dumps(state))
+            last_saved[0] = done
+
+    save_state(force=True)
+    tasks = [
+        asyncio.create_task(
+            _with_retries(
+                lambda segment=segment: _download_segment(
+                    session,
+                    url,
+                    part_path,
+                    segment,
+                    validator,
+                    save_state,
+                    pbar,
+                    limiter,
+                    chunk_size,
+                ),
+                f"GET {url} (bytes {segment[0]}-{segment[1] - 1})",
+                max_retries,
+                backoff,
+            )
+        )
+        for segment in state["segments"]
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other segments before the part file is resumed or replaced
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        save_state(force=True)
@@ -0,0 +1,153 @@
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+GB = 1024**3
+
+# Rough resource usage of each tool as (fixed bytes, bytes per input byte), measured on
+# a few countries. The memory is the peak RSS, the disk is the scratch + output space.
+COST_FACTORS: Dict[str, Dict[str, Tuple[float, float]]] = {
+    "ogr2ogr": {"memory": (256 * 1024**2, 0.1), "disk": (0, 4.0)},
+    "tippecanoe": {"memory": (1 * GB, 1.0), "disk": (0, 3.0)},
+    # Fed by ogr2ogr from the zipped GeoPackage, which is about 4 times smaller
+    "tippecanoe-stream": {"memory": (1 * GB, 4.0), "disk": (0, 8.0)},
+    "tile-join": {"memory": (256 * 1024**2, 0.1), "disk": (0, 1.0)},
+    # The inputs are memory-mapped, only the directories are held in memory
+    "merge_pmtiles": {"memory": (256 * 1024**2, 0.05), "disk": (0, 1.0)},
+}
+
+
+@dataclass
+class JobCost:
+    memory: int = 0
+    disk: int = 0
+    size: int = 0  # Size of the inputs, used to run the largest jobs first
+
+
+def estimate_cost(tool: str, input_paths: Iterable[Path]) -> JobCost:
+    """Estimate the resources used by `tool` from the size of its inputs."""
+    size = sum(p.stat().st_size for p in input_paths if p.exists())
+    factors = COST_FACTORS[tool]
+    mem_fixed, mem_factor = factors["memory"]
+    disk_fixed, disk_factor = factors["disk"]
+    return JobCost(
+        memory=int(mem_fixed + mem_factor * size),
+        disk=int(disk_fixed + disk_factor * size),
+        size=size,
+    )
+
+
+def default_workers() -> int:
+    return (
+        len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+    ) or 4
+
+
+class ResourceBudget:
+    """
+    Budget of RAM and scratch disk that jobs are admitted against.
+
+    Waiting jobs are admitted largest first (LPT), and only the largest waiting job can
+    be admitted, so that a big country is not starved by a stream of small ones.
+    A job larger than the whole budget is admitted once nothing else is running.
+    """
+
+    def __init__(self, memory: int, disk: int):
+        self.memory = memory
+        self.disk = disk
+        self._used_memory = 0
+        self._used_disk = 0
+        self._running = 0
+        self._waiting: List[Tuple[int, int]] = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_system(
+        cls,
+        memory: int | None = None,
+        disk: int | None = None,
+        scratch_dir: Path | None = None,
+    ) -> "ResourceBudget":
+        """Default to 80% of the RAM and of the free space of the scratch directory."""
+        if memory is None:
+            memory = int(0.8 * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+        if disk is None:
+            free = shutil.disk_usage(scratch_dir or tempfile.gettempdir()).free
+            disk = int(0.8 * free)
+        logging.info(
+            f"Using a budget of {memory / GB:.1f} GB of RAM and {disk / GB:.1f} GB of disk."
+        )
+        return cls(memory=memory, disk=disk)
+
+    def _fits(self, cost: JobCost) -> bool:
+        if self._running == 0:
+            return True
+        return (
+            self._used_memory + cost.memory <= self.memory
+            and self._used_disk + cost.disk <= self.disk
+        )
+
+    def acquire(self, cost: JobCost):
+        with self._cond:
+            key = (-cost.size, next(self._counter))
+            heapq.heappush(self._waiting, key)
+            self._cond.wait_for(lambda: self._waiting[0] == key and self._fits(cost))
+            heapq.heappop(self._waiting)
+            self._used_memory += cost.memory
+            self._used_disk += cost.disk
+            self._running += 1
+            self._cond.notify_all()
+
+    def release(self, cost: JobCost):
+        with self._cond:
+            self._used_memory -= cost.memory
+            self._used_disk -= cost.disk
+            self._running -= 1
+            self._cond.notify_all()
+
+    def run(self, cost: JobCost, func: Callable[..., Any], *args, **kwargs) -> Any:
+        self.acquire(cost)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release(cost)
+
+
+@dataclass
+class Job:
+    func: Callable[..., Any]
+    args: Tuple
+    cost: JobCost
+
+
+def run_jobs(
+    jobs: List[Job],
+    budget: ResourceBudget | None = None,
+    max_workers: int | None = None,
+) -> List[Any]:
+    """
+    Run jobs in threads, largest first, with at most `max_workers` jobs at once and
+    within the RAM/disk budget. The jobs are expected to wait on subprocesses, so
+    threads are enough. Returns the results in the same order as `jobs`.
+    """
+    budget = budget or ResourceBudget.from_system()
+    workers = max_workers or default_workers()
+    logging.info(f"Using at most {workers} workers.")
+
+    order = sorted(range(len(jobs)), key=lambda i: jobs[i].cost.size, reverse=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # Submitting everything at once is fine, the budget decides which job goes first
+        futures = {
+            i: pool.submit(budget.run, jobs[i].cost, jobs[i].func, *jobs[i].args)
+            for i in order
+        }
+        return [futures[i].result() for i in range(len(jobs))]
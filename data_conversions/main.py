@@ -1,13 +1,103 @@
+import logging
+import os
+import subprocess
+import sys
 import time
 import zipfile
+from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
+from typing import Annotated, Callable, Dict, List
 from urllib.request import urlretrieve
 
 import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+import typer
 from geoparquet_io.core.convert import convert_to_geoparquet
 
+from gpkg_cache import GpkgCache, open_gpkg
+from job_pool import GB
+from parquet_index import (
+    BBOX_COLUMN,
+    BBOX_TYPE,
+    GEOMETRY_COLUMN,
+    bbox_array,
+    build_index,
+    geo_metadata,
+    rows_per_row_group,
+)
 from utils import init_db_con
 
+app = typer.Typer()
+
+# Number of rows used to estimate the size of a row
+SAMPLE_ROWS = 10_000
+MB = 1024**2
+
+
+class Engine(Enum):
+    GeoPandas = "geopandas"
+    DuckDB = "duckdb"
+    Gpio = "gpio"
+    Streaming = "streaming"
+
+
+class Compression(Enum):
+    Zstd = "zstd"
+    Snappy = "snappy"
+    Gzip = "gzip"
+    Brotli = "brotli"
+    Lz4 = "lz4"
+    NoCompression = "none"
+
+    @property
+    def has_level(self) -> bool:
+        return self in (Compression.Zstd, Compression.Gzip, Compression.Brotli)
+
+
+# Levels used when none is given, the other codecs keep their own default
+DEFAULT_LEVELS = {Compression.Zstd: 15}
+
+
+@dataclass
+class ConvertOptions:
+    """
+    Options shared by all the engines. `row_group_bytes`, when given, replaces
+    `row_group_size` by the number of rows that makes row groups of about that many
+    uncompressed bytes.
+    """
+
+    compression: Compression = Compression.Zstd
+    # None for the default of the codec
+    compression_level: int | None = None
+    row_group_size: int = 100_000
+    row_group_bytes: int | None = None
+    hilbert: bool = False
+
+    @property
+    def level(self) -> int | None:
+        """Compression level, None for the default of the codec or if it has none."""
+        if not self.compression.has_level:
+            return None
+        if self.compression_level is None:
+            return DEFAULT_LEVELS.get(self.compression)
+        return self.compression_level
+
+    def cli_args(self) -> List[str]:
+        """Arguments of the `convert` command that give the same options."""
+        args = ["--compression", self.compression.value]
+        args += ["--row_group_size", str(self.row_group_size)]
+        if self.compression_level is not None:
+            args += ["--compression_level", str(self.compression_level)]
+        if self.row_group_bytes is not None:
+            args += ["--row_group_mb", str(self.row_group_bytes / MB)]
+        if self.hilbert:
+            args.append("--hilbert")
+        return args
+
 
 def download_sample_data(fgb_path: Path, gpkg_path: Path, gpkg_zip_path: Path):
     # URL to download
@@ -28,36 +118,254 @@ def download_sample_data(fgb_path: Path, gpkg_path: Path, gpkg_zip_path: Path):
         zf.write(gpkg_path, arcname=gpkg_path.name)
 
 
-def gpkg_to_parquet_geopandas(input_path: Path, output_path: Path):
+def gpkg_to_parquet_geopandas(
+    input_path: Path, output_path: Path, options: ConvertOptions = ConvertOptions()
+):
+    """
+    Load the whole layer in memory. With `hilbert`, the rows are sorted along a
+    Hilbert curve, so that bbox queries read few row groups.
+    """
     gdf = gpd.read_file(input_path)
+    if options.hilbert:
+        gdf = gdf.iloc[gdf.hilbert_distance().argsort()].reset_index(drop=True)
+
+    row_group_size = options.row_group_size
+    if options.row_group_bytes is not None:
+        sample = pa.table(gdf.head(SAMPLE_ROWS).to_arrow(geometry_encoding="WKB"))
+        row_group_size = rows_per_row_group(sample, options.row_group_bytes)
+
     gdf.to_parquet(
         output_path,
-        compression="zstd",
+        compression=options.compression.value,
+        compression_level=options.level,
+        row_group_size=row_group_size,
         write_covering_bbox=True,
         schema_version="1.1.0",
     )
 
 
-def gpkg_to_parquet_duckdb(input_path: Path, output_path: Path):
+def gpkg_to_parquet_duckdb(
+    input_path: Path, output_path: Path, options: ConvertOptions = ConvertOptions()
+):
+    """
+    With `hilbert`, the rows are sorted with `ST_Hilbert` over the extent of the layer
+    and a bbox covering column is added.
+    """
     # Create the database
     con = init_db_con(read_only=True)
+    params = {"input_path": str(input_path), "output_path": str(output_path)}
+
+    row_group_size = options.row_group_size
+    if options.row_group_bytes is not None:
+        sample = con.execute(
+            f"""
+            SELECT * EXCLUDE(geom), ST_AsWKB(geom) AS geometry
+            FROM st_read($input_path, allowed_drivers=["GPKG"])
+            LIMIT {SAMPLE_ROWS};
+            """,
+            {"input_path": str(input_path)},
+        ).fetch_arrow_table()
+        row_group_size = rows_per_row_group(sample, options.row_group_bytes)
+
+    bbox = ""
+    order_by = ""
+    if options.hilbert:
+        xmin, ymin, xmax, ymax = con.execute(
+            """
+            SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+            FROM (
+                SELECT ST_Extent_Agg(geom) AS extent
+                FROM st_read($input_path, allowed_drivers=["GPKG"])
+            );
+            """,
+            {"input_path": str(input_path)},
+        ).fetchone()
+        params.update({"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax})
+        bbox = """,
+            struct_pack(
+                xmin := ST_XMin(geom),
+                ymin := ST_YMin(geom),
+                xmax := ST_XMax(geom),
+                ymax := ST_YMax(geom)
+            ) AS bbox"""
+        order_by = """
+            ORDER BY ST_Hilbert(geom, ST_Extent(ST_MakeEnvelope($xmin, $ymin, $xmax, $ymax)))"""
+
+    codec = options.compression
+    compression = (
+        "COMPRESSION uncompressed"
+        if codec == Compression.NoCompression
+        else f"COMPRESSION {codec.value}"
+    )
+    if options.level is not None:
+        compression += f", COMPRESSION_LEVEL {options.level}"
 
     con.execute(
-        """
+        f"""
         COPY(
             SELECT * EXCLUDE(geom),
-            geom AS geometry
-            FROM st_read($input_path, allowed_drivers=["GPKG"])
+            geom AS geometry{bbox}
+            FROM st_read($input_path, allowed_drivers=["GPKG"]){order_by}
         )
         TO $output_path
-        (FORMAT parquet, COMPRESSION zstd, COMPRESSION_LEVEL 15, ROW_GROUP_SIZE 100_000);
+        (FORMAT parquet, {compression}, ROW_GROUP_SIZE {row_group_size});
         """,
-        {"input_path": str(input_path), "output_path": str(output_path)},
+        params,
     )
 
 
-def gpkg_to_parquet_gpio(input_path: Path, output_path: Path):
-    convert_to_geoparquet(input_file=str(input_path), output_file=str(output_path))
+def gpkg_to_parquet_gpio(
+    input_path: Path, output_path: Path, options: ConvertOptions = ConvertOptions()
+):
+    """geoparquet-io always sorts the rows along a Hilbert curve."""
+    row_group_size = options.row_group_size
+    if options.row_group_bytes is not None:
+        _, sample = pyogrio.read_arrow(input_path, max_features=SAMPLE_ROWS)
+        row_group_size = rows_per_row_group(sample, options.row_group_bytes)
+
+    # Codecs without levels keep the default of geoparquet-io
+    level_kwargs = {}
+    if options.level is not None:
+        level_kwargs["compression_level"] = options.level
+    convert_to_geoparquet(
+        input_file=str(input_path),
+        output_file=str(output_path),
+        compression=options.compression.value.upper(),
+        row_group_rows=row_group_size,
+        **level_kwargs,
+    )
+
+
+def gpkg_to_parquet_streaming(
+    input_path: Path, output_path: Path, options: ConvertOptions = ConvertOptions()
+):
+    """
+    Stream the layer from GDAL in Arrow batches of one row group each, adding a bbox
+    covering column, so that memory stays bounded by a few row groups whatever the
+    size of the country. The rows keep the order of the GeoPackage, and the geometry
+    column is renamed to `geometry` like with the other engines.
+    """
+    if options.hilbert:
+        raise ValueError("The streaming engine cannot sort the rows, use another one.")
+
+    row_group_size = options.row_group_size
+    if options.row_group_bytes is not None:
+        _, sample = pyogrio.read_arrow(input_path, max_features=SAMPLE_ROWS)
+        row_group_size = rows_per_row_group(sample, options.row_group_bytes)
+
+    with pyogrio.open_arrow(
+        input_path, batch_size=row_group_size, use_pyarrow=True
+    ) as (meta, reader):
+        source_column = meta["geometry_name"] or "wkb_geometry"
+        names = [
+            GEOMETRY_COLUMN if name == source_column else name
+            for name in reader.schema.names
+        ]
+        index = reader.schema.get_field_index(source_column)
+        schema = reader.schema.set(
+            index, reader.schema.field(index).with_name(GEOMETRY_COLUMN)
+        )
+        schema = schema.append(pa.field(BBOX_COLUMN, BBOX_TYPE))
+        schema = schema.with_metadata(
+            geo_metadata(GEOMETRY_COLUMN, meta["crs"], BBOX_COLUMN)
+        )
+        with pq.ParquetWriter(
+            output_path,
+            schema,
+            compression=options.compression.value,
+            compression_level=options.level,
+        ) as writer:
+            for batch in reader:
+                batch = batch.rename_columns(names)
+                bounds = shapely.bounds(shapely.from_wkb(batch.column(GEOMETRY_COLUMN)))
+                writer.write_batch(batch.append_column(BBOX_COLUMN, bbox_array(bounds)))
+
+
+CONVERTERS: Dict[Engine, Callable[[Path, Path, ConvertOptions], None]] = {
+    Engine.GeoPandas: gpkg_to_parquet_geopandas,
+    Engine.DuckDB: gpkg_to_parquet_duckdb,
+    Engine.Gpio: gpkg_to_parquet_gpio,
+    Engine.Streaming: gpkg_to_parquet_streaming,
+}
+
+
+def convert(
+    input_path: Path,
+    output_path: Path,
+    engine: Engine = Engine.Streaming,
+    options: ConvertOptions = ConvertOptions(),
+    cache: GpkgCache | None = None,
+):
+    """
+    Convert `input_path` to GeoParquet with `engine`, through a temporary file. With a
+    cache, a zipped GeoPackage is read from its extracted copy.
+    With `hilbert`, a sidecar index of the bbox of each row group of the output is
+    written, so that bbox queries read few row groups.
+    """
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    try:
+        with open_gpkg(input_path, cache) as source_path:
+            CONVERTERS[engine](source_path, tmp_path, options)
+        os.replace(tmp_path, output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    if options.hilbert:
+        try:
+            build_index(output_path)
+        except ValueError as exc:
+            logging.warning(f"Not indexing {output_path.name} → {exc}")
+
+
+@dataclass
+class EngineRun:
+    engine: Engine
+    ok: bool
+    seconds: float
+    peak_rss: int
+    output_size: int
+
+
+def run_engine(
+    input_path: Path,
+    output_path: Path,
+    engine: Engine,
+    options: ConvertOptions,
+    cache: GpkgCache | None = None,
+) -> EngineRun:
+    """
+    Convert with `engine` in a child process, so that its peak RSS is measured alone
+    from the resource usage of the child, rather than mixed with the other engines.
+    The child adopts the GeoPackages already extracted in the directory of `cache`,
+    which this process must have closed for the child to use it.
+    """
+    args = [
+        sys.executable,
+        str(Path(__file__).resolve()),
+        "convert",
+        "-i",
+        str(input_path),
+        "-o",
+        str(output_path),
+        "-e",
+        engine.value,
+        *options.cli_args(),
+    ]
+    if cache is not None:
+        args += ["--cache_dir", str(cache.directory)]
+        args += ["--cache_size", str(cache.max_bytes / GB)]
+    start = time.perf_counter()
+    process = subprocess.Popen(args)
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return EngineRun(
+        engine=engine,
+        ok=process.returncode == 0,
+        seconds=seconds,
+        # ru_maxrss is in KB on Linux
+        peak_rss=rusage.ru_maxrss * 1024,
+        output_size=output_path.stat().st_size if process.returncode == 0 else 0,
+    )
 
 
 # def parquet_to_pmtimes(input_path: Path, output_path: Path):
@@ -82,33 +390,156 @@ def gpkg_to_parquet_gpio(input_path: Path, output_path: Path):
 #     )
 
 
-if __name__ == "__main__":
-    main_folder = Path("data") / "eubucco"
+CompressionOption = Annotated[
+    Compression, typer.Option("--compression", help="Compression codec.")
+]
+CompressionLevelOption = Annotated[
+    int | None,
+    typer.Option(
+        "--compression_level",
+        help="Level of the codec, if it has any (default: 15 for zstd).",
+    ),
+]
+RowGroupSizeOption = Annotated[
+    int, typer.Option("--row_group_size", help="Number of rows per row group.")
+]
+RowGroupMBOption = Annotated[
+    float | None,
+    typer.Option(
+        "--row_group_mb",
+        help="Uncompressed size of the row groups in MB, instead of a number of rows.",
+    ),
+]
+CacheDirOption = Annotated[
+    Path | None,
+    typer.Option(
+        "--cache_dir",
+        help="Directory of a cache of extracted GeoPackages (default: read the zip).",
+    ),
+]
+CacheSizeOption = Annotated[
+    float, typer.Option("--cache_size", help="Size in GB of the GeoPackage cache.")
+]
+HilbertOption = Annotated[
+    bool,
+    typer.Option(
+        "--hilbert", help="Sort the rows along a Hilbert curve and index them."
+    ),
+]
+
+
+def _options(
+    compression: Compression,
+    compression_level: int | None,
+    row_group_size: int,
+    row_group_mb: float | None,
+    hilbert: bool,
+) -> ConvertOptions:
+    return ConvertOptions(
+        compression=compression,
+        compression_level=compression_level,
+        row_group_size=row_group_size,
+        row_group_bytes=int(row_group_mb * MB) if row_group_mb is not None else None,
+        hilbert=hilbert,
+    )
 
-    input_gpkg_path = main_folder / "v0_1-FRA.gpkg.zip"
-    output_folder = Path(
-        str(input_gpkg_path).removesuffix("".join(input_gpkg_path.suffixes))
+
+@app.command("convert")
+def convert_command(
+    input_path: Annotated[
+        Path, typer.Option("-i", "--input", help="GeoPackage to convert.", exists=True)
+    ],
+    output_path: Annotated[
+        Path, typer.Option("-o", "--output", help="GeoParquet file to write.")
+    ],
+    engine: Annotated[
+        Engine, typer.Option("-e", "--engine", help="Engine doing the conversion.")
+    ] = Engine.Streaming,
+    compression: CompressionOption = Compression.Zstd,
+    compression_level: CompressionLevelOption = None,
+    row_group_size: RowGroupSizeOption = 100_000,
+    row_group_mb: RowGroupMBOption = None,
+    hilbert: HilbertOption = False,
+    cache_dir: CacheDirOption = None,
+    cache_size: CacheSizeOption = 50,
+):
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    options = _options(
+        compression, compression_level, row_group_size, row_group_mb, hilbert
     )
-    output_folder.mkdir(exist_ok=True)
-    file_name = output_folder.stem
-
-    fgb_path = output_folder / f"{file_name}.fgb"
-    parquet_pandas_path = output_folder / f"{file_name}_geopandas.parquet"
-    parquet_duckdb_path = output_folder / f"{file_name}_duckdb.parquet"
-    parquet_gpio_path = output_folder / f"{file_name}_gpio.parquet"
-
-    # download_sample_data(
-    #     fgb_path=fgb_path, gpkg_path=gpkg_path, gpkg_zip_path=gpkg_zip_path
-    # )
-
-    # t = time.perf_counter()
-    # gpkg_to_parquet_geopandas(
-    #     input_path=input_gpkg_path, output_path=parquet_pandas_path
-    # )
-    # print(f"gpkg_to_parquet_geopandas executed in {time.perf_counter() - t}")
-    # t = time.perf_counter()
-    # gpkg_to_parquet_duckdb(input_path=input_gpkg_path, output_path=parquet_duckdb_path)
-    # print(f"gpkg_to_parquet_duckdb executed in {time.perf_counter() - t}")
+    cache = GpkgCache(cache_dir, int(cache_size * GB)) if cache_dir else None
     t = time.perf_counter()
-    gpkg_to_parquet_gpio(input_path=input_gpkg_path, output_path=parquet_gpio_path)
-    print(f"gpkg_to_parquet_gpio executed in {time.perf_counter() - t}")
+    convert(input_path, output_path, engine, options, cache)
+    logging.info(
+        f"gpkg_to_parquet_{engine.value} executed in {time.perf_counter() - t}"
+    )
+
+
+@app.command("benchmark")
+def benchmark_command(
+    input_path: Annotated[
+        Path, typer.Option("-i", "--input", help="GeoPackage to convert.", exists=True)
+    ],
+    output_dir: Annotated[
+        Path | None,
+        typer.Option(
+            "-o",
+            "--output_dir",
+            help="Directory of the outputs (default: next to the input).",
+        ),
+    ] = None,
+    engines: Annotated[
+        List[Engine] | None,
+        typer.Option("-e", "--engine", help="Engines to compare (default: all)."),
+    ] = None,
+    compression: CompressionOption = Compression.Zstd,
+    compression_level: CompressionLevelOption = None,
+    row_group_size: RowGroupSizeOption = 100_000,
+    row_group_mb: RowGroupMBOption = None,
+    hilbert: HilbertOption = False,
+    cache_dir: CacheDirOption = None,
+    cache_size: CacheSizeOption = 50,
+):
+    """Convert with each engine in turn and report its time and peak memory."""
+    options = _options(
+        compression, compression_level, row_group_size, row_group_mb, hilbert
+    )
+    cache = None
+    if cache_dir is not None:
+        # Extract before the runs, so that the first engine is not charged for it
+        cache = GpkgCache(cache_dir, int(cache_size * GB))
+        with cache.open(input_path):
+            pass
+        # The engines run one at a time, each child taking the directory in turn
+        cache.close()
+    file_name = input_path.name.removesuffix("".join(input_path.suffixes))
+    output_dir = output_dir or input_path.parent / file_name
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    runs = [
+        run_engine(
+            input_path,
+            output_dir / f"{file_name}_{engine.value}.parquet",
+            engine,
+            options,
+            cache,
+        )
+        for engine in engines or list(Engine)
+    ]
+
+    print(
+        f"{'engine':<12}{'ok':>4}{'time (s)':>10}{'peak RSS (MB)':>15}{'size (MB)':>11}"
+    )
+    for run in runs:
+        print(
+            f"{run.engine.value:<12}{'yes' if run.ok else 'no':>4}{run.seconds:>10.1f}"
+            f"{run.peak_rss / MB:>15.0f}{run.output_size / MB:>11.1f}"
+        )
+    if not all(run.ok for run in runs):
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pydantic import BaseModel
+from pyproj import CRS
+
+# (xmin, ymin, xmax, ymax) in the CRS of the file
+BBox = Tuple[float, float, float, float]
+
+GEOMETRY_COLUMN = "geometry"
+BBOX_COLUMN = "bbox"
+BBOX_FIELDS = ("xmin", "ymin", "xmax", "ymax")
+BBOX_TYPE = pa.struct([(name, pa.float64()) for name in BBOX_FIELDS])
+
+
+class RowGroupBBox(BaseModel):
+    row_group: int
+    num_rows: int
+    xmin: float
+    ymin: float
+    xmax: float
+    ymax: float
+
+    def intersects(self, bbox: BBox) -> bool:
+        xmin, ymin, xmax, ymax = bbox
+        return not (
+            self.xmax < xmin or self.xmin > xmax or self.ymax < ymin or self.ymin > ymax
+        )
+
+
+class BBoxIndex(BaseModel):
+    """
+    Bounding box and number of rows of every row group of a Parquet file, from the
+    statistics of its bbox covering column. Stored as a small JSON file next to the
+    Parquet file, so that a query can pick its row groups without reading the footer.
+    """
+
+    parquet_size: int
+    parquet_mtime_ns: int
+    bbox_column: str = BBOX_COLUMN
+    row_groups: List[RowGroupBBox] = []
+
+    def intersecting(self, bbox: BBox) -> List[int]:
+        return [rg.row_group for rg in self.row_groups if rg.intersects(bbox)]
+
+
+def row_group_bboxes(
+    metadata: pq.FileMetaData, bbox_column: str = BBOX_COLUMN
+) -> List[RowGroupBBox] | None:
+    """
+    Read the bounding box of each row group from the min/max statistics of the bbox
+    covering column. Returns None if the file has no such column or no statistics.
+    """
+    columns: Dict[str, int] = {}
+    schema = metadata.schema
+    for i in range(len(schema)):
+        path = schema.column(i).path
+        for name in BBOX_FIELDS:
+            if path == f"{bbox_column}.{name}":
+                columns[name] = i
+    if len(columns) < len(BBOX_FIELDS):
+        return None
+
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        stats = {name: row_group.column(j).statistics for name, j in columns.items()}
+        if any(s is None or not s.has_min_max for s in stats.values()):
+            return None
+        row_groups.append(
+            RowGroupBBox(
+                row_group=i,
+                num_rows=row_group.num_rows,
+                xmin=stats["xmin"].min,
+                ymin=stats["ymin"].min,
+                xmax=stats["xmax"].max,
+                ymax=stats["ymax"].max,
+            )
+        )
+    return row_groups
+
+
+def index_path(parquet_path: Path) -> Path:
+    return parquet_path.with_name(parquet_path.name + ".index.json")
+
+
+def build_index(parquet_path: Path, bbox_column: str = BBOX_COLUMN) -> BBoxIndex:
+    """Build the row group index of `parquet_path` and write it next to the file."""
+    row_groups = row_group_bboxes(pq.read_metadata(parquet_path), bbox_column)
+    if row_groups is None:
+        raise ValueError(
+            f"{parquet_path} has no statistics for a '{bbox_column}' covering column."
+        )
+    stat = parquet_path.stat()
+    index = BBoxIndex(
+        parquet_size=stat.st_size,
+        parquet_mtime_ns=stat.st_mtime_ns,
+        bbox_column=bbox_column,
+        row_groups=row_groups,
+    )
+    path = index_path(parquet_path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(index.model_dump_json())
+    os.replace(tmp_path, path)
+    return index
+
+
+def load_index(parquet_path: Path, bbox_column: str = BBOX_COLUMN) -> BBoxIndex:
+    """Load the index of `parquet_path`, rebuilding it if it is missing or stale."""
+    path = index_path(parquet_path)
+    if path.exists():
+        index = BBoxIndex.model_validate_json(path.read_text())
+        stat = parquet_path.stat()
+        if (
+            index.parquet_size == stat.st_size
+            and index.parquet_mtime_ns == stat.st_mtime_ns
+            and index.bbox_column == bbox_column
+        ):
+            return index
+        logging.info(f"The index of {parquet_path} is stale, rebuilding it.")
+    return build_index(parquet_path, bbox_column)
+
+
+def geo_metadata(
+    geometry_column: str, crs: str | None, bbox_column: str | None = None
+) -> Dict[bytes, bytes]:
+    """
+    GeoParquet 1.1 `geo` file metadata of a WKB `geometry_column`, for Parquet files
+    written batch by batch with pyarrow rather than through geopandas or DuckDB.
+    """
+    column = {"encoding": "WKB", "geometry_types": []}
+    if crs is not None:
+        column["crs"] = CRS.from_user_input(crs).to_json_dict()
+    if bbox_column is not None:
+        column["covering"] = {
+            "bbox": {name: [bbox_column, name] for name in BBOX_FIELDS}
+        }
+    metadata = {
+        "version": "1.1.0",
+        "primary_column": geometry_column,
+        "columns": {geometry_column: column},
+    }
+    return {b"geo": json.dumps(metadata).encode()}
+
+
+def geometry_column(metadata: pq.FileMetaData) -> str:
+    """Primary geometry column of a GeoParquet file, from its `geo` metadata."""
+    geo = (metadata.metadata or {}).get(b"geo")
+    if geo is None:
+        return GEOMETRY_COLUMN
+    return json.loads(geo).get("primary_column", GEOMETRY_COLUMN)
+
+
+def bbox_array(bounds) -> pa.StructArray:
+    """Bbox covering column of the geometries of the (n, 4) array of `shapely.bounds`."""
+    return pa.StructArray.from_arrays(
+        [pa.array(bounds[:, i]) for i in range(len(BBOX_FIELDS))],
+        names=list(BBOX_FIELDS),
+    )
+
+
+def rows_per_row_group(sample: pa.Table, target_bytes: int) -> int:
+    """
+    Number of rows that makes row groups of about `target_bytes` uncompressed bytes,
+    from the average size of the rows of `sample`.
+    """
+    if sample.num_rows == 0:
+        return 100_000
+    bytes_per_row = sample.nbytes / sample.num_rows
+    return max(1_000, int(target_bytes / bytes_per_row))
+
+
+def bbox_mask(
+    batch: pa.RecordBatch, bbox: BBox, bbox_column: str = BBOX_COLUMN
+) -> pa.Array:
+    """Mask of the rows of `batch` whose bbox intersects `bbox`."""
+    xmin, ymin, xmax, ymax = bbox
+    column = batch.column(bbox_column)
+    return pc.and_(
+        pc.and_(
+            pc.less_equal(pc.struct_field(column, "xmin"), xmax),
+            pc.greater_equal(pc.struct_field(column, "xmax"), xmin),
+        ),
+        pc.and_(
+            pc.less_equal(pc.struct_field(column, "ymin"), ymax),
+            pc.greater_equal(pc.struct_field(column, "ymax"), ymin),
+        ),
+    )
+
+
+def read_bbox(
+    parquet_path: Path,
+    bbox: BBox,
+    columns: List[str] | None = None,
+    bbox_column: str = BBOX_COLUMN,
+    batch_size: int = 65_536,
+) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the rows of `parquet_path` whose bbox intersects `bbox`, only reading the
+    row groups that the index says can contain some of them.
+    """
+    index = load_index(parquet_path, bbox_column)
+    row_groups = index.intersecting(bbox)
+    logging.debug(
+        f"Reading {len(row_groups)}/{len(index.row_groups)} row groups of {parquet_path}."
+    )
+    if not row_groups:
+        return
+
+    read_columns = columns
+    if columns is not None and bbox_column not in columns:
+        read_columns = [*columns, bbox_column]
+
+    parquet_file = pq.ParquetFile(parquet_path)
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_size, row_groups=row_groups, columns=read_columns
+    ):
+        batch = batch.filter(bbox_mask(batch, bbox, bbox_column))
+        if columns is not None and bbox_column not in columns:
+            batch = batch.drop_columns([bbox_column])
+        if batch.num_rows > 0:
+            yield batch
@@ -1,104 +1,245 @@
 # External
-import geoparquet_io as gpio
-from geoparquet_io.core.add_bbox_column import add_bbox_column
-from geoparquet_io.core.hilbert_order import hilbert_order
-from geoparquet_io.core.partition_by_h3 import partition_by_h3
-from geoparquet_io.core.check_parquet_structure import check_all
+import logging
+import os
+import shutil
 from pathlib import Path
-import geopandas as gpd
-import h3
-from shapely.geometry import mapping
+from typing import Annotated, Dict, List, Tuple
+
+import typer
+from tqdm.contrib.logging import logging_redirect_tqdm
 
 # Internal
-from main import gpkg_to_parquet_geopandas, gpkg_to_parquet_gpio
-
-def partition_gpkg_by_country_h3(gpkg_path : Path,
-                              resolution : int):
-    
-    # Read the GeoPackage
-    gdf = gpd.read_file(gpkg_path)
-
-    # Convert to WGS84 if not already
-    if gdf.crs.to_epsg() != 4326:
-        gdf = gdf.to_crs(epsg=4326)
-        print("Converted GeoDataFrame to WGS84 (EPSG:4326)")
-    
-    # Save to parquet for gpio workflow
-    gdf.to_parquet(PATH_PQ)
-
-    # Hilbert-order, h3
+from gpkg_cache import GpkgCache, open_gpkg
+from job_pool import GB, Job, JobCost, ResourceBudget, default_workers, run_jobs
+from utils import init_db_con, load_h3
+
+app = typer.Typer()
+
+H3_COLUMN = "h3_cell"
+BBOX_COLUMN = "bbox"
+
+
+def _source_layer(con, input_path: Path) -> Tuple[str, str]:
+    """Return the geometry column and the CRS ('AUTH:CODE') of the first layer."""
+    row = con.execute(
+        """
+        SELECT
+            layers[1].geometry_fields[1].name,
+            layers[1].geometry_fields[1].crs.auth_name,
+            layers[1].geometry_fields[1].crs.auth_code
+        FROM st_read_meta($input_path)
+        """,
+        {"input_path": str(input_path)},
+    ).fetchone()
+    if row is None or row[1] is None:
+        raise RuntimeError(f"Could not find the CRS of {input_path}.")
+    geom_column, auth_name, auth_code = row
+    return geom_column, f"{auth_name}:{auth_code}"
+
+
+def partition_gpkg_by_country_h3(
+    gpkg_path: Path,
+    output_dir: Path,
+    resolution: int,
+    memory_limit: float = 4,
+    threads: int | None = None,
+    overwrite: bool = False,
+    cache: GpkgCache | None = None,
+) -> Tuple[Path, bool]:
     """
-    __ = gpio.read(PATH_PQ) \
-        .add_bbox() \
-        .sort_hilbert() \
-        .add_h3(resolution = resolution, column_name= f"h3_res{resolution}") \
-        .write(PATH_PQ)
-"""
-
-    # Hilbert-order, h3, partition
-    __ = gpio.read(PATH_PQ) \
-        .add_bbox() \
-        .partition_by_h3(output_dir = OUT_DIR, resolution = resolution)
-
-
-    # Partition
-
+    Partition the buildings of a GeoPackage by the H3 cell of their centroid, into a
+    hive-partitioned GeoParquet dataset `output_dir/h3_cell=<cell>/`.
+
+    The features are streamed through DuckDB, which reprojects them to EPSG:4326 and
+    spills to disk beyond `memory_limit` GB, so the country never has to fit in memory.
+    Each row also gets a `bbox` struct column to filter on without reading geometries.
+    With a cache, the extracted GeoPackage is read instead of the zip.
+    Returns (output_dir, success_flag).
+    """
+    if output_dir.exists() and not overwrite:
+        logging.info(f"Skipping {output_dir} which already exists.")
+        return output_dir, True
+
+    # Write next to the final directory so that a failed run leaves nothing behind
+    tmp_dir = output_dir.with_name(output_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    con = init_db_con(read_only=False)
+    try:
+        load_h3(con)
+        con.execute(f"SET memory_limit = '{memory_limit}GB';")
+        con.execute(f"SET threads = {threads or default_workers()};")
+        con.execute(f"SET temp_directory = '{tmp_dir}_spill';")
+        con.execute("SET preserve_insertion_order = false;")
+
+        with open_gpkg(gpkg_path, cache) as source_path:
+            geom_column, source_crs = _source_layer(con, source_path)
+            logging.info(
+                f"Partitioning {gpkg_path} ({source_crs}) into {output_dir}..."
+            )
+            con.execute(
+                f"""
+                COPY (
+                    WITH reprojected AS (
+                        SELECT * EXCLUDE ("{geom_column}"),
+                        ST_Transform("{geom_column}", $source_crs, 'EPSG:4326', true) AS geometry
+                        FROM st_read($input_path)
+                    ),
+                    with_centroid AS (
+                        SELECT *, ST_Centroid(geometry) AS centroid
+                        FROM reprojected
+                    )
+                    SELECT * EXCLUDE (centroid),
+                    h3_latlng_to_cell_string(
+                        ST_Y(centroid), ST_X(centroid), $resolution
+                    ) AS {H3_COLUMN},
+                    struct_pack(
+                        xmin := ST_XMin(geometry),
+                        ymin := ST_YMin(geometry),
+                        xmax := ST_XMax(geometry),
+                        ymax := ST_YMax(geometry)
+                    ) AS {BBOX_COLUMN}
+                    FROM with_centroid
+                )
+                TO $output_dir
+                (FORMAT parquet, PARTITION_BY ({H3_COLUMN}), WRITE_PARTITION_COLUMNS true,
+                COMPRESSION zstd, ROW_GROUP_SIZE 100_000);
+                """,
+                {
+                    "input_path": str(source_path),
+                    "output_dir": str(tmp_dir),
+                    "source_crs": source_crs,
+                    "resolution": resolution,
+                },
+            )
+
+        if output_dir.exists():
+            shutil.rmtree(output_dir)
+        os.replace(tmp_dir, output_dir)
+
+    except Exception as exc:
+        logging.error(f"Partitioning {gpkg_path.name} → {exc}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return output_dir, False
+
+    finally:
+        con.close()
+        shutil.rmtree(f"{tmp_dir}_spill", ignore_errors=True)
+
+    return output_dir, True
+
+
+def partition_countries_h3(
+    gpkg_paths: Dict[str, Path],
+    output_dir: Path,
+    resolution: int,
+    memory_limit: float = 4,
+    max_workers: int | None = None,
+    overwrite: bool = False,
+    budget: ResourceBudget | None = None,
+    cache: GpkgCache | None = None,
+) -> List[Tuple[Path, bool]]:
+    """
+    Partition the GeoPackages of several countries in parallel into
+    `output_dir/country=<code>/h3_cell=<cell>/`. Each country gets `memory_limit` GB
+    and its share of the cores, and is admitted against the RAM/disk budget.
+    """
+    workers = max_workers or max(1, default_workers() // 4)
+    threads = max(1, default_workers() // workers)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    jobs = []
+    for code, gpkg_path in gpkg_paths.items():
+        size = gpkg_path.stat().st_size
+        jobs.append(
+            Job(
+                func=partition_gpkg_by_country_h3,
+                args=(
+                    gpkg_path,
+                    output_dir / f"country={code}",
+                    resolution,
+                    memory_limit,
+                    threads,
+                    overwrite,
+                    cache,
+                ),
+                # The GeoPackages are zipped, the Parquet output is about as large
+                # as the unzipped file, plus what DuckDB spills to disk
+                cost=JobCost(memory=int(memory_limit * GB), disk=8 * size, size=size),
+            )
+        )
+    return run_jobs(jobs, budget=budget, max_workers=workers)
+
+
+@app.command("partition_h3")
+def partition_h3(
+    data_dir: Annotated[
+        Path,
+        typer.Option(
+            "-d", "--data_dir", help="Main directory of the data.", exists=True
+        ),
+    ],
+    country_codes: Annotated[
+        List[str] | None,
+        typer.Option(
+            "-c",
+            "--country_code",
+            help="Codes of the countries to process (default: all downloaded ones).",
+        ),
+    ] = None,
+    resolution: Annotated[
+        int, typer.Option("-r", "--resolution", help="H3 resolution of the partitions.")
+    ] = 4,
+    memory_limit: Annotated[
+        float,
+        typer.Option(
+            "--memory_limit", help="Memory in GB that DuckDB can use per country."
+        ),
+    ] = 4,
+    jobs: Annotated[
+        int | None,
+        typer.Option("--jobs", help="Number of countries partitioned in parallel."),
+    ] = None,
+    overwrite: Annotated[
+        bool, typer.Option("--overwrite", help="Partition again existing countries.")
+    ] = False,
+    gpkg_cache_size: Annotated[
+        float | None,
+        typer.Option(
+            "--gpkg_cache",
+            help="Size in GB of a cache of extracted GeoPackages (default: read the zips).",
+        ),
+    ] = None,
+):
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    gpkg_dir = data_dir / "buildings" / "gpkg"
+    gpkg_paths = {
+        path.name.removesuffix(".gpkg.zip"): path
+        for path in sorted(gpkg_dir.glob("*.gpkg.zip"))
+    }
+    if country_codes is not None:
+        gpkg_paths = {code: gpkg_paths[code] for code in country_codes}
+
+    gpkg_cache = None
+    if gpkg_cache_size is not None:
+        gpkg_cache = GpkgCache(data_dir / "cache" / "gpkg", int(gpkg_cache_size * GB))
+
+    with logging_redirect_tqdm():
+        results = partition_countries_h3(
+            gpkg_paths,
+            data_dir / "partition" / f"h3_res{resolution}",
+            resolution,
+            memory_limit=memory_limit,
+            max_workers=jobs,
+            overwrite=overwrite,
+            cache=gpkg_cache,
+        )
+    if gpkg_cache is not None:
+        typer.echo(gpkg_cache.stats().format())
+    if not all(ok for _, ok in results):
+        raise typer.Exit(code=1)
 
 
 if __name__ == "__main__":
-    DATA_DIR = Path("..", "data") # Home data mount
-    IN_DIR = DATA_DIR / "gpkg" # Folder with all gpkg
-    OUT_DIR = DATA_DIR / "partition" / "parquet-h3" # One partition location
-    
-    
-    SAMPLE_FILE = IN_DIR / "v0_1-CYP.gpkg"
-    PATH_PQ = Path("..", "data", "parquet", "cyprus.parquet")
-
-    # Call to partitioning
-    partition_gpkg_by_country_h3(gpkg_path = SAMPLE_FILE, resolution = 4)
-
-
-    # Read with gpd
-    #f = gpd.read_parquet(PATH_PQ)
-    #print(f)
-
-    #print(f" Number of unique h3: {set(f["h3_res4"])}")
-
-
-
-
-"""
-    # Pathlib does not work with check_parquet_structure
-    man_path = "/Users/carlocordes/Library/CloudStorage/OneDrive-Personal/MSc_Carlo/5019_Studio/EUBUCCO-Dissemination/data/parquet/cyprus.parquet"
-
-    # Convert
-    gpkg_to_parquet_gpio(PATH_GPKG, PATH_PQ)
-
-
-    # Sort by Hilbert curve
-    hilbert_order(
-        input_parquet=man_path,
-        output_parquet=man_path,
-        geometry_column="geometry",
-        verbose=True
-    )
-
-    partition_by_h3(
-        input_parquet=man_path,
-        output_folder="output/partition",
-        resolution=2,
-        hive=False,
-        verbose=True,
-        force = True
-    )
-    check_all(man_path)
-
-# Partition by H3
-partition_by_h3(
-    input_parquet="input.parquet",
-    output_folder="output/",
-    resolution=9,
-    hive=False,
-    verbose=True
-)
-"""
\ No newline at end of file
+    app()
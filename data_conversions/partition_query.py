@@ -0,0 +1,269 @@
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import h3
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import box, mapping
+
+from parquet_index import (
+    BBOX_COLUMN,
+    BBox,
+    bbox_mask,
+    geometry_column,
+    row_group_bboxes,
+)
+from partition import H3_COLUMN
+
+# Buildings are assigned to the cell of their centroid, so the query is grown by about
+# the size of a large building to also find those whose centroid is just outside
+DEFAULT_MARGIN = 0.002
+
+
+@dataclass
+class AttributeFilter:
+    """Filters on the attributes of the buildings, None meaning no bound."""
+
+    min_height: float | None = None
+    max_height: float | None = None
+    min_age: float | None = None
+    max_age: float | None = None
+    types: List[str] | None = None
+
+    def expression(self) -> ds.Expression | None:
+        conditions = []
+        if self.min_height is not None:
+            conditions.append(pc.field("height") >= self.min_height)
+        if self.max_height is not None:
+            conditions.append(pc.field("height") <= self.max_height)
+        if self.min_age is not None:
+            conditions.append(pc.field("age") >= self.min_age)
+        if self.max_age is not None:
+            conditions.append(pc.field("age") <= self.max_age)
+        if self.types is not None:
+            conditions.append(pc.field("type").isin(self.types))
+        if not conditions:
+            return None
+        expression = conditions[0]
+        for condition in conditions[1:]:
+            expression = expression & condition
+        return expression
+
+    def columns(self) -> List[str]:
+        columns = []
+        if self.min_height is not None or self.max_height is not None:
+            columns.append("height")
+        if self.min_age is not None or self.max_age is not None:
+            columns.append("age")
+        if self.types is not None:
+            columns.append("type")
+        return columns
+
+    def ranges(self) -> Dict[str, Tuple[float | None, float | None]]:
+        """Numeric ranges, used to prune row groups with the column statistics."""
+        ranges = {}
+        if self.min_height is not None or self.max_height is not None:
+            ranges["height"] = (self.min_height, self.max_height)
+        if self.min_age is not None or self.max_age is not None:
+            ranges["age"] = (self.min_age, self.max_age)
+        return ranges
+
+
+@dataclass
+class ScanStats:
+    files: int = 0
+    row_groups_total: int = 0
+    row_groups_read: int = 0
+    bytes_read: int = 0
+    rows_read: int = 0
+    rows_matched: int = 0
+    partitions: List[str] = field(default_factory=list)
+
+
+def _outside_ranges(
+    row_group: pq.RowGroupMetaData,
+    columns: Dict[str, int],
+    ranges: Dict[str, Tuple[float | None, float | None]],
+) -> bool:
+    """Check if the statistics of the row group prove that no row is in the ranges."""
+    for name, (low, high) in ranges.items():
+        if name not in columns:
+            continue
+        stats = row_group.column(columns[name]).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        if (low is not None and stats.max < low) or (
+            high is not None and stats.min > high
+        ):
+            return True
+    return False
+
+
+def _selected_row_groups(
+    metadata: pq.FileMetaData,
+    bbox: BBox | None,
+    ranges: Dict[str, Tuple[float | None, float | None]],
+) -> List[int]:
+    row_groups = list(range(metadata.num_row_groups))
+    if bbox is not None:
+        bboxes = row_group_bboxes(metadata)
+        if bboxes is not None:
+            row_groups = [rg.row_group for rg in bboxes if rg.intersects(bbox)]
+    if ranges:
+        columns = {
+            metadata.schema.column(i).path: i for i in range(len(metadata.schema))
+        }
+        row_groups = [
+            i
+            for i in row_groups
+            if not _outside_ranges(metadata.row_group(i), columns, ranges)
+        ]
+    return row_groups
+
+
+def _bytes_read(
+    metadata: pq.FileMetaData, row_groups: List[int], columns: List[str] | None
+) -> int:
+    total = 0
+    for i in row_groups:
+        row_group = metadata.row_group(i)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            if columns is None or column.path_in_schema.split(".")[0] in columns:
+                total += column.total_compressed_size
+    return total
+
+
+def scan_parquet_files(
+    paths: Iterable[Path],
+    bbox: BBox | None = None,
+    polygon: shapely.Geometry | None = None,
+    filters: AttributeFilter | None = None,
+    columns: List[str] | None = None,
+    stats: ScanStats | None = None,
+    batch_size: int = 65_536,
+) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the rows of Parquet files that intersect `bbox` (or `polygon`) and match
+    the attribute filters. Row groups are skipped using the statistics of the bbox
+    covering column and of the filtered attributes, rows using the bbox column and the
+    filters, and with a polygon the geometries are finally tested exactly.
+    `stats` is filled with what was actually read.
+    """
+    stats = stats if stats is not None else ScanStats()
+    if polygon is not None:
+        shapely.prepare(polygon)
+        if bbox is None:
+            bbox = polygon.bounds
+    filters = filters or AttributeFilter()
+    expression = filters.expression()
+    ranges = filters.ranges()
+
+    extra = [BBOX_COLUMN] if bbox is not None else []
+    extra.extend(filters.columns())
+
+    for path in paths:
+        parquet_file = pq.ParquetFile(path)
+        metadata = parquet_file.metadata
+        geometry = geometry_column(metadata)
+        row_groups = _selected_row_groups(metadata, bbox, ranges)
+        stats.files += 1
+        stats.row_groups_total += metadata.num_row_groups
+        stats.row_groups_read += len(row_groups)
+        if not row_groups:
+            continue
+
+        names = set(parquet_file.schema_arrow.names)
+        file_columns = None
+        if columns is not None:
+            needed = [*extra, geometry] if polygon is not None else extra
+            file_columns = [
+                c
+                for c in [*columns, *(c for c in needed if c not in columns)]
+                if c in names
+            ]
+        stats.bytes_read += _bytes_read(metadata, row_groups, file_columns)
+
+        for batch in parquet_file.iter_batches(
+            batch_size=batch_size, row_groups=row_groups, columns=file_columns
+        ):
+            stats.rows_read += batch.num_rows
+            if bbox is not None and BBOX_COLUMN in batch.schema.names:
+                batch = batch.filter(bbox_mask(batch, bbox))
+            if expression is not None and batch.num_rows > 0:
+                batch = batch.filter(expression)
+            if polygon is not None and batch.num_rows > 0:
+                geometries = shapely.from_wkb(batch.column(geometry))
+                batch = batch.filter(pa.array(shapely.intersects(polygon, geometries)))
+            if columns is not None:
+                batch = batch.select([c for c in columns if c in batch.schema.names])
+            if batch.num_rows > 0:
+                stats.rows_matched += batch.num_rows
+                yield batch
+
+
+class PartitionedDataset:
+    """
+    Dataset written by `partition.py`, laid out as
+    `<root>/country=<code>/h3_cell=<cell>/*.parquet`.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.partitions: Dict[str, List[Path]] = {}
+        for cell_dir in root.glob(f"*/{H3_COLUMN}=*"):
+            cell = cell_dir.name.split("=", 1)[1]
+            self.partitions.setdefault(cell, []).extend(
+                sorted(cell_dir.glob("*.parquet"))
+            )
+        if not self.partitions:
+            raise ValueError(f"No H3 partition found in {root}.")
+        self.resolution = h3.get_resolution(next(iter(self.partitions)))
+
+    def cells(
+        self, geometry: shapely.Geometry, margin: float = DEFAULT_MARGIN
+    ) -> List[str]:
+        """H3 cells of the partitions that can contain buildings intersecting `geometry`."""
+        if margin > 0:
+            geometry = geometry.buffer(margin, join_style="mitre")
+        shape = h3.geo_to_h3shape(mapping(geometry))
+        cells = h3.h3shape_to_cells_experimental(
+            shape, self.resolution, contain="overlap"
+        )
+        return sorted(cell for cell in cells if cell in self.partitions)
+
+    def query(
+        self,
+        bbox: BBox | None = None,
+        polygon: shapely.Geometry | None = None,
+        filters: AttributeFilter | None = None,
+        columns: List[str] | None = None,
+        stats: ScanStats | None = None,
+        batch_size: int = 65_536,
+    ) -> Iterator[pa.RecordBatch]:
+        """
+        Stream the buildings intersecting `bbox` or `polygon` (in EPSG:4326) and
+        matching the attribute filters, reading only the partitions of the H3 cells
+        that cover the query and the row groups that intersect it.
+        """
+        if bbox is None and polygon is None:
+            raise ValueError("A bbox or a polygon is needed to query the dataset.")
+        stats = stats if stats is not None else ScanStats()
+        cells = self.cells(polygon if polygon is not None else box(*bbox))
+        stats.partitions = cells
+        logging.debug(f"Querying {len(cells)}/{len(self.partitions)} partitions.")
+        paths = [path for cell in cells for path in self.partitions[cell]]
+        yield from scan_parquet_files(
+            paths,
+            bbox=bbox,
+            polygon=polygon,
+            filters=filters,
+            columns=columns,
+            stats=stats,
+            batch_size=batch_size,
+        )
@@ -0,0 +1,570 @@
+# External
+import csv
+import logging
+from pathlib import Path
+from typing import Annotated, Dict, List, Tuple
+
+import numpy as np
+import pyogrio
+import typer
+from pydantic import BaseModel, computed_field
+from tqdm import tqdm
+
+# Internal
+from pmtiles_archive import (
+    Entries,
+    PMTilesReader,
+    TileType,
+    decompress,
+    iter_fields,
+    tileid_to_zxy,
+)
+
+app = typer.Typer()
+
+# Upper bounds of the buckets of compressed tile sizes. 500 KB is the default limit of
+# tippecanoe, beyond which it drops or coalesces features
+SIZE_BUCKETS = [1_024, 4_096, 16_384, 65_536, 131_072, 262_144, 500_000, 1_048_576]
+SIZE_BUCKET_LABELS = ["1K", "4K", "16K", "64K", "128K", "256K", "500K", "1M", ">1M"]
+MAX_ZOOM = 31
+# First tile ID of every zoom
+ZOOM_STARTS = np.array([((1 << (2 * z)) - 1) // 3 for z in range(MAX_ZOOM + 2)])
+DEFAULT_TOP = 20
+DEFAULT_LAYER_SAMPLE = 200
+
+
+class ZoomReport(BaseModel):
+    zoom: int
+    # Tiles addressed by the directories, and entries pointing to their data
+    tiles: int
+    entries: int
+    # Compressed sizes, with each addressed tile counted
+    bytes: int
+    mean: float
+    p50: float
+    p90: float
+    p99: float
+    max: int
+    # Number of tiles per bucket of SIZE_BUCKETS
+    histogram: List[int]
+    decoded_tiles: int = 0
+    # Features in the decoded tiles. The features that cross tile edges are counted in
+    # every tile, unique_features counts their IDs when all of them have one
+    features: int | None = None
+    unique_features: int | None = None
+    # Fraction of the features of the source kept at this zoom
+    kept: float | None = None
+
+
+class HeavyTile(BaseModel):
+    z: int
+    x: int
+    y: int
+    # Centre of the tile
+    lon: float
+    lat: float
+    bytes: int
+    features: int | None = None
+
+
+class LayerReport(BaseModel):
+    """Uncompressed bytes of a layer in a sample of the tiles of a zoom."""
+
+    layer: str
+    zoom: int
+    tiles: int
+    features: int
+    bytes: int
+    geometry_bytes: int
+    # Tags of the features, and keys and values tables of the layer
+    attribute_bytes: int
+
+    @computed_field
+    @property
+    def attribute_share(self) -> float:
+        return self.attribute_bytes / self.bytes if self.bytes else 0.0
+
+
+class ArchiveReport(BaseModel):
+    path: str
+    bytes: int
+    tile_type: str
+    min_zoom: int
+    max_zoom: int
+    addressed_tiles: int
+    tile_entries: int
+    tile_contents: int
+    directory_bytes: int
+    metadata_bytes: int
+    source_features: int | None = None
+    zooms: List[ZoomReport] = []
+    heaviest: List[HeavyTile] = []
+    layers: List[LayerReport] = []
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(self.model_dump_json(indent=2))
+
+
+def tile_xy(zoom: int, tile_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized x and y of tile IDs of `zoom`, as `tileid_to_zxy`."""
+    t = tile_ids.astype(np.int64) - ZOOM_STARTS[zoom]
+    x = np.zeros_like(t)
+    y = np.zeros_like(t)
+    s = 1
+    while s < (1 << zoom):
+        rx = 1 & (t // 2)
+        ry = 1 & (t ^ rx)
+        flip = (ry == 0) & (rx == 1)
+        x = np.where(flip, s - 1 - x, x)
+        y = np.where(flip, s - 1 - y, y)
+        swap = ry == 0
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        x += s * rx
+        y += s * ry
+        t //= 4
+        s *= 2
+    return x, y
+
+
+def tile_centre(zoom: int, x, y) -> Tuple[np.ndarray, np.ndarray]:
+    """Longitude and latitude of the centre of tiles."""
+    n = 2**zoom
+    lon = (np.asarray(x) + 0.5) / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (np.asarray(y) + 0.5) / n))))
+    return lon, lat
+
+
+def zoom_overlaps(entries: Entries, zoom: int) -> np.ndarray:
+    """Number of the tiles of every entry, and of its run, that are in `zoom`."""
+    starts = entries.tile_ids.astype(np.int64)
+    ends = starts + entries.run_lengths.astype(np.int64)
+    return np.clip(
+        np.minimum(ends, ZOOM_STARTS[zoom + 1]) - np.maximum(starts, ZOOM_STARTS[zoom]),
+        0,
+        None,
+    )
+
+
+def _weighted_quantile(values: np.ndarray, weights: np.ndarray, q: float) -> float:
+    order = np.argsort(values)
+    cumulative = np.cumsum(weights[order])
+    return float(values[order][np.searchsorted(cumulative, q * cumulative[-1])])
+
+
+def zoom_report(entries: Entries, zoom: int) -> ZoomReport | None:
+    overlaps = zoom_overlaps(entries, zoom)
+    in_zoom = overlaps > 0
+    if not in_zoom.any():
+        return None
+    sizes = entries.lengths[in_zoom].astype(np.int64)
+    weights = overlaps[in_zoom]
+    buckets = np.searchsorted(SIZE_BUCKETS, sizes, side="left")
+    histogram = np.bincount(buckets, weights=weights, minlength=len(SIZE_BUCKETS) + 1)
+    tiles = int(weights.sum())
+    total = int((sizes * weights).sum())
+    return ZoomReport(
+        zoom=zoom,
+        tiles=tiles,
+        entries=int(in_zoom.sum()),
+        bytes=total,
+        mean=total / tiles,
+        p50=_weighted_quantile(sizes, weights, 0.5),
+        p90=_weighted_quantile(sizes, weights, 0.9),
+        p99=_weighted_quantile(sizes, weights, 0.99),
+        max=int(sizes.max()),
+        histogram=histogram.astype(np.int64).tolist(),
+    )
+
+
+def _layer_name(layer: memoryview) -> str:
+    for number, _, value, _ in iter_fields(layer):
+        if number == 1:
+            return bytes(value).decode()
+    return ""
+
+
+def count_features(tile: bytes) -> Dict[str, int]:
+    """Number of features of every layer of a decompressed vector tile."""
+    counts: Dict[str, int] = {}
+    for number, _, layer, _ in iter_fields(tile):
+        if number != 3:
+            continue
+        features = sum(1 for field, *_ in iter_fields(layer) if field == 2)
+        name = _layer_name(layer)
+        counts[name] = counts.get(name, 0) + features
+    return counts
+
+
+def parse_layers(
+    tile: bytes, ids: set | None = None
+) -> Dict[str, Tuple[int, int, int, int, bool]]:
+    """
+    Features, bytes, geometry bytes and attribute bytes of every layer of a
+    decompressed vector tile, and whether all its features have an ID, which are added
+    to `ids`.
+    """
+    layers = {}
+    for number, _, layer, _ in iter_fields(tile):
+        if number != 3:
+            continue
+        name = ""
+        features = geometry_bytes = attribute_bytes = 0
+        all_ids = True
+        for layer_number, _, value, raw in iter_fields(layer):
+            if layer_number == 1:
+                name = bytes(value).decode()
+            elif layer_number in (3, 4):
+                attribute_bytes += len(raw)
+            elif layer_number == 2:
+                features += 1
+                has_id = False
+                for feature_number, _, feature_value, feature_raw in iter_fields(value):
+                    if feature_number == 1:
+                        has_id = True
+                        if ids is not None:
+                            ids.add(feature_value)
+                    elif feature_number == 2:
+                        attribute_bytes += len(feature_raw)
+                    elif feature_number == 4:
+                        geometry_bytes += len(feature_raw)
+                all_ids &= has_id
+        layers[name] = (features, len(layer), geometry_bytes, attribute_bytes, all_ids)
+    return layers
+
+
+def source_features(paths: List[Path]) -> int:
+    """Number of features in all the layers of the source files."""
+    total = 0
+    for path in paths:
+        for layer in pyogrio.list_layers(path)[:, 0]:
+            total += pyogrio.read_info(path, layer=layer)["features"]
+    return total
+
+
+def tilestats_features(metadata: Dict) -> int | None:
+    """Number of features of the input of tippecanoe, which it writes as tilestats."""
+    layers = metadata.get("tilestats", {}).get("layers")
+    if not layers:
+        return None
+    return sum(layer.get("count", 0) for layer in layers)
+
+
+def analyze(
+    path: Path,
+    source_paths: List[Path] | None = None,
+    top: int = DEFAULT_TOP,
+    layer_sample: int = DEFAULT_LAYER_SAMPLE,
+    decode_zooms: List[int] | None = None,
+) -> Tuple[ArchiveReport, Entries, np.ndarray]:
+    """
+    Analyze the directories of an archive and decode its tiles: all those of
+    `decode_zooms` (default: all the zooms) to count their features, and a sample of
+    `layer_sample` tiles per zoom, with the heaviest ones, to split the bytes of their
+    layers. The features of the max zoom are compared to those of the source files, or
+    to the tilestats of tippecanoe in the metadata.
+    Returns the report, the entries and the number of features of every entry, -1 if
+    it was not decoded.
+    """
+    reader = PMTilesReader.open(path)
+    try:
+        h = reader.header
+        entries = reader.entries()
+        metadata = reader.metadata()
+        report = ArchiveReport(
+            path=str(path),
+            bytes=path.stat().st_size,
+            tile_type=TileType(h.tile_type).name,
+            min_zoom=h.min_zoom,
+            max_zoom=h.max_zoom,
+            addressed_tiles=int(entries.run_lengths.sum()),
+            tile_entries=len(entries),
+            tile_contents=len(np.unique(entries.offsets)),
+            directory_bytes=h.root_length + h.leaf_directory_length,
+            metadata_bytes=h.metadata_length,
+        )
+        if source_paths:
+            report.source_features = source_features(source_paths)
+        else:
+            report.source_features = tilestats_features(metadata)
+
+        zooms = {}
+        for zoom in range(h.min_zoom, h.max_zoom + 1):
+            zoom_stats = zoom_report(entries, zoom)
+            if zoom_stats is not None:
+                zooms[zoom] = zoom_stats
+        report.zooms = list(zooms.values())
+
+        entry_zooms = np.searchsorted(ZOOM_STARTS, entries.tile_ids, side="right") - 1
+        heaviest = np.argsort(entries.lengths)[::-1][:top]
+        sampled = set(heaviest.tolist())
+        for zoom in zooms:
+            indices = np.flatnonzero(entry_zooms == zoom)
+            if len(indices) > 0:
+                picks = np.linspace(
+                    0, len(indices) - 1, min(layer_sample, len(indices))
+                )
+                sampled.update(indices[picks.astype(np.int64)].tolist())
+
+        features = np.full(len(entries), -1, dtype=np.int64)
+        if h.tile_type != TileType.Mvt:
+            logging.warning(f"{path} does not hold vector tiles, they are not decoded.")
+        else:
+            decode = np.isin(
+                entry_zooms, decode_zooms if decode_zooms is not None else list(zooms)
+            )
+            decode[list(sampled)] = True
+            layers: Dict[Tuple[str, int], LayerReport] = {}
+            ids: set = set()
+            all_ids = True
+            for i in tqdm(np.flatnonzero(decode), desc="Decoding tiles", unit="tile"):
+                zoom = int(entry_zooms[i])
+                tile = decompress(
+                    reader.tile_data(int(entries.offsets[i]), int(entries.lengths[i])),
+                    h.tile_compression,
+                )
+                if i not in sampled and zoom != h.max_zoom:
+                    features[i] = sum(count_features(tile).values())
+                    continue
+                parsed = parse_layers(tile, ids if zoom == h.max_zoom else None)
+                features[i] = sum(p[0] for p in parsed.values())
+                if zoom == h.max_zoom:
+                    all_ids &= all(p[4] for p in parsed.values())
+                if i not in sampled:
+                    continue
+                for name, (count, size, geometry, attributes, _) in parsed.items():
+                    layer = layers.setdefault(
+                        (name, zoom),
+                        LayerReport(
+                            layer=name,
+                            zoom=zoom,
+                            tiles=0,
+                            features=0,
+                            bytes=0,
+                            geometry_bytes=0,
+                            attribute_bytes=0,
+                        ),
+                    )
+                    layer.tiles += 1
+                    layer.features += count
+                    layer.bytes += size
+                    layer.geometry_bytes += geometry
+                    layer.attribute_bytes += attributes
+            report.layers = sorted(layers.values(), key=lambda r: (r.layer, r.zoom))
+
+            for zoom, zoom_stats in zooms.items():
+                overlaps = zoom_overlaps(entries, zoom)
+                decoded = (overlaps > 0) & (features >= 0)
+                zoom_stats.decoded_tiles = int(overlaps[decoded].sum())
+                if zoom_stats.decoded_tiles < zoom_stats.tiles:
+                    # Only a sample of the zoom was decoded
+                    continue
+                zoom_stats.features = int((features[decoded] * overlaps[decoded]).sum())
+                if zoom == h.max_zoom and all_ids and ids:
+                    zoom_stats.unique_features = len(ids)
+                if report.source_features:
+                    kept = zoom_stats.unique_features or zoom_stats.features
+                    zoom_stats.kept = kept / report.source_features
+
+        for i in heaviest:
+            z, x, y = tileid_to_zxy(int(entries.tile_ids[i]))
+            lon, lat = tile_centre(z, x, y)
+            report.heaviest.append(
+                HeavyTile(
+                    z=z,
+                    x=x,
+                    y=y,
+                    lon=float(lon),
+                    lat=float(lat),
+                    bytes=int(entries.lengths[i]),
+                    features=int(features[i]) if features[i] >= 0 else None,
+                )
+            )
+        return report, entries, features
+    finally:
+        reader.close()
+
+
+def write_heatmap(path: Path, entries: Entries, features: np.ndarray, zoom: int):
+    """
+    Write a CSV of every tile of `zoom` with its centre, compressed size and features
+    (empty if it was not decoded), to be loaded as a heatmap.
+    """
+    overlaps = zoom_overlaps(entries, zoom)
+    in_zoom = np.flatnonzero(overlaps > 0)
+    # Every tile of the runs, which all share the data of their entry
+    first = np.maximum(entries.tile_ids[in_zoom].astype(np.int64), ZOOM_STARTS[zoom])
+    counts = overlaps[in_zoom]
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    tile_ids = np.repeat(first, counts) + offsets
+    indices = np.repeat(in_zoom, counts)
+    x, y = tile_xy(zoom, tile_ids)
+    lon, lat = tile_centre(zoom, x, y)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["z", "x", "y", "lon", "lat", "bytes", "features"])
+        for i in range(len(tile_ids)):
+            entry = indices[i]
+            writer.writerow(
+                [
+                    zoom,
+                    x[i],
+                    y[i],
+                    f"{lon[i]:.6f}",
+                    f"{lat[i]:.6f}",
+                    entries.lengths[entry],
+                    features[entry] if features[entry] >= 0 else "",
+                ]
+            )
+    tmp_path.replace(path)
+
+
+def _size(value: float) -> str:
+    for unit in ["B", "KB", "MB"]:
+        if value < 1024:
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GB"
+
+
+def format_report(report: ArchiveReport) -> str:
+    lines = [
+        f"{report.path}: {_size(report.bytes)}, {report.tile_type}, "
+        f"zooms {report.min_zoom}-{report.max_zoom}",
+        f"{report.addressed_tiles} tiles in {report.tile_entries} entries, "
+        f"{report.tile_contents} distinct contents, "
+        f"directories {_size(report.directory_bytes)}, "
+        f"metadata {_size(report.metadata_bytes)}",
+    ]
+    if report.source_features is not None:
+        lines.append(f"{report.source_features} features in the source")
+
+    lines += [
+        "",
+        f"{'z':>3}{'tiles':>10}{'total':>11}{'mean':>10}{'p50':>10}{'p90':>10}"
+        f"{'p99':>10}{'max':>10}{'features':>12}{'kept':>8}",
+    ]
+    for z in report.zooms:
+        features = (
+            f"{z.unique_features or z.features:>12}"
+            if z.features is not None
+            else f"{'':>12}"
+        )
+        kept = f"{z.kept:>8.1%}" if z.kept is not None else f"{'':>8}"
+        lines.append(
+            f"{z.zoom:>3}{z.tiles:>10}{_size(z.bytes):>11}{_size(z.mean):>10}"
+            f"{_size(z.p50):>10}{_size(z.p90):>10}{_size(z.p99):>10}"
+            f"{_size(z.max):>10}{features}{kept}"
+        )
+
+    lines += [
+        "",
+        "Tiles by compressed size:",
+        f"{'z':>3}"
+        + "".join(f"{f'≤{label}':>8}" for label in SIZE_BUCKET_LABELS[:-1])
+        + f"{SIZE_BUCKET_LABELS[-1]:>8}",
+    ]
+    for z in report.zooms:
+        lines.append(f"{z.zoom:>3}" + "".join(f"{count:>8}" for count in z.histogram))
+
+    lines += [
+        "",
+        "Heaviest tiles:",
+        f"{'z/x/y':<20}{'lon':>11}{'lat':>10}{'size':>10}{'features':>10}",
+    ]
+    for t in report.heaviest:
+        features = f"{t.features:>10}" if t.features is not None else f"{'':>10}"
+        lines.append(
+            f"{f'{t.z}/{t.x}/{t.y}':<20}{t.lon:>11.4f}{t.lat:>10.4f}"
+            f"{_size(t.bytes):>10}{features}"
+        )
+
+    if report.layers:
+        lines += [
+            "",
+            "Layers, in a sample of the tiles (uncompressed):",
+            f"{'layer':<20}{'z':>3}{'tiles':>7}{'features':>10}{'bytes':>11}"
+            f"{'geometry':>10}{'attributes':>12}",
+        ]
+        for layer in report.layers:
+            lines.append(
+                f"{layer.layer:<20}{layer.zoom:>3}{layer.tiles:>7}{layer.features:>10}"
+                f"{_size(layer.bytes):>11}"
+                f"{layer.geometry_bytes / max(layer.bytes, 1):>10.1%}"
+                f"{layer.attribute_share:>12.1%}"
+            )
+    return "\n".join(lines)
+
+
+@app.command("analyze")
+def analyze_command(
+    input_path: Annotated[
+        Path,
+        typer.Option("-i", "--input", help="PMTiles archive to analyze.", exists=True),
+    ],
+    source_paths: Annotated[
+        List[Path] | None,
+        typer.Option(
+            "-s",
+            "--source",
+            help="Files the archive was made from, to count the dropped features "
+            "(default: the tilestats of the metadata).",
+            exists=True,
+        ),
+    ] = None,
+    output: Annotated[
+        Path | None, typer.Option("-o", "--output", help="JSON file of the report.")
+    ] = None,
+    heatmap: Annotated[
+        Path | None,
+        typer.Option("--heatmap", help="CSV of the size and features of every tile."),
+    ] = None,
+    heatmap_zoom: Annotated[
+        int | None,
+        typer.Option(
+            "--heatmap_zoom", help="Zoom of the tiles of the heatmap (default: max)."
+        ),
+    ] = None,
+    top: Annotated[
+        int, typer.Option("--top", help="Number of heaviest tiles to report.")
+    ] = DEFAULT_TOP,
+    layer_sample: Annotated[
+        int,
+        typer.Option(
+            "--layer_sample", help="Tiles per zoom whose layers are broken down."
+        ),
+    ] = DEFAULT_LAYER_SAMPLE,
+    zooms: Annotated[
+        List[int] | None,
+        typer.Option(
+            "-z",
+            "--zoom",
+            help="Zooms whose tiles are all decoded to count the features "
+            "(default: all).",
+        ),
+    ] = None,
+):
+    """
+    Report the tile counts and sizes per zoom, the heaviest tiles, the bytes of the
+    layers and of their attributes, and the features kept from the source.
+    """
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    report, entries, features = analyze(
+        input_path, source_paths, top, layer_sample, zooms
+    )
+    typer.echo(format_report(report))
+    if output is not None:
+        report.save(output)
+    if heatmap is not None:
+        zoom = heatmap_zoom if heatmap_zoom is not None else report.max_zoom
+        write_heatmap(heatmap, entries, features, zoom)
+        logging.info(f"Wrote the tiles of zoom {zoom} to {heatmap}.")
+
+
+if __name__ == "__main__":
+    app()
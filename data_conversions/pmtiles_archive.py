@@ -0,0 +1,862 @@
+"""
+Reading, writing and merging of PMTiles v3 archives.
+
+See the specification at https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md.
+Directories are decoded and encoded with numpy, so that archives with tens of millions
+of tiles can be handled without one Python object per tile.
+"""
+
+import gzip
+import json
+import logging
+import mmap
+import struct
+from dataclasses import dataclass, field
+from enum import IntEnum
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+HEADER_SIZE = 127
+ROOT_DIR_MAX_SIZE = 16384 - HEADER_SIZE
+MAGIC = b"PMTiles"
+
+
+class Compression(IntEnum):
+    Unknown = 0
+    NoCompression = 1
+    Gzip = 2
+    Brotli = 3
+    Zstd = 4
+
+
+class TileType(IntEnum):
+    Unknown = 0
+    Mvt = 1
+    Png = 2
+    Jpeg = 3
+    Webp = 4
+    Avif = 5
+
+
+def decompress(data: bytes, compression: Compression) -> bytes:
+    if compression == Compression.NoCompression:
+        return bytes(data)
+    if compression == Compression.Gzip:
+        return gzip.decompress(data)
+    raise NotImplementedError(f"Compression {compression.name} is not supported.")
+
+
+def compress(data: bytes, compression: Compression) -> bytes:
+    if compression == Compression.NoCompression:
+        return data
+    if compression == Compression.Gzip:
+        return gzip.compress(data, mtime=0)
+    raise NotImplementedError(f"Compression {compression.name} is not supported.")
+
+
+# Tile IDs along the Hilbert curve
+def _rotate(n: int, x: int, y: int, rx: int, ry: int) -> Tuple[int, int]:
+    if ry == 0:
+        if rx == 1:
+            x = n - 1 - x
+            y = n - 1 - y
+        return y, x
+    return x, y
+
+
+def zxy_to_tileid(z: int, x: int, y: int) -> int:
+    acc = ((1 << (2 * z)) - 1) // 3  # Number of tiles in the lower zooms
+    n = 1 << z
+    d = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if (x & s) > 0 else 0
+        ry = 1 if (y & s) > 0 else 0
+        d += s * s * ((3 * rx) ^ ry)
+        x, y = _rotate(n, x, y, rx, ry)
+        s >>= 1
+    return acc + d
+
+
+def tileid_to_zxy(tile_id: int) -> Tuple[int, int, int]:
+    acc = 0
+    for z in range(32):
+        num_tiles = 1 << (2 * z)
+        if acc + num_tiles > tile_id:
+            t = tile_id - acc
+            tx = ty = 0
+            s = 1
+            while s < (1 << z):
+                rx = 1 & (t // 2)
+                ry = 1 & (t ^ rx)
+                tx, ty = _rotate(s, tx, ty, rx, ry)
+                tx += s * rx
+                ty += s * ry
+                t //= 4
+                s *= 2
+            return z, tx, ty
+        acc += num_tiles
+    raise ValueError(f"Tile ID {tile_id} is too large.")
+
+
+# Vectorized varints
+def decode_varints(buf: bytes) -> np.ndarray:
+    """Decode a buffer made only of unsigned varints."""
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    is_last = data < 0x80
+    ends = np.flatnonzero(is_last)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    # Position of each byte in its varint
+    value_index = np.concatenate(([0], np.cumsum(is_last)[:-1]))
+    position = np.arange(len(data)) - starts[value_index]
+    parts = (data & 0x7F).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+
+def encode_varints(values: np.ndarray) -> bytes:
+    """Encode an array of unsigned integers as consecutive varints."""
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        n_bytes += values >= np.uint64(1 << (7 * k))
+    offsets = np.concatenate(([0], np.cumsum(n_bytes)[:-1]))
+    out = np.zeros(int(n_bytes.sum()), dtype=np.uint8)
+    for k in range(10):
+        mask = n_bytes > k
+        if not mask.any():
+            break
+        byte = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        byte |= np.where(n_bytes[mask] > k + 1, 0x80, 0).astype(np.uint64)
+        out[offsets[mask] + k] = byte.astype(np.uint8)
+    return out.tobytes()
+
+
+# Header and directories
+@dataclass
+class Header:
+    root_offset: int = 0
+    root_length: int = 0
+    metadata_offset: int = 0
+    metadata_length: int = 0
+    leaf_directory_offset: int = 0
+    leaf_directory_length: int = 0
+    tile_data_offset: int = 0
+    tile_data_length: int = 0
+    addressed_tiles_count: int = 0
+    tile_entries_count: int = 0
+    tile_contents_count: int = 0
+    clustered: bool = True
+    internal_compression: Compression = Compression.Gzip
+    tile_compression: Compression = Compression.Gzip
+    tile_type: TileType = TileType.Mvt
+    min_zoom: int = 0
+    max_zoom: int = 0
+    min_lon_e7: int = -1800000000
+    min_lat_e7: int = -850000000
+    max_lon_e7: int = 1800000000
+    max_lat_e7: int = 850000000
+    center_zoom: int = 0
+    center_lon_e7: int = 0
+    center_lat_e7: int = 0
+
+    _FORMAT = "<7sB11QBBBBBBiiiiBii"
+
+    @classmethod
+    def deserialize(cls, buf: bytes) -> "Header":
+        fields = struct.unpack(cls._FORMAT, buf[:HEADER_SIZE])
+        if fields[0] != MAGIC:
+            raise ValueError("Not a PMTiles archive.")
+        if fields[1] != 3:
+            raise ValueError(f"PMTiles version {fields[1]} is not supported.")
+        return cls(
+            *fields[2:13],
+            clustered=fields[13] == 1,
+            internal_compression=Compression(fields[14]),
+            tile_compression=Compression(fields[15]),
+            tile_type=TileType(fields[16]),
+            min_zoom=fields[17],
+            max_zoom=fields[18],
+            min_lon_e7=fields[19],
+            min_lat_e7=fields[20],
+            max_lon_e7=fields[21],
+            max_lat_e7=fields[22],
+            center_zoom=fields[23],
+            center_lon_e7=fields[24],
+            center_lat_e7=fields[25],
+        )
+
+    def serialize(self) -> bytes:
+        return struct.pack(
+            self._FORMAT,
+            MAGIC,
+            3,
+            self.root_offset,
+            self.root_length,
+            self.metadata_offset,
+            self.metadata_length,
+            self.leaf_directory_offset,
+            self.leaf_directory_length,
+            self.tile_data_offset,
+            self.tile_data_length,
+            self.addressed_tiles_count,
+            self.tile_entries_count,
+            self.tile_contents_count,
+            1 if self.clustered else 0,
+            self.internal_compression,
+            self.tile_compression,
+            self.tile_type,
+            self.min_zoom,
+            self.max_zoom,
+            self.min_lon_e7,
+            self.min_lat_e7,
+            self.max_lon_e7,
+            self.max_lat_e7,
+            self.center_zoom,
+            self.center_lon_e7,
+            self.center_lat_e7,
+        )
+
+
+@dataclass
+class Entries:
+    """Directory entries as parallel arrays. A run length of 0 points to a leaf."""
+
+    tile_ids: np.ndarray = field(default_factory=lambda: np.zeros(0, np.uint64))
+    offsets: np.ndarray = field(default_factory=lambda: np.zeros(0, np.uint64))
+    lengths: np.ndarray = field(default_factory=lambda: np.zeros(0, np.uint64))
+    run_lengths: np.ndarray = field(default_factory=lambda: np.zeros(0, np.uint64))
+
+    def __len__(self) -> int:
+        return len(self.tile_ids)
+
+    def __getitem__(self, index) -> "Entries":
+        return Entries(
+            self.tile_ids[index],
+            self.offsets[index],
+            self.lengths[index],
+            self.run_lengths[index],
+        )
+
+    @classmethod
+    def concatenate(cls, entries: List["Entries"]) -> "Entries":
+        if len(entries) == 0:
+            return cls()
+        return cls(
+            np.concatenate([e.tile_ids for e in entries]),
+            np.concatenate([e.offsets for e in entries]),
+            np.concatenate([e.lengths for e in entries]),
+            np.concatenate([e.run_lengths for e in entries]),
+        )
+
+
+def deserialize_directory(buf: bytes) -> Entries:
+    values = decode_varints(buf)
+    n = int(values[0])
+    tile_ids = np.cumsum(values[1 : 1 + n], dtype=np.uint64)
+    run_lengths = values[1 + n : 1 + 2 * n]
+    lengths = values[1 + 2 * n : 1 + 3 * n]
+    raw_offsets = values[1 + 3 * n : 1 + 4 * n]
+
+    # An offset of 0 means that the tile directly follows the previous one
+    explicit = raw_offsets > 0
+    explicit[0] = True
+    last_explicit = np.maximum.accumulate(np.where(explicit, np.arange(n), 0))
+    ends = np.cumsum(lengths, dtype=np.uint64)
+    starts = ends - lengths
+    offsets = (raw_offsets[last_explicit] - np.uint64(1)) + (
+        starts - starts[last_explicit]
+    )
+    return Entries(tile_ids, offsets, lengths, run_lengths)
+
+
+def serialize_directory(entries: Entries) -> bytes:
+    n = len(entries)
+    if n == 0:
+        return encode_varints(np.zeros(1, np.uint64))
+    deltas = np.diff(entries.tile_ids, prepend=np.uint64(0))
+    raw_offsets = entries.offsets + np.uint64(1)
+    contiguous = np.zeros(n, dtype=bool)
+    contiguous[1:] = entries.offsets[1:] == entries.offsets[:-1] + entries.lengths[:-1]
+    raw_offsets[contiguous] = 0
+    return encode_varints(
+        np.concatenate(
+            (
+                np.array([n], dtype=np.uint64),
+                deltas,
+                entries.run_lengths,
+                entries.lengths,
+                raw_offsets,
+            )
+        )
+    )
+
+
+def build_directories(
+    entries: Entries, compression: Compression
+) -> Tuple[bytes, bytes, int]:
+    """
+    Split the entries into a root directory that fits in the first 16 KB and leaf
+    directories. Returns (root bytes, leaves bytes, number of leaves).
+    """
+    root = compress(serialize_directory(entries), compression)
+    if len(root) <= ROOT_DIR_MAX_SIZE:
+        return root, b"", 0
+
+    leaf_size = 4096
+    while True:
+        leaves: List[bytes] = []
+        leaves_length = 0
+        root_entries = Entries(
+            tile_ids=entries.tile_ids[::leaf_size].copy(),
+            offsets=np.zeros(0, np.uint64),
+            lengths=np.zeros(0, np.uint64),
+            run_lengths=np.zeros(0, np.uint64),
+        )
+        offsets, lengths = [], []
+        for start in range(0, len(entries), leaf_size):
+            leaf = compress(
+                serialize_directory(entries[start : start + leaf_size]), compression
+            )
+            offsets.append(leaves_length)
+            lengths.append(len(leaf))
+            leaves.append(leaf)
+            leaves_length += len(leaf)
+        root_entries.offsets = np.array(offsets, dtype=np.uint64)
+        root_entries.lengths = np.array(lengths, dtype=np.uint64)
+        root_entries.run_lengths = np.zeros(len(offsets), dtype=np.uint64)
+        root = compress(serialize_directory(root_entries), compression)
+        if len(root) <= ROOT_DIR_MAX_SIZE:
+            return root, b"".join(leaves), len(leaves)
+        leaf_size *= 2
+
+
+# Reading
+class MmapSource:
+    """Read ranges of a local file through a memory map."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self._mmap)
+
+    def __call__(self, offset: int, length: int) -> memoryview:
+        return self.view[offset : offset + length]
+
+    def close(self):
+        self.view.release()
+        self._mmap.close()
+        self._file.close()
+
+
+class PMTilesReader:
+    """
+    Reader of a PMTiles archive from a `source(offset, length)` callable, which can read
+    a local file or make HTTP range requests.
+    """
+
+    def __init__(self, source: Callable[[int, int], bytes]):
+        self.source = source
+        self.header = Header.deserialize(bytes(source(0, HEADER_SIZE)))
+
+    @classmethod
+    def open(cls, path: Path) -> "PMTilesReader":
+        return cls(MmapSource(path))
+
+    def close(self):
+        if isinstance(self.source, MmapSource):
+            self.source.close()
+
+    def metadata(self) -> Dict[str, Any]:
+        h = self.header
+        data = self.source(h.metadata_offset, h.metadata_length)
+        return json.loads(decompress(data, h.internal_compression) or b"{}")
+
+    def _directory(self, offset: int, length: int) -> Entries:
+        data = self.source(offset, length)
+        return deserialize_directory(decompress(data, self.header.internal_compression))
+
+    def entries(self) -> Entries:
+        """Return all the tile entries, in tile ID order, with the leaves resolved."""
+        h = self.header
+        root = self._directory(h.root_offset, h.root_length)
+        parts: List[Entries] = []
+        stack = [root]
+        # Depth-first, keeping the order of the tile IDs
+        while stack:
+            directory = stack.pop()
+            is_leaf = directory.run_lengths == 0
+            if not is_leaf.any():
+                parts.append(directory)
+                continue
+            children: List[Entries] = []
+            start = 0
+            for i in np.flatnonzero(is_leaf):
+                if i > start:
+                    children.append(directory[start:i])
+                children.append(
+                    self._directory(
+                        h.leaf_directory_offset + int(directory.offsets[i]),
+                        int(directory.lengths[i]),
+                    )
+                )
+                start = i + 1
+            if start < len(directory):
+                children.append(directory[start:])
+            stack.extend(reversed(children))
+        return Entries.concatenate(parts)
+
+    def find_entry(self, tile_id: int) -> Tuple[int, int] | None:
+        """Return the (offset, length) of the data of a tile, or None if it is absent."""
+        h = self.header
+        offset, length = h.root_offset, h.root_length
+        for _ in range(4):  # The specification allows at most 3 levels of leaves
+            directory = self._directory(offset, length)
+            i = int(np.searchsorted(directory.tile_ids, tile_id, side="right")) - 1
+            if i < 0:
+                return None
+            run_length = int(directory.run_lengths[i])
+            if run_length == 0:
+                offset = h.leaf_directory_offset + int(directory.offsets[i])
+                length = int(directory.lengths[i])
+                continue
+            if tile_id < int(directory.tile_ids[i]) + run_length:
+                return int(directory.offsets[i]), int(directory.lengths[i])
+            return None
+        return None
+
+    def tile_data(self, offset: int, length: int) -> bytes:
+        """Return the compressed data of a tile from its entry."""
+        return self.source(self.header.tile_data_offset + offset, length)
+
+    def get_tile(self, z: int, x: int, y: int) -> bytes | None:
+        """Return the decompressed data of a tile, or None if it is absent."""
+        entry = self.find_entry(zxy_to_tileid(z, x, y))
+        if entry is None:
+            return None
+        return decompress(self.tile_data(*entry), self.header.tile_compression)
+
+
+# Minimal Mapbox Vector Tile decoding and merging
+def _read_varint(buf: memoryview, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_varint(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def iter_fields(buf: bytes) -> Iterator[Tuple[int, int, Any, memoryview]]:
+    """
+    Iterate over the fields of a protobuf message, as (field number, wire type, value,
+    raw bytes of the whole field).
+    """
+    buf = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        start = pos
+        key, pos = _read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            value = buf[pos : pos + 8]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value = buf[pos : pos + length]
+            pos += length
+        elif wire_type == 5:
+            value = buf[pos : pos + 4]
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}.")
+        yield number, wire_type, value, buf[start:pos]
+
+
+def _length_delimited(number: int, payload: bytes) -> bytes:
+    return _write_varint(number << 3 | 2) + _write_varint(len(payload)) + payload
+
+
+@dataclass
+class _Layer:
+    name: bytes
+    extent: int = 4096
+    version: int = 2
+    keys: List[bytes] = field(default_factory=list)
+    values: List[bytes] = field(default_factory=list)
+    features: List[bytes] = field(default_factory=list)
+    key_index: Dict[bytes, int] = field(default_factory=dict)
+    value_index: Dict[bytes, int] = field(default_factory=dict)
+
+    def add(self, layer_bytes: bytes):
+        """Add the features of another layer with the same name, remapping their tags."""
+        keys: List[bytes] = []
+        values: List[bytes] = []
+        features: List[memoryview] = []
+        extent = 4096
+        for number, _, value, _ in iter_fields(layer_bytes):
+            if number == 2:
+                features.append(value)
+            elif number == 3:
+                keys.append(bytes(value))
+            elif number == 4:
+                values.append(bytes(value))
+            elif number == 5:
+                extent = value
+            elif number == 15:
+                self.version = value
+        if len(self.features) > 0 and extent != self.extent:
+            raise ValueError(
+                f"Cannot merge layers {self.name!r} with extents {self.extent} and {extent}."
+            )
+        self.extent = extent
+
+        key_map = [self._index(self.keys, self.key_index, k) for k in keys]
+        value_map = [self._index(self.values, self.value_index, v) for v in values]
+
+        for feature in features:
+            out = bytearray()
+            for number, _, value, raw in iter_fields(feature):
+                if number == 2:
+                    tags = []
+                    pos = 0
+                    while pos < len(value):
+                        tag, pos = _read_varint(value, pos)
+                        tags.append(tag)
+                    remapped = b"".join(
+                        _write_varint(key_map[tag] if i % 2 == 0 else value_map[tag])
+                        for i, tag in enumerate(tags)
+                    )
+                    out += _length_delimited(2, remapped)
+                else:
+                    out += raw
+            self.features.append(bytes(out))
+
+    @staticmethod
+    def _index(items: List[bytes], index: Dict[bytes, int], item: bytes) -> int:
+        if item not in index:
+            index[item] = len(items)
+            items.append(item)
+        return index[item]
+
+    def serialize(self) -> bytes:
+        out = bytearray()
+        out += _write_varint(15 << 3) + _write_varint(self.version)
+        out += _length_delimited(1, self.name)
+        for feature in self.features:
+            out += _length_delimited(2, feature)
+        for key in self.keys:
+            out += _length_delimited(3, key)
+        for value in self.values:
+            out += _length_delimited(4, value)
+        out += _write_varint(5 << 3) + _write_varint(self.extent)
+        return bytes(out)
+
+
+def merge_mvt(tiles: List[bytes]) -> bytes:
+    """
+    Merge decompressed vector tiles. Layers present in only one tile are copied as is,
+    layers with the same name are merged into one.
+    """
+    layers: Dict[bytes, List[bytes]] = {}
+    for tile in tiles:
+        for number, _, value, _ in iter_fields(tile):
+            if number != 3:
+                continue
+            name = b""
+            for layer_number, _, layer_value, _ in iter_fields(value):
+                if layer_number == 1:
+                    name = bytes(layer_value)
+                    break
+            layers.setdefault(name, []).append(bytes(value))
+
+    out = bytearray()
+    for name, parts in layers.items():
+        if len(parts) == 1:
+            out += _length_delimited(3, parts[0])
+        else:
+            layer = _Layer(name=name)
+            for part in parts:
+                layer.add(part)
+            out += _length_delimited(3, layer.serialize())
+    return bytes(out)
+
+
+# Merging archives
+def _merge_metadata(metadatas: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge the metadata, taking the union of the vector layers."""
+    merged = dict(metadatas[0])
+    # The statistics are computed per archive and would be wrong for the merged one
+    if len(metadatas) > 1:
+        merged.pop("tilestats", None)
+        merged.pop("strategies", None)
+
+    vector_layers: Dict[str, Dict[str, Any]] = {}
+    for metadata in metadatas:
+        for layer in metadata.get("vector_layers", []):
+            current = vector_layers.get(layer["id"])
+            if current is None:
+                vector_layers[layer["id"]] = {
+                    **layer,
+                    "fields": dict(layer.get("fields", {})),
+                }
+                continue
+            current["fields"].update(layer.get("fields", {}))
+            if "minzoom" in layer:
+                current["minzoom"] = min(current.get("minzoom", 99), layer["minzoom"])
+            if "maxzoom" in layer:
+                current["maxzoom"] = max(current.get("maxzoom", 0), layer["maxzoom"])
+    if vector_layers:
+        merged["vector_layers"] = list(vector_layers.values())
+    return merged
+
+
+def merge_pmtiles(
+    input_paths: List[Path],
+    save_path: Path,
+    on_progress: Callable[[float], None] | None = None,
+) -> Header:
+    """
+    Merge PMTiles archives into one. Tiles present in only one input are copied
+    byte-for-byte from the memory-mapped inputs, only the tiles present in several
+    inputs are decoded and their layers merged.
+    """
+    readers = [PMTilesReader.open(path) for path in input_paths]
+    try:
+        headers = [r.header for r in readers]
+        tile_compression = headers[0].tile_compression
+        if any(h.tile_compression != tile_compression for h in headers):
+            raise ValueError("Cannot merge archives with different tile compressions.")
+        if any(h.tile_type != headers[0].tile_type for h in headers):
+            raise ValueError("Cannot merge archives with different tile types.")
+
+        # All entries of all inputs, sorted by tile ID
+        all_entries = [r.entries() for r in readers]
+        sources = np.concatenate(
+            [np.full(len(e), i, dtype=np.int64) for i, e in enumerate(all_entries)]
+        )
+        entries = Entries.concatenate(all_entries)
+        order = np.argsort(entries.tile_ids, kind="stable")
+        entries = entries[order]
+        sources = sources[order]
+
+        # An entry overlaps with a previous one if it starts before the end of any of
+        # them, overlapping entries are grouped to be merged tile by tile
+        ends = entries.tile_ids + entries.run_lengths
+        previous_max_end = np.maximum.accumulate(ends)
+        overlaps_previous = np.zeros(len(entries), dtype=bool)
+        overlaps_previous[1:] = entries.tile_ids[1:] < previous_max_end[:-1]
+        in_conflict = overlaps_previous.copy()
+        in_conflict[:-1] |= overlaps_previous[1:]
+        logging.info(
+            f"Merging {len(input_paths)} archives: {len(entries)} entries, "
+            f"{int(in_conflict.sum())} of them overlapping."
+        )
+
+        # Tiles that are referenced several times in the same input are only written once
+        keys = sources.astype(np.uint64) << np.uint64(48) | entries.offsets
+        unique_keys, counts = np.unique(keys[~in_conflict], return_counts=True)
+        shared_keys = set(unique_keys[counts > 1].tolist())
+        shared_offsets: Dict[int, Tuple[int, int]] = {}
+
+        out_tile_ids: List[np.ndarray] = []
+        out_offsets: List[np.ndarray] = []
+        out_lengths: List[np.ndarray] = []
+        out_run_lengths: List[np.ndarray] = []
+
+        with open(save_path, "wb") as f:
+            # The header and the root directory are written at the end
+            f.write(b"\0" * (HEADER_SIZE + ROOT_DIR_MAX_SIZE))
+            tile_data_offset = f.tell()
+            written = 0
+            contents = 0
+
+            # Segments are either maximal runs of entries that do not overlap, which are
+            # copied, or groups of overlapping entries, which are merged tile by tile
+            n = len(entries)
+            new_segment = np.ones(n, dtype=bool)
+            new_segment[1:] = (in_conflict[1:] != in_conflict[:-1]) | (
+                in_conflict[1:] & ~overlaps_previous[1:]
+            )
+            bounds = np.append(np.flatnonzero(new_segment), n)
+            last_percent = -1
+
+            for i, j in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                if not in_conflict[i]:
+                    block = entries[i:j]
+                    block_sources = sources[i:j]
+                    block_keys = keys[i:j]
+                    if shared_keys and not shared_keys.isdisjoint(block_keys.tolist()):
+                        new_offsets = np.zeros(j - i, dtype=np.uint64)
+                        for k in range(j - i):
+                            src = int(block_sources[k])
+                            offset = int(block.offsets[k])
+                            length = int(block.lengths[k])
+                            key = int(block_keys[k])
+                            if key in shared_offsets:
+                                new_offsets[k] = shared_offsets[key][0]
+                                continue
+                            f.write(readers[src].tile_data(offset, length))
+                            new_offsets[k] = written
+                            if key in shared_keys:
+                                shared_offsets[key] = (written, length)
+                            written += length
+                            contents += 1
+                    else:
+                        # Every entry has its own data, copy contiguous ranges at once
+                        starts = (
+                            np.cumsum(block.lengths, dtype=np.uint64) - block.lengths
+                        )
+                        new_offsets = starts + np.uint64(written)
+                        breaks = np.flatnonzero(
+                            (block_sources[1:] != block_sources[:-1])
+                            | (
+                                block.offsets[1:]
+                                != block.offsets[:-1] + block.lengths[:-1]
+                            )
+                        )
+                        run_starts = np.concatenate(([0], breaks + 1)).tolist()
+                        run_ends = np.append(breaks + 1, j - i).tolist()
+                        for start, end in zip(run_starts, run_ends):
+                            length = int(
+                                block.offsets[end - 1]
+                                + block.lengths[end - 1]
+                                - block.offsets[start]
+                            )
+                            f.write(
+                                readers[int(block_sources[start])].tile_data(
+                                    int(block.offsets[start]), length
+                                )
+                            )
+                        written += int(block.lengths.sum())
+                        contents += j - i
+                    out_tile_ids.append(block.tile_ids)
+                    out_offsets.append(new_offsets)
+                    out_lengths.append(block.lengths)
+                    out_run_lengths.append(block.run_lengths)
+                else:
+                    per_tile: Dict[int, List[Tuple[int, int, int]]] = {}
+                    for k in range(i, j):
+                        src = int(sources[k])
+                        start = int(entries.tile_ids[k])
+                        for tile_id in range(
+                            start, start + int(entries.run_lengths[k])
+                        ):
+                            per_tile.setdefault(tile_id, []).append(
+                                (src, int(entries.offsets[k]), int(entries.lengths[k]))
+                            )
+                    group_tile_ids = sorted(per_tile)
+                    group_offsets = np.zeros(len(group_tile_ids), dtype=np.uint64)
+                    group_lengths = np.zeros(len(group_tile_ids), dtype=np.uint64)
+                    for k, tile_id in enumerate(group_tile_ids):
+                        parts = per_tile[tile_id]
+                        if len(parts) == 1:
+                            src, offset, length = parts[0]
+                            data = bytes(readers[src].tile_data(offset, length))
+                        else:
+                            tiles = [
+                                decompress(
+                                    readers[src].tile_data(offset, length),
+                                    tile_compression,
+                                )
+                                for src, offset, length in parts
+                            ]
+                            data = compress(merge_mvt(tiles), tile_compression)
+                        f.write(data)
+                        group_offsets[k] = written
+                        group_lengths[k] = len(data)
+                        written += len(data)
+                        contents += 1
+                    out_tile_ids.append(np.array(group_tile_ids, dtype=np.uint64))
+                    out_offsets.append(group_offsets)
+                    out_lengths.append(group_lengths)
+                    out_run_lengths.append(
+                        np.ones(len(group_tile_ids), dtype=np.uint64)
+                    )
+
+                if on_progress is not None and 100 * j // n > last_percent:
+                    last_percent = 100 * j // n
+                    on_progress(last_percent)
+
+            out_entries = Entries(
+                (
+                    np.concatenate(out_tile_ids)
+                    if out_tile_ids
+                    else np.zeros(0, np.uint64)
+                ),
+                np.concatenate(out_offsets) if out_offsets else np.zeros(0, np.uint64),
+                np.concatenate(out_lengths) if out_lengths else np.zeros(0, np.uint64),
+                (
+                    np.concatenate(out_run_lengths)
+                    if out_run_lengths
+                    else np.zeros(0, np.uint64)
+                ),
+            )
+
+            internal_compression = Compression.Gzip
+            root, leaves, _ = build_directories(out_entries, internal_compression)
+            metadata = compress(
+                json.dumps(_merge_metadata([r.metadata() for r in readers])).encode(),
+                internal_compression,
+            )
+            metadata_offset = f.tell()
+            f.write(metadata)
+            leaf_directory_offset = f.tell()
+            f.write(leaves)
+
+            min_lon_e7 = min(h.min_lon_e7 for h in headers)
+            min_lat_e7 = min(h.min_lat_e7 for h in headers)
+            max_lon_e7 = max(h.max_lon_e7 for h in headers)
+            max_lat_e7 = max(h.max_lat_e7 for h in headers)
+            min_zoom = min(h.min_zoom for h in headers)
+            header = Header(
+                root_offset=HEADER_SIZE,
+                root_length=len(root),
+                metadata_offset=metadata_offset,
+                metadata_length=len(metadata),
+                leaf_directory_offset=leaf_directory_offset,
+                leaf_directory_length=len(leaves),
+                tile_data_offset=tile_data_offset,
+                tile_data_length=written,
+                addressed_tiles_count=int(out_entries.run_lengths.sum()),
+                tile_entries_count=len(out_entries),
+                tile_contents_count=contents,
+                clustered=True,
+                internal_compression=internal_compression,
+                tile_compression=tile_compression,
+                tile_type=headers[0].tile_type,
+                min_zoom=min_zoom,
+                max_zoom=max(h.max_zoom for h in headers),
+                min_lon_e7=min_lon_e7,
+                min_lat_e7=min_lat_e7,
+                max_lon_e7=max_lon_e7,
+                max_lat_e7=max_lat_e7,
+                center_zoom=min_zoom,
+                center_lon_e7=(min_lon_e7 + max_lon_e7) // 2,
+                center_lat_e7=(min_lat_e7 + max_lat_e7) // 2,
+            )
+            f.seek(0)
+            f.write(header.serialize())
+            f.write(root)
+    finally:
+        for reader in readers:
+            reader.close()
+
+    return header
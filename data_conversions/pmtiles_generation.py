@@ -4,23 +4,41 @@ import json
 import logging
 import math
 import os
+import signal
 import subprocess
+import tempfile
+import threading
+from contextlib import ExitStack
 from enum import Enum
 from pathlib import Path
 from pprint import pprint
 from typing import Annotated, Dict, Iterable, List, Literal, Tuple
 
-import aiofiles
 import aiohttp
-import boto3
 import geopandas as gpd
 import typer
-from botocore.exceptions import ClientError, EndpointConnectionError
-from dotenv import dotenv_values
+from osgeo import ogr
 from pydantic import BaseModel
-from tqdm import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
 
+from build_manifest import BuildManifest, file_sha256
+from gpkg_cache import GpkgCache, open_gpkg
+from http_download import HostLimiter, download_file
+from job_pool import (
+    COST_FACTORS,
+    GB,
+    JobCost,
+    ResourceBudget,
+    default_workers,
+    estimate_cost,
+)
+from pmtiles_archive import merge_pmtiles
+from progress import PROGRESS
+from run_report import USAGE, format_report, report_path
+from s3_publish import MB, make_client, upload_file
+from task_graph import Task, TaskGraph, TaskKind
+from zoom_planner import load_plan
+
 app = typer.Typer()
 
 
@@ -51,6 +69,15 @@ class Verbose(Enum):
                 raise RuntimeError("Verbose has only 4 possible values.")
 
 
+class JoinEngine(Enum):
+    Native = "native"
+    TileJoin = "tile-join"
+
+    @property
+    def cost_tool(self) -> str:
+        return "tile-join" if self == JoinEngine.TileJoin else "merge_pmtiles"
+
+
 def setup_logging(verbose: Verbose):
     logging.basicConfig(
         level=verbose.value,
@@ -64,11 +91,23 @@ def _safe_name(code: str) -> str:
     return "".join(c if c.isalnum() or c in "-_" else "_" for c in code)
 
 
-async def _get_content_length(session: aiohttp.ClientSession, url: str) -> int:
-    """Issue a HEAD request to fetch the Content-Length header."""
-    async with session.head(url, allow_redirects=True) as resp:
-        resp.raise_for_status()
-        return int(resp.headers.get("Content-Length", 0))
+def _is_up_to_date(
+    save_path: Path,
+    overwrite: bool,
+    manifest: BuildManifest | None,
+    inputs: Iterable[Path] = (),
+    params: Dict | None = None,
+    tools: Iterable[str] = (),
+) -> bool:
+    """
+    Decide if `save_path` can be reused. Without a manifest, any existing file is
+    reused, otherwise it also has to be built from the same inputs, params and tools.
+    """
+    if overwrite:
+        return False
+    if manifest is None:
+        return save_path.exists()
+    return manifest.is_fresh(save_path, inputs, params, tools)
 
 
 class AdminInfo(BaseModel):
@@ -90,6 +129,11 @@ class BuildingsInfo(BaseModel):
     gpkg_zip_path: Path
     fgb_path: Path | None = None
     pmtiles_path: Path | None = None
+    # Layers of a GeoPackage that has several of them, such as CZE, which are converted
+    # and tiled separately and only merged in the archive of the country
+    layers: List[str] = []
+    layer_fgb_paths: Dict[str, Path] = {}
+    layer_pmtiles_paths: Dict[str, Path] = {}
 
     def get_fgb_path(self):
         if self.fgb_path is None:
@@ -101,6 +145,24 @@ class BuildingsInfo(BaseModel):
             raise RuntimeError("pmtiles_path was not specified.")
         return self.pmtiles_path
 
+    def _layer_paths(self, paths: Dict[str, Path], name: str) -> List[Path]:
+        missing = [layer for layer in self.layers if layer not in paths]
+        if missing:
+            raise RuntimeError(f"{name} was not specified for {', '.join(missing)}.")
+        return [paths[layer] for layer in self.layers]
+
+    def get_fgb_paths(self) -> List[Path]:
+        """FlatGeoBuf of every layer, or the only one."""
+        if not self.layers:
+            return [self.get_fgb_path()]
+        return self._layer_paths(self.layer_fgb_paths, "fgb_path")
+
+    def get_pmtiles_paths(self) -> List[Path]:
+        """PMTiles of every layer, or the only one."""
+        if not self.layers:
+            return [self.get_pmtiles_path()]
+        return self._layer_paths(self.layer_pmtiles_paths, "pmtiles_path")
+
 
 class Country(BaseModel):
     admin_info: CountryAdminInfo
@@ -113,6 +175,43 @@ class Country(BaseModel):
         return self.pmtiles_path
 
 
+def _compute_mean_area(geojson_path: Path) -> float:
+    """Compute the mean area in EPSG:3857 of the geometries of a file."""
+    geoms = gpd.read_file(geojson_path, columns=[]).geometry
+    return float(geoms.to_crs(3857).area.mean())
+
+
+async def get_mean_area(
+    geojson_path: Path,
+    manifest: BuildManifest | None = None,
+    pool: concurrent.futures.Executor | None = None,
+) -> float:
+    """
+    Return the mean area of the boundaries in `geojson_path`, from the
+    <file>.stats.json sidecar if it was computed for the same file content, otherwise
+    by computing it in `pool` (or a thread) to keep the event loop free.
+    """
+    stats_path = geojson_path.with_name(geojson_path.name + ".stats.json")
+    if manifest is not None:
+        record = await asyncio.to_thread(manifest.file_record, geojson_path)
+        file_hash = record.sha256
+    else:
+        file_hash = await asyncio.to_thread(file_sha256, geojson_path)
+
+    if stats_path.exists():
+        stats = json.loads(stats_path.read_text())
+        if stats.get("sha256") == file_hash:
+            return stats["mean_area"]
+
+    loop = asyncio.get_running_loop()
+    mean_area = await loop.run_in_executor(pool, _compute_mean_area, geojson_path)
+
+    tmp_path = stats_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps({"sha256": file_hash, "mean_area": mean_area}))
+    os.replace(tmp_path, stats_path)
+    return mean_area
+
+
 async def download_admin_one_country_one_level(
     session: aiohttp.ClientSession,
     country_code: str,
@@ -120,6 +219,9 @@ async def download_admin_one_country_one_level(
     output_dir: Path,
     overwrite: bool,
     chunk_size: int = 64 * 1024,
+    manifest: BuildManifest | None = None,
+    limiter: HostLimiter | None = None,
+    stats_pool: concurrent.futures.Executor | None = None,
 ) -> AdminInfo:
     """
     Perform a single GET request for a given country/administrative level,
@@ -127,14 +229,16 @@ async def download_admin_one_country_one_level(
     """
     output_dir.mkdir(parents=True, exist_ok=True)
     save_path = output_dir / f"{country_code}-{level}.geojson"
-    if save_path.exists() and not overwrite:
+    meta_url = (
+        f"https://www.geoboundaries.org/api/current/gbOpen/{country_code}/{level}"
+    )
+    params = {"url": meta_url}
+    if await asyncio.to_thread(
+        _is_up_to_date, save_path, overwrite, manifest, params=params
+    ):
         logging.info(f"Skipping {save_path} which already exists.")
 
     else:
-        meta_url = (
-            f"https://www.geoboundaries.org/api/current/gbOpen/{country_code}/{level}"
-        )
-
         try:
             async with session.get(meta_url) as resp:
                 resp.raise_for_status()
@@ -151,38 +255,32 @@ async def download_admin_one_country_one_level(
             raise RuntimeError("No URL found to download!")
 
         # Download the actual boundaries
-        async with session.get(geojson_url) as resp:
-            resp.raise_for_status()
-            total_bytes = int(resp.headers.get("Content-Length", 0))
-
-            pbar = tqdm(
-                total=total_bytes,
-                unit="B",
-                unit_scale=True,
-                desc=f"{country_code}-{level}",
-                colour="green",
-                leave=True,
-            )
-
-            # Stream the response to disk in binary mode
-            async with aiofiles.open(save_path, mode="wb") as f:
-                async for chunk in resp.content.iter_chunked(chunk_size):
-                    await f.write(chunk)
-                    pbar.update(len(chunk))
+        await download_file(
+            session,
+            geojson_url,
+            save_path,
+            desc=f"{country_code}-{level}",
+            limiter=limiter or HostLimiter(max_connections=4),
+            chunk_size=chunk_size,
+        )
 
-            pbar.close()
+        if manifest is not None:
+            await asyncio.to_thread(manifest.record, save_path, params=params)
 
-    # Compute the mean area
-    gdf = gpd.read_file(save_path)
-    gdf = gdf.to_crs(3857)  # project to meters
     return AdminInfo(
         geojson_path=save_path,
-        mean_area=float(gdf.geometry.area.mean()),
+        mean_area=await get_mean_area(save_path, manifest=manifest, pool=stats_pool),
     )
 
 
 async def download_admin_one_country(
-    session: aiohttp.ClientSession, country_code: str, output_dir: Path, overwrite: bool
+    session: aiohttp.ClientSession,
+    country_code: str,
+    output_dir: Path,
+    overwrite: bool,
+    manifest: BuildManifest | None = None,
+    limiter: HostLimiter | None = None,
+    stats_pool: concurrent.futures.Executor | None = None,
 ) -> CountryAdminInfo:
     """
     Fire off the three level-specific requests for a single country in parallel.
@@ -191,7 +289,14 @@ async def download_admin_one_country(
     admin_infos = await asyncio.gather(
         *(
             download_admin_one_country_one_level(
-                session, country_code, lvl, output_dir, overwrite=overwrite
+                session,
+                country_code,
+                lvl,
+                output_dir,
+                overwrite=overwrite,
+                manifest=manifest,
+                limiter=limiter,
+                stats_pool=stats_pool,
             )
             for lvl in ADMIN_LEVELS
         )
@@ -200,23 +305,34 @@ async def download_admin_one_country(
 
 
 async def download_admin(
-    country_codes: List[str], output_dir: Path, overwrite: bool = False
+    country_codes: List[str],
+    output_dir: Path,
+    overwrite: bool = False,
+    manifest: BuildManifest | None = None,
 ) -> dict[str, CountryAdminInfo]:
     """
     Entry point: open a single aiohttp session and run all country queries concurrently.
     """
     logging.info(f"Downloading the administrative boundaries...")
     download_timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=300)
-    async with aiohttp.ClientSession(timeout=download_timeout) as session:
-        # Run each country's set of requests concurrently as well
-        areas_per_country = await asyncio.gather(
-            *(
-                download_admin_one_country(
-                    session, code, output_dir, overwrite=overwrite
+    limiter = HostLimiter(max_connections=4)
+    with concurrent.futures.ProcessPoolExecutor() as stats_pool:
+        async with aiohttp.ClientSession(timeout=download_timeout) as session:
+            # Run each country's set of requests concurrently as well
+            areas_per_country = await asyncio.gather(
+                *(
+                    download_admin_one_country(
+                        session,
+                        code,
+                        output_dir,
+                        overwrite=overwrite,
+                        manifest=manifest,
+                        limiter=limiter,
+                        stats_pool=stats_pool,
+                    )
+                    for code in country_codes
                 )
-                for code in country_codes
             )
-        )
 
     logging.info(f"Done downloading the administrative boundaries.")
     return dict(zip(country_codes, areas_per_country))
@@ -252,49 +368,58 @@ async def download_buildings_one_country(
     output_dir: Path,
     overwrite: bool,
     chunk_size: int = 64 * 1024,
+    manifest: BuildManifest | None = None,
+    limiter: HostLimiter | None = None,
+    segments: int = 1,
 ) -> BuildingsInfo:
     """
-    Perform a single GET request for a given country,
-    then save the GeoPackage file.
+    Download the GeoPackage file of a given country, resuming a previous partial
+    download if there is one, and splitting large files into `segments` parallel
+    byte ranges.
     """
     output_dir.mkdir(parents=True, exist_ok=True)
     safe_code = _safe_name(country_code)
     save_path = output_dir / f"{safe_code}.gpkg.zip"
+    params = {"url": data_url}
 
-    if save_path.exists() and not overwrite:
+    if await asyncio.to_thread(
+        _is_up_to_date, save_path, overwrite, manifest, params=params
+    ):
         logging.info(f"Skipping {save_path} which already exists.")
 
     else:
         try:
-            async with session.get(data_url) as resp:
-                resp.raise_for_status()
-
-                total_bytes = int(resp.headers.get("Content-Length", 0))
-
-                pbar = tqdm(
-                    total=total_bytes,
-                    unit="B",
-                    unit_scale=True,
-                    desc=f"{safe_code}",
-                    colour="green",
-                )
-
-                # Stream the response to disk in binary mode
-                async with aiofiles.open(save_path, mode="wb") as f:
-                    async for chunk in resp.content.iter_chunked(chunk_size):
-                        await f.write(chunk)
-                        pbar.update(len(chunk))
-
-                pbar.close()
+            await download_file(
+                session,
+                data_url,
+                save_path,
+                desc=f"{safe_code}",
+                limiter=limiter or HostLimiter(max_connections=4),
+                segments=segments,
+                chunk_size=chunk_size,
+            )
 
         except aiohttp.ClientError as e:
             raise RuntimeError(f"Failed to download {data_url}: {e}") from e
 
-    return BuildingsInfo(gpkg_zip_path=save_path)
+        if manifest is not None:
+            await asyncio.to_thread(manifest.record, save_path, params=params)
+
+    layers = await asyncio.to_thread(gpkg_layers, save_path)
+    if len(layers) > 1:
+        logging.info(f"{save_path.name} has {len(layers)} layers: {', '.join(layers)}.")
+    return BuildingsInfo(
+        gpkg_zip_path=save_path, layers=layers if len(layers) > 1 else []
+    )
 
 
 async def download_buildings(
-    country_codes: List[str], output_dir: Path, overwrite: bool = False
+    country_codes: List[str],
+    output_dir: Path,
+    overwrite: bool = False,
+    manifest: BuildManifest | None = None,
+    max_connections: int = 4,
+    segments: int = 1,
 ) -> dict[str, BuildingsInfo]:
     logging.info(f"Downloading the buildings...")
     code_to_url = await get_buildings_country_codes_and_urls()
@@ -304,68 +429,284 @@ async def download_buildings(
 
     logging.info(f"Downloading the buildings...")
     download_timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=300)
+    limiter = HostLimiter(max_connections=max_connections)
     async with aiohttp.ClientSession(timeout=download_timeout) as session:
         save_paths = await asyncio.gather(
             *(
                 download_buildings_one_country(
-                    session, code, url, output_dir, overwrite=overwrite
+                    session,
+                    code,
+                    url,
+                    output_dir,
+                    overwrite=overwrite,
+                    manifest=manifest,
+                    limiter=limiter,
+                    segments=segments,
                 )
                 for (code, url) in code_to_url.items()
             )
         )
 
     logging.info(f"Done downloading the buildings.")
-    return dict(zip(country_codes, save_paths))
+    return dict(zip(code_to_url.keys(), save_paths))
 
 
 # ----------------------------------------------------------------------
 # Small wrapper to run a shell command and raise a clear exception on failure
 # ----------------------------------------------------------------------
-def _run_cmd(cmd: List[str]) -> None:
-    """Run a command synchronously, raising on non-zero exit."""
+def _run_cmd(
+    cmd: List[str],
+    job: str | None = None,
+    stage: str | None = None,
+    input_paths: Iterable[Path] = (),
+    outputs: Iterable[Path] = (),
+    scratch_dirs: Iterable[Path] = (),
+) -> None:
+    """
+    Run a command synchronously, streaming its output to parse and report its progress,
+    and raising on non-zero exit.
+    Its rusage and the peak disk usage of its `outputs` and `scratch_dirs` are recorded
+    for the run report.
+    """
     logging.info(" ".join(cmd))
-    result = subprocess.run(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
-    if result.returncode != 0:
+    job = job or Path(cmd[-1]).name
+    stage = stage or cmd[0]
+    progress = PROGRESS.start(job, stage, cmd[0], input_paths)
+    stdout_tail: List[bytes] = []
+    stderr_tail: List[bytes] = []
+    with USAGE.measure(job, stage, cmd[0], outputs, scratch_dirs) as meter:
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            meter.watch(proc)
+            threads = [
+                threading.Thread(
+                    target=progress.watch, args=(proc.stdout, stdout_tail)
+                ),
+                threading.Thread(
+                    target=progress.watch, args=(proc.stderr, stderr_tail)
+                ),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            meter.wait(proc)
+        finally:
+            progress.close()
+
+    if proc.returncode != 0:
         raise RuntimeError(
-            f"Command {' '.join(cmd)} failed (code {result.returncode})\n"
-            f"stdout: {result.stdout}\nstderr: {result.stderr}"
+            f"Command {' '.join(cmd)} failed (code {proc.returncode})\n"
+            f"stdout: {b''.join(stdout_tail).decode(errors='replace')}\n"
+            f"stderr: {b''.join(stderr_tail).decode(errors='replace')}"
+        )
+
+
+def _run_piped_cmds(
+    reader_cmds: List[List[str]],
+    writer_cmd: List[str],
+    job: str | None = None,
+    stage: str | None = None,
+    input_paths: Iterable[Path] = (),
+    outputs: Iterable[Path] = (),
+    scratch_dirs: Iterable[Path] = (),
+) -> None:
+    """
+    Run the reader commands in parallel and merge their line-delimited stdout into the
+    stdin of the writer command, raising if any of them exits with a non-zero code.
+    Lines are never interleaved, so each reader can output one record per line.
+    The progress is parsed from the output of the writer, and the rusage of all the
+    commands is recorded as a single job of the run report.
+    """
+    logging.info(" ".join(writer_cmd))
+    job = job or writer_cmd[0]
+    stage = stage or writer_cmd[0]
+    progress = PROGRESS.start(job, stage, writer_cmd[0], input_paths)
+    stderrs = [tempfile.TemporaryFile() for _ in reader_cmds]
+    writer_tail: List[bytes] = []
+    readers: List[subprocess.Popen] = []
+    write_lock = threading.Lock()
+    writer_gone = threading.Event()
+
+    def stop_readers():
+        # Readers that nobody forwards anymore would block forever on their full pipe.
+        # Signal them by pid: `Popen.terminate` polls, which would reap the exited
+        # ones before the meter waits for them, and they stay zombies until then.
+        for reader in readers:
+            if reader.returncode is None:
+                try:
+                    os.kill(reader.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    with USAGE.measure(job, stage, writer_cmd[0], outputs, scratch_dirs) as meter:
+        writer = subprocess.Popen(
+            writer_cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        meter.watch(writer)
+        writer_thread = threading.Thread(
+            target=progress.watch, args=(writer.stderr, writer_tail)
+        )
+        writer_thread.start()
+
+        def forward(reader: subprocess.Popen):
+            remainder = b""
+            try:
+                while chunk := reader.stdout.read(1024 * 1024):
+                    chunk = remainder + chunk
+                    end = chunk.rfind(b"\n") + 1
+                    remainder = chunk[end:]
+                    with write_lock:
+                        writer.stdin.write(chunk[:end])
+                if remainder:
+                    with write_lock:
+                        writer.stdin.write(remainder + b"\n")
+            except OSError:
+                # The writer exited before reading all of its input
+                writer_gone.set()
+                stop_readers()
+
+        try:
+            for reader_cmd, stderr in zip(reader_cmds, stderrs):
+                logging.info(" ".join(reader_cmd))
+                readers.append(
+                    subprocess.Popen(reader_cmd, stdout=subprocess.PIPE, stderr=stderr)
+                )
+                meter.watch(readers[-1])
+            threads = [threading.Thread(target=forward, args=(r,)) for r in readers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            stop_readers()
+            raise
+        finally:
+            try:
+                writer.stdin.close()
+            except OSError:
+                writer_gone.set()
+            for reader in readers:
+                reader.stdout.close()
+                meter.wait(reader)
+            writer_thread.join()
+            meter.wait(writer)
+            progress.close()
+
+    messages = []
+    for stderr in stderrs:
+        stderr.seek(0)
+        messages.append(stderr.read().decode(errors="replace"))
+        stderr.close()
+    failures = [
+        f"Command {' '.join(cmd)} failed (code {proc.returncode})\n"
+        f"stderr: {message}"
+        for cmd, proc, message in zip(reader_cmds, readers, messages)
+        if proc.returncode != 0
+    ]
+    if writer.returncode != 0:
+        writer_failure = (
+            f"Command {' '.join(writer_cmd)} failed (code {writer.returncode})\n"
+            f"stderr: {b''.join(writer_tail).decode(errors='replace')}"
+        )
+        # The readers were stopped because the writer exited
+        if writer_gone.is_set():
+            failures.insert(0, writer_failure)
+        else:
+            failures.append(writer_failure)
+    elif writer_gone.is_set():
+        failures.insert(
+            0, f"Command {' '.join(writer_cmd)} exited before reading all its input"
         )
+    if failures:
+        raise RuntimeError(failures[0])
+
+
+def gpkg_layers(input_path: Path) -> List[str]:
+    """Names of the layers of a GeoPackage, zipped or not."""
+    ds = ogr.Open(str(input_path))
+    if ds is None:
+        raise RuntimeError(f"Could not open {input_path}.")
+    return [ds.GetLayer(i).GetName() for i in range(ds.GetLayerCount())]
+
+
+def _scratch_dir(save_path: Path) -> tempfile.TemporaryDirectory:
+    """
+    Temporary directory of the tippecanoe job creating `save_path`, in the same
+    place tippecanoe would use, but of its own so that its size can be sampled.
+    """
+    return tempfile.TemporaryDirectory(prefix=f"{save_path.name}-")
+
+
+def _output_stem(input_path: Path, source_layer: str | None) -> str:
+    """Name of the outputs of `input_path`, followed by the layer if it has several."""
+    stem = str(input_path.name).removesuffix("".join(input_path.suffixes))
+    return stem if source_layer is None else f"{stem}-{_safe_name(source_layer)}"
+
+
+def layer_cost(tool: str, input_paths: List[Path], layers: List[str]) -> JobCost:
+    """
+    Cost of converting one layer of the buildings of a country with `tool`, from
+    inputs shared by all the layers, each of them being assumed to hold an equal share.
+    """
+    cost = estimate_cost(tool, input_paths)
+    share = max(1, len(layers))
+    memory_fixed = COST_FACTORS[tool]["memory"][0]
+    disk_fixed = COST_FACTORS[tool]["disk"][0]
+    return JobCost(
+        memory=int(memory_fixed + (cost.memory - memory_fixed) / share),
+        disk=int(disk_fixed + (cost.disk - disk_fixed) / share),
+        size=cost.size // share,
+    )
 
 
 def convert_one_to_flatgeobuf(
-    buildings_info: BuildingsInfo, output_dir: Path, overwrite: bool
+    buildings_info: BuildingsInfo,
+    output_dir: Path,
+    overwrite: bool,
+    manifest: BuildManifest | None = None,
+    cache: GpkgCache | None = None,
+    source_layer: str | None = None,
 ) -> Tuple[Path, bool]:
     """
-    Convert a single <country>.gpkg.zip → <country>.fgb using the gdal_translate CLI.
+    Convert a single <country>.gpkg.zip → <country>.fgb using the gdal_translate CLI,
+    or only its `source_layer` → <country>-<layer>.fgb if it has several.
+    With a cache, ogr2ogr reads the extracted GeoPackage instead of the zip.
     Returns (output_fgb_path, success_flag).
     """
     input_path = buildings_info.gpkg_zip_path
-    save_path = (
-        output_dir
-        / f"{str(input_path.name).removesuffix("".join(input_path.suffixes))}.fgb"
-    )
+    save_path = output_dir / f"{_output_stem(input_path, source_layer)}.fgb"
+    params = {"format": "FlatGeoBuf", "t_srs": "EPSG:4326"}
+    if source_layer is not None:
+        params["source_layer"] = source_layer
+    tools = ["ogr2ogr"]
 
-    if save_path.exists() and not overwrite:
+    if _is_up_to_date(save_path, overwrite, manifest, [input_path], params, tools):
         logging.info(f"Skipping {save_path} which already exists.")
 
     else:
         try:
-            translate_cmd = [
-                "ogr2ogr",
-                "-progress",
-                "-f",
-                "FlatGeoBuf",
-                str(save_path),
-                str(input_path),
-                "-t_srs",
-                "EPSG:4326",
-            ]
-            _run_cmd(translate_cmd)
+            with open_gpkg(input_path, cache) as source_path:
+                translate_cmd = [
+                    "ogr2ogr",
+                    "-progress",
+                    "-f",
+                    "FlatGeoBuf",
+                    str(save_path),
+                    str(source_path),
+                    *([source_layer] if source_layer is not None else []),
+                    "-t_srs",
+                    "EPSG:4326",
+                ]
+                _run_cmd(
+                    translate_cmd,
+                    job=save_path.name,
+                    stage="flatgeobuf",
+                    input_paths=[input_path],
+                    outputs=[save_path],
+                )
+            if manifest is not None:
+                manifest.record(save_path, [input_path], params, tools)
 
         except Exception as exc:
             logging.error(f"{input_path.name} → {exc}")
@@ -374,47 +715,186 @@ def convert_one_to_flatgeobuf(
     return save_path, True
 
 
-def convert_to_flatgeobufs(
-    buildings_infos: dict[str, BuildingsInfo],
-    output_dir: Path,
-    max_workers: int | None = None,
-    overwrite: bool = False,
-) -> List[Tuple[Path, bool]]:
+def compute_admin_zooms(country_admin_info: CountryAdminInfo) -> List[Tuple[int, int]]:
     """
-    Convert every *.gpkg.zip in *gpkg_zip_files* to FlatGeobuf using a process pool.
-    Returns a list of (output_path, success) tuples.
+    Compute the zoom ranges of the administrative levels of a country from the mean
+    area of the next level. Range i is used for ADMIN_LEVELS[i], and the buildings start
+    right after the last range.
     """
-    logging.info("Converting all GeoPackage to FlatGeoBuf...")
-    output_dir.mkdir(parents=True, exist_ok=True)
+    zooms: List[Tuple[int, int]] = []
+    prev_zoom = -1
+    for admin_level in ADMIN_LEVELS[1:]:
+        admin_info = country_admin_info.levels[admin_level]
+        zoom = math.ceil(BASE_ZOOM_VALUE - 0.5 * math.log2(admin_info.mean_area))
+        if zoom <= 10:
+            zooms.append((prev_zoom + 1, zoom))
+            prev_zoom = zoom
+    return zooms
+
+
+def country_pmtiles_inputs(country: Country) -> List[Path]:
+    """Return the individual PMTiles to join into the archive of a country."""
+    input_paths = country.bdgs_info.get_pmtiles_paths()
+    for admin_level in ADMIN_LEVELS:
+        admin_info = country.admin_info.levels[admin_level]
+
+        # Ignore the administrative levels that were skipped
+        if admin_info.pmtiles_path is None:
+            continue
+        input_paths.append(admin_info.get_pmtiles_path())
+    return input_paths
 
-    # Use as many workers as there are CPU cores unless overridden
-    workers = (
-        max_workers
-        or (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None)
-        or 4
+
+def buildings_zooms(
+    country_code: str,
+    zooms: List[Tuple[int, int]],
+    zoom_plans_dir: Path | None = None,
+) -> Tuple[int, int, List[str]]:
+    """
+    Min zoom, max zoom and extra tippecanoe flags of the buildings of a country. They
+    start after the administrative levels and go up to MAX_ZOOM, unless there is a
+    zoom plan for the country, which can start later, stop earlier and drop buildings.
+    """
+    min_zoom = zooms[-1][1] + 1
+    if zoom_plans_dir is None:
+        return min_zoom, MAX_ZOOM, []
+    plan = load_plan(zoom_plans_dir, country_code)
+    if plan is None:
+        logging.warning(f"No zoom plan for {country_code}, using the default zooms.")
+        return min_zoom, MAX_ZOOM, []
+    min_zoom = max(min_zoom, plan.min_zoom)
+    return min_zoom, max(min_zoom, plan.max_zoom), plan.flags()
+
+
+def _tippecanoe_flags(max_zoom: int | Literal["g"]) -> List[str]:
+    flags = ["--coalesce-densest-as-needed", "--drop-densest-as-needed"]
+    if max_zoom == "g":
+        flags.append("--extend-zooms-if-still-dropping")
+    return flags
+
+
+def _fid_ranges(
+    input_path: Path, n_ranges: int, source_layer: str | None = None
+) -> Tuple[str, str, List[Tuple[int, int]]]:
+    """
+    Split the features of `source_layer`, or of the first layer, of `input_path` into
+    `n_ranges` contiguous ranges of FIDs. Returns the layer name, the FID column and
+    the [start, end) ranges.
+    """
+    ds = ogr.Open(str(input_path))
+    if ds is None:
+        raise RuntimeError(f"Could not open {input_path}.")
+    layer = ds.GetLayer(0) if source_layer is None else ds.GetLayerByName(source_layer)
+    if layer is None:
+        raise RuntimeError(f"No layer {source_layer} in {input_path}.")
+    layer_name = layer.GetName()
+    fid_column = layer.GetFIDColumn() or "fid"
+    result = ds.ExecuteSQL(
+        f'SELECT MIN("{fid_column}"), MAX("{fid_column}") FROM "{layer_name}"'
     )
+    feature = result.GetNextFeature()
+    fid_min, fid_max = feature.GetFieldAsInteger64(0), feature.GetFieldAsInteger64(1)
+    ds.ReleaseResultSet(result)
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
-        futures: list[concurrent.futures.Future[Tuple[Path, bool]]] = []
+    bounds = [
+        fid_min + (fid_max + 1 - fid_min) * i // n_ranges for i in range(n_ranges + 1)
+    ]
+    ranges = [
+        (bounds[i], bounds[i + 1]) for i in range(n_ranges) if bounds[i] < bounds[i + 1]
+    ]
+    return layer_name, fid_column, ranges
 
-        for country_code, buildings_info in buildings_infos.items():
-            futures.append(
-                pool.submit(
-                    convert_one_to_flatgeobuf,
-                    buildings_info,
-                    output_dir,
-                    overwrite,
-                )
-            )
 
-        results = [f.result() for f in concurrent.futures.as_completed(futures)]
+def stream_one_to_pmtiles(
+    input_path: Path,
+    min_zoom: int,
+    max_zoom: int | Literal["g"],
+    output_dir: Path,
+    layer: str,
+    overwrite: bool,
+    readers: int = 4,
+    manifest: BuildManifest | None = None,
+    cache: GpkgCache | None = None,
+    extra_flags: List[str] | None = None,
+    source_layer: str | None = None,
+) -> Tuple[Path, bool]:
+    """
+    Convert a single <country>.gpkg.zip → <country>.pmtiles without intermediate file,
+    by piping the reprojected features of `readers` ogr2ogr processes, each reading a
+    range of FIDs, into tippecanoe. With a cache, the readers seek in the extracted
+    GeoPackage instead of the zip. With `source_layer`, only this layer of the
+    GeoPackage is tiled, into <country>-<layer>.pmtiles.
+    Returns (output_pmtiles_path, success_flag).
+    """
+    save_path = output_dir / f"{_output_stem(input_path, source_layer)}.pmtiles"
+    flags = _tippecanoe_flags(max_zoom) + (extra_flags or [])
+    params = {
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "layer": layer,
+        "flags": flags,
+        "source": "stream",
+    }
+    if source_layer is not None:
+        params["source_layer"] = source_layer
+    tools = ["ogr2ogr", "tippecanoe"]
+
+    if _is_up_to_date(save_path, overwrite, manifest, [input_path], params, tools):
+        logging.info(f"Skipping {save_path} which already exists.")
+
+    else:
+        try:
+            with (
+                open_gpkg(input_path, cache) as source_path,
+                _scratch_dir(save_path) as scratch_dir,
+            ):
+                layer_name, fid_column, ranges = _fid_ranges(
+                    source_path, readers, source_layer
+                )
+                reader_cmds = [
+                    [
+                        "ogr2ogr",
+                        "-f",
+                        "GeoJSONSeq",
+                        "/vsistdout/",
+                        str(source_path),
+                        layer_name,
+                        "-t_srs",
+                        "EPSG:4326",
+                        "-where",
+                        f'"{fid_column}" >= {start} AND "{fid_column}" < {end}',
+                    ]
+                    for start, end in ranges
+                ]
+                tippecanoe_cmd = [
+                    "tippecanoe",
+                    f"-Z{min_zoom}",
+                    f"-z{max_zoom}",
+                    "-o",
+                    str(save_path),
+                    "-l",
+                    layer,
+                    "-t",
+                    str(scratch_dir),
+                    *flags,
+                ]
+                _run_piped_cmds(
+                    reader_cmds,
+                    tippecanoe_cmd,
+                    job=save_path.name,
+                    stage="pmtiles",
+                    input_paths=[input_path],
+                    outputs=[save_path],
+                    scratch_dirs=[scratch_dir],
+                )
+            if manifest is not None:
+                manifest.record(save_path, [input_path], params, tools)
 
-        # Store the path of FlatGeoBuf
-        for country_code, result in zip(buildings_infos.keys(), results):
-            buildings_infos[country_code].fgb_path = result[0]
+        except Exception as exc:
+            logging.error(f"{input_path.name} → {exc}")
+            return save_path, False
 
-    logging.info("Done converting all GeoPackage to FlatGeoBuf.")
-    return results
+    return save_path, True
 
 
 def convert_one_to_pmtiles(
@@ -424,37 +904,56 @@ def convert_one_to_pmtiles(
     output_dir: Path,
     layer: str,
     overwrite: bool,
+    manifest: BuildManifest | None = None,
+    extra_flags: List[str] | None = None,
 ) -> Tuple[Path, bool]:
     """
     Convert a single <country>.fgb → <country>.pmtiles using the gdal_translate CLI.
+    `extra_flags` are added to the tippecanoe command, such as those of a zoom plan.
     Returns (output_fgb_path, success_flag).
     """
     save_path = (
         output_dir
         / f"{str(input_path.name).removesuffix("".join(input_path.suffixes))}.pmtiles"
     )
+    flags = _tippecanoe_flags(max_zoom) + (extra_flags or [])
+    params = {
+        "min_zoom": min_zoom,
+        "max_zoom": max_zoom,
+        "layer": layer,
+        "flags": flags,
+    }
+    tools = ["tippecanoe"]
 
-    if save_path.exists() and not overwrite:
+    if _is_up_to_date(save_path, overwrite, manifest, [input_path], params, tools):
         logging.info(f"Skipping {save_path} which already exists.")
 
     else:
         try:
-            translate_cmd = [
-                "tippecanoe",
-                f"-Z{min_zoom}",
-                f"-z{max_zoom}",
-                "-o",
-                str(save_path),
-                "-l",
-                layer,
-                "--coalesce-densest-as-needed",
-                "--drop-densest-as-needed",
-                str(input_path),
-            ]
-
-            if max_zoom == "g":
-                translate_cmd.append("--extend-zooms-if-still-dropping")
-            _run_cmd(translate_cmd)
+            with _scratch_dir(save_path) as scratch_dir:
+                translate_cmd = [
+                    "tippecanoe",
+                    f"-Z{min_zoom}",
+                    f"-z{max_zoom}",
+                    "-o",
+                    str(save_path),
+                    "-l",
+                    layer,
+                    "-t",
+                    str(scratch_dir),
+                    *flags,
+                    str(input_path),
+                ]
+                _run_cmd(
+                    translate_cmd,
+                    job=save_path.name,
+                    stage="pmtiles",
+                    input_paths=[input_path],
+                    outputs=[save_path],
+                    scratch_dirs=[scratch_dir],
+                )
+            if manifest is not None:
+                manifest.record(save_path, [input_path], params, tools)
 
         except Exception as exc:
             logging.error(f"{input_path.name} → {exc}")
@@ -463,117 +962,54 @@ def convert_one_to_pmtiles(
     return save_path, True
 
 
-def convert_to_pmtiles(
-    countries_infos: dict[str, Country],
-    output_dir: Path,
-    max_workers: int | None = None,
-    overwrite: bool = False,
-) -> List[Tuple[Path, bool]]:
-    """
-    Convert every *.fgb in *fgb_files* to PMTiles using a process pool.
-    Returns a list of (output_path, success) tuples.
-    """
-    logging.info("Converting all FlatGeoBuf to PMTiles...")
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    # Use as many workers as there are CPU cores unless overridden
-    workers = (
-        max_workers
-        or (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None)
-        or 4
-    )
-    logging.info(f"Using {workers} workers.")
-
-    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
-        futures: list[concurrent.futures.Future[Tuple[Path, bool]]] = []
-        futures_info: list[tuple[str, str]] = []  # info the gather results properly
-        for country_code, country_infos in countries_infos.items():
-            bdgs_info = country_infos.bdgs_info
-            country_admin_info = country_infos.admin_info
-
-            zooms: List[Tuple[int, int]] = []
-            prev_zoom = -1
-
-            # Administrative boundaries
-            for admin_level in ADMIN_LEVELS[1:]:
-
-                admin_info = country_admin_info.levels[admin_level]
-                zoom = math.ceil(
-                    BASE_ZOOM_VALUE - 0.5 * math.log2(admin_info.mean_area)
-                )
-                if zoom <= 10:
-                    zooms.append((prev_zoom + 1, zoom))
-                    prev_zoom = zoom
-
-            for i in range(len(zooms)):
-                admin_level = ADMIN_LEVELS[i]
-                admin_info = country_admin_info.levels[admin_level]
-                min_zoom, max_zoom = zooms[i]
-                futures.append(
-                    pool.submit(
-                        convert_one_to_pmtiles,
-                        admin_info.geojson_path,
-                        min_zoom,
-                        max_zoom,
-                        output_dir,
-                        admin_level,
-                        overwrite,
-                    )
-                )
-                futures_info.append((country_code, admin_level))
-
-            # Buildings
-            min_zoom = zooms[-1][1] + 1
-            futures.append(
-                pool.submit(
-                    convert_one_to_pmtiles,
-                    bdgs_info.get_fgb_path(),
-                    min_zoom,
-                    MAX_ZOOM,
-                    output_dir,
-                    BUILDINGS_LAYER,
-                    overwrite,
-                )
-            )
-            futures_info.append((country_code, BUILDINGS_LAYER))
-
-        results: List[Tuple[Path, bool]] = []
-        for fut, (country_code, layer) in zip(
-            concurrent.futures.as_completed(futures), futures_info
-        ):
-            pmtiles_path, ok = fut.result()
-            results.append((pmtiles_path, ok))
-
-            # Find the originating object and store the path
-            if layer in ADMIN_LEVELS:
-                countries_infos[country_code].admin_info.levels[
-                    layer
-                ].pmtiles_path = pmtiles_path
-            elif layer == "buildings":
-                countries_infos[country_code].bdgs_info.pmtiles_path = pmtiles_path
+def _join_pmtiles(
+    input_paths: List[Path], save_path: Path, stage: str, engine: JoinEngine
+) -> None:
+    if engine == JoinEngine.TileJoin:
+        translate_cmd = [
+            "tile-join",
+            "-o",
+            str(save_path),
+            *map(lambda p: str(p), input_paths),
+        ]
+        _run_cmd(
+            translate_cmd,
+            job=save_path.name,
+            stage=stage,
+            input_paths=input_paths,
+            outputs=[save_path],
+        )
+        return
 
-    logging.info("Done converting all FlatGeoBuf to PMTiles.")
-    return results
+    logging.info(f"Merging {', '.join(p.name for p in input_paths)} into {save_path}")
+    progress = PROGRESS.start(save_path.name, stage, engine.value, input_paths)
+    tmp_path = save_path.with_name(save_path.name + ".tmp")
+    try:
+        with USAGE.measure_thread(save_path.name, stage, engine.value, [save_path]):
+            merge_pmtiles(input_paths, tmp_path, on_progress=progress.update)
+            os.replace(tmp_path, save_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+        progress.close()
 
 
 def join_one_pmtiles(
     input_paths: List[Path],
     save_path: Path,
     overwrite: bool,
+    manifest: BuildManifest | None = None,
+    engine: JoinEngine = JoinEngine.Native,
 ) -> Tuple[Path, bool]:
-    if save_path.exists() and not overwrite:
+    tools = ["tile-join"] if engine == JoinEngine.TileJoin else []
+    params = {"engine": engine.value}
+    if _is_up_to_date(save_path, overwrite, manifest, input_paths, params, tools):
         logging.info(f"Skipping {save_path} which already exists.")
 
     else:
         try:
-            translate_cmd = [
-                "tile-join",
-                "-o",
-                str(save_path),
-                *map(lambda p: str(p), input_paths),
-            ]
-
-            _run_cmd(translate_cmd)
+            _join_pmtiles(input_paths, save_path, "join", engine)
+            if manifest is not None:
+                manifest.record(save_path, input_paths, params, tools)
 
         except Exception as exc:
             logging.error(f"Creating {save_path.name} → {exc}")
@@ -582,105 +1018,457 @@ def join_one_pmtiles(
     return save_path, True
 
 
-def join_pmtiles_per_country(
+def join_pmtiles_all_countries(
     countries_infos: dict[str, Country],
-    output_dir: Path,
-    max_workers: int | None = None,
+    save_path: Path,
     overwrite: bool = False,
-) -> List[Tuple[Path, bool]]:
-    logging.info("Joining all PMTiles per country...")
-    output_dir.mkdir(parents=True, exist_ok=True)
-
-    # Use as many workers as there are CPU cores unless overridden
-    workers = (
-        max_workers
-        or (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None)
-        or 4
-    )
-    logging.info(f"Using {workers} workers.")
-
-    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
-        futures: list[concurrent.futures.Future[Tuple[Path, bool]]] = []
-        futures_info: list[str] = []  # info the gather results properly
-        for country_code, country_infos in countries_infos.items():
-            bdgs_info = country_infos.bdgs_info
-            country_admin_info = country_infos.admin_info
-
-            input_paths: List[Path] = []
-            input_paths.append(bdgs_info.get_pmtiles_path())
-            # Administrative boundaries
-            for admin_level in ADMIN_LEVELS:
-                admin_info = country_admin_info.levels[admin_level]
-
-                # Ignore the administrative levels that were skipped
-                if admin_info.pmtiles_path is None:
-                    continue
-                input_paths.append(admin_info.get_pmtiles_path())
-
-            save_path = output_dir / f"{country_code}.pmtiles"
-            futures.append(
-                pool.submit(
-                    join_one_pmtiles,
-                    input_paths,
-                    save_path,
-                    overwrite,
-                )
-            )
-            futures_info.append(country_code)
-
-        results: List[Tuple[Path, bool]] = []
-        for fut, country_code in zip(
-            concurrent.futures.as_completed(futures), futures_info
-        ):
-            pmtiles_path, ok = fut.result()
-            results.append((pmtiles_path, ok))
-            countries_infos[country_code].pmtiles_path = pmtiles_path
-
-    logging.info("Done joining all PMTiles per country.")
-    return results
-
-
-def join_pmtiles_all_countries(
-    countries_infos: dict[str, Country], save_path: Path, overwrite: bool = False
+    manifest: BuildManifest | None = None,
+    engine: JoinEngine = JoinEngine.Native,
 ):
     logging.info("Joining the PMTiles of all countries together...")
-    if save_path.exists() and not overwrite:
+    input_paths = [country.get_pmtiles_path() for country in countries_infos.values()]
+    tools = ["tile-join"] if engine == JoinEngine.TileJoin else []
+    params = {"engine": engine.value}
+    if _is_up_to_date(save_path, overwrite, manifest, input_paths, params, tools):
         logging.info(f"Skipping {save_path} which already exists.")
 
     else:
         try:
-            translate_cmd = [
-                "tile-join",
-                "-o",
-                str(save_path),
-                *map(lambda p: str(p.pmtiles_path), countries_infos.values()),
-            ]
-
-            _run_cmd(translate_cmd)
+            _join_pmtiles(input_paths, save_path, "join_all", engine)
+            if manifest is not None:
+                manifest.record(save_path, input_paths, params, tools)
 
         except Exception as exc:
             logging.error(f"Creating {save_path.name} → {exc}")
             return save_path, False
 
     logging.info("Done joining the PMTiles of all countries together.")
+    return save_path, True
 
 
-def push_pmtiles(local_path: Path, s3_path: str):
-    logging.info("Pushing the PMTiles to S3 storage...")
-    S3_ENDPOINT = "https://fsn1.your-objectstorage.com"
-    S3_BUCKET = "eubuccodissemination"
+def push_pmtiles(
+    local_path: Path,
+    s3_path: str,
+    client=None,
+    part_size: int = 64 * MB,
+    concurrency: int = 8,
+    manifest: BuildManifest | None = None,
+) -> bool:
+    logging.info(f"Pushing {local_path.name} to S3 storage...")
+    uploaded = upload_file(
+        client or make_client(),
+        local_path,
+        s3_path,
+        part_size=part_size,
+        concurrency=concurrency,
+        manifest=manifest,
+    )
+    logging.info(f"Done pushing {local_path.name} to S3 storage.")
+    return uploaded
 
-    config = dotenv_values(".env")
 
-    client = boto3.client(
-        "s3",
-        endpoint_url=S3_ENDPOINT,
-        aws_access_key_id=config["ACCESS_KEY"],
-        aws_secret_access_key=config["SECRET_KEY"],
-    )
+async def run_pmtiles_pipeline(
+    country_codes: List[str],
+    data_dir: Path,
+    limits: Dict[TaskKind, int],
+    overwrite: bool = False,
+    push: bool = True,
+    manifest: BuildManifest | None = None,
+    budget: ResourceBudget | None = None,
+    max_connections: int = 4,
+    segments: int = 1,
+    stream: bool = False,
+    stream_readers: int = 4,
+    keep_fgb: bool = False,
+    join_engine: JoinEngine = JoinEngine.Native,
+    push_countries: bool = False,
+    s3_client=None,
+    part_size: int = 64 * MB,
+    upload_concurrency: int = 8,
+    gpkg_cache: GpkgCache | None = None,
+    zoom_plans_dir: Path | None = None,
+) -> TaskGraph:
+    """
+    Build and run the dependency graph of the whole pipeline. Each country moves on
+    from download to FlatGeoBuf, PMTiles and joined archive on its own, so that
+    downloads, tiling and joins of different countries overlap.
+    With `stream`, the buildings are tiled straight from the GeoPackage and the
+    FlatGeoBuf is only created if `keep_fgb` is set.
+    With a manifest, only the artifacts that are stale are rebuilt. With a budget, the
+    ogr2ogr, tippecanoe and join jobs are admitted against the available RAM/disk.
+    With `push`, the final archive is uploaded to S3, and with `push_countries` the
+    archive of each country as well, skipping the objects that did not change.
+    With a GeoPackage cache, each country is decompressed once for all its readers.
+    With `zoom_plans_dir`, the buildings follow the reviewed zoom plans of
+    `zoom_planner.py`.
+    """
+    admin_dir = data_dir / "admin_boundaries"
+    bdgs_gpkg_dir = data_dir / "buildings" / "gpkg"
+    buildings_flatgeobuf_dir = data_dir / "buildings" / "flatgeobuf"
+    individual_pmtiles_dir = data_dir / "pmtiles" / "indiv"
+    country_pmtiles_dir = data_dir / "pmtiles" / "country"
+    final_pmtiles_path = data_dir / "pmtiles" / "all_countries.pmtiles"
+    for directory in [
+        buildings_flatgeobuf_dir,
+        individual_pmtiles_dir,
+        country_pmtiles_dir,
+    ]:
+        directory.mkdir(parents=True, exist_ok=True)
+
+    graph = TaskGraph()
+    admin_levels: Dict[str, Dict[str, AdminInfo]] = {code: {} for code in country_codes}
+    bdgs_infos: Dict[str, BuildingsInfo] = {}
+    countries_infos: Dict[str, Country] = {}
+
+    if (push or push_countries) and s3_client is None:
+        s3_client = make_client()
+
+    def upload(local_path: Path, s3_path: str) -> bool:
+        return push_pmtiles(
+            local_path,
+            s3_path,
+            client=s3_client,
+            part_size=part_size,
+            concurrency=upload_concurrency,
+            manifest=manifest,
+        )
+
+    def check(result: Tuple[Path, bool]) -> Path:
+        path, ok = result
+        if not ok:
+            raise RuntimeError(f"Failed to create {path}.")
+        return path
+
+    limiter = HostLimiter(max_connections=max_connections)
+    download_timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=300)
+    # Parse the administrative boundaries in other processes to keep the loop free
+    with concurrent.futures.ProcessPoolExecutor() as stats_pool:
+        async with aiohttp.ClientSession(timeout=download_timeout) as session:
+
+            async def get_urls() -> Dict[str, str]:
+                return await get_buildings_country_codes_and_urls()
+
+            urls_task = graph.add("buildings_urls", TaskKind.Network, get_urls)
+
+            for code in country_codes:
+                admin_tasks: List[str] = []
+                for level in ADMIN_LEVELS:
+
+                    async def download_level(code=code, level=level) -> AdminInfo:
+                        admin_info = await download_admin_one_country_one_level(
+                            session,
+                            code,
+                            level,
+                            admin_dir,
+                            overwrite=overwrite,
+                            manifest=manifest,
+                            limiter=limiter,
+                            stats_pool=stats_pool,
+                        )
+                        admin_levels[code][level] = admin_info
+                        return admin_info
+
+                    admin_tasks.append(
+                        graph.add(
+                            f"{code}/admin/{level}", TaskKind.Network, download_level
+                        )
+                    )
+
+                async def download_bdgs(code=code) -> BuildingsInfo:
+                    url = graph.results[urls_task].get(code)
+                    if url is None:
+                        raise RuntimeError(f"No buildings found for {code}.")
+                    bdgs_infos[code] = await download_buildings_one_country(
+                        session,
+                        code,
+                        url,
+                        bdgs_gpkg_dir,
+                        overwrite=overwrite,
+                        manifest=manifest,
+                        limiter=limiter,
+                        segments=segments,
+                    )
+                    return bdgs_infos[code]
+
+                bdgs_task = graph.add(
+                    f"{code}/buildings", TaskKind.Network, download_bdgs, [urls_task]
+                )
+
+                def convert_layer(source_layer: str | None, code=code) -> Path:
+                    return check(
+                        convert_one_to_flatgeobuf(
+                            bdgs_infos[code],
+                            buildings_flatgeobuf_dir,
+                            overwrite,
+                            manifest,
+                            gpkg_cache,
+                            source_layer,
+                        )
+                    )
+
+                def fgb_layer_tasks(code=code) -> List[Task]:
+                    """One task per layer of a GeoPackage that has several of them."""
+                    bdgs_info = bdgs_infos[code]
+                    return [
+                        Task(
+                            name=f"{code}/fgb/{layer}",
+                            kind=TaskKind.Cpu,
+                            func=lambda layer=layer: convert_layer(layer),
+                            estimate=lambda: layer_cost(
+                                "ogr2ogr", [bdgs_info.gpkg_zip_path], bdgs_info.layers
+                            ),
+                        )
+                        for layer in bdgs_info.layers
+                    ]
+
+                def to_fgb(code=code) -> List[Path]:
+                    bdgs_info = bdgs_infos[code]
+                    if bdgs_info.layers:
+                        bdgs_info.layer_fgb_paths = {
+                            layer: graph.results[f"{code}/fgb/{layer}"]
+                            for layer in bdgs_info.layers
+                        }
+                    else:
+                        bdgs_info.fgb_path = convert_layer(None)
+                    return bdgs_info.get_fgb_paths()
+
+                def estimate_fgb(code=code) -> JobCost:
+                    bdgs_info = bdgs_infos[code]
+                    if bdgs_info.layers:
+                        # The layers were converted by the subtasks
+                        return JobCost()
+                    return estimate_cost("ogr2ogr", [bdgs_info.gpkg_zip_path])
+
+                if not stream or keep_fgb:
+                    fgb_task = graph.add(
+                        f"{code}/fgb",
+                        TaskKind.Cpu,
+                        to_fgb,
+                        [bdgs_task],
+                        estimate=estimate_fgb,
+                        expand=fgb_layer_tasks,
+                    )
+
+                # The zoom ranges depend on the areas of all the levels
+                pmtiles_tasks: List[str] = []
+                for i, level in enumerate(ADMIN_LEVELS[:-1]):
+
+                    def admin_to_pmtiles(code=code, i=i, level=level) -> Path | None:
+                        zooms = compute_admin_zooms(
+                            CountryAdminInfo(levels=admin_levels[code])
+                        )
+                        if i >= len(zooms):
+                            return None
+                        admin_info = admin_levels[code][level]
+                        admin_info.pmtiles_path = check(
+                            convert_one_to_pmtiles(
+                                admin_info.geojson_path,
+                                zooms[i][0],
+                                zooms[i][1],
+                                individual_pmtiles_dir,
+                                level,
+                                overwrite,
+                                manifest,
+                            )
+                        )
+                        return admin_info.pmtiles_path
+
+                    pmtiles_tasks.append(
+                        graph.add(
+                            f"{code}/pmtiles/{level}",
+                            TaskKind.Cpu,
+                            admin_to_pmtiles,
+                            admin_tasks,
+                            estimate=lambda code=code, level=level: estimate_cost(
+                                "tippecanoe", [admin_levels[code][level].geojson_path]
+                            ),
+                        )
+                    )
 
-    response = client.upload_file(local_path, S3_BUCKET, s3_path)
-    logging.info("Done pushing the PMTiles to S3 storage.")
+                def tile_layer(source_layer: str | None, code=code) -> Path:
+                    zooms = compute_admin_zooms(
+                        CountryAdminInfo(levels=admin_levels[code])
+                    )
+                    min_zoom, max_zoom, extra_flags = buildings_zooms(
+                        code, zooms, zoom_plans_dir
+                    )
+                    bdgs_info = bdgs_infos[code]
+                    if stream:
+                        return check(
+                            stream_one_to_pmtiles(
+                                bdgs_info.gpkg_zip_path,
+                                min_zoom,
+                                max_zoom,
+                                individual_pmtiles_dir,
+                                BUILDINGS_LAYER,
+                                overwrite,
+                                stream_readers,
+                                manifest,
+                                gpkg_cache,
+                                extra_flags,
+                                source_layer,
+                            )
+                        )
+                    fgb_path = (
+                        bdgs_info.get_fgb_path()
+                        if source_layer is None
+                        else bdgs_info.layer_fgb_paths[source_layer]
+                    )
+                    return check(
+                        convert_one_to_pmtiles(
+                            fgb_path,
+                            min_zoom,
+                            max_zoom,
+                            individual_pmtiles_dir,
+                            BUILDINGS_LAYER,
+                            overwrite,
+                            manifest,
+                            extra_flags,
+                        )
+                    )
+
+                def bdgs_pmtiles_cost(source_layer: str | None, code=code) -> JobCost:
+                    bdgs_info = bdgs_infos[code]
+                    if stream:
+                        return layer_cost(
+                            "tippecanoe-stream",
+                            [bdgs_info.gpkg_zip_path],
+                            bdgs_info.layers,
+                        )
+                    fgb_path = (
+                        bdgs_info.get_fgb_path()
+                        if source_layer is None
+                        else bdgs_info.layer_fgb_paths[source_layer]
+                    )
+                    return estimate_cost("tippecanoe", [fgb_path])
+
+                def pmtiles_layer_tasks(code=code) -> List[Task]:
+                    """One task per layer of a GeoPackage that has several of them."""
+                    return [
+                        Task(
+                            name=f"{code}/pmtiles/{BUILDINGS_LAYER}/{layer}",
+                            kind=TaskKind.Cpu,
+                            func=lambda layer=layer: tile_layer(layer),
+                            estimate=lambda layer=layer: bdgs_pmtiles_cost(layer),
+                        )
+                        for layer in bdgs_infos[code].layers
+                    ]
+
+                def bdgs_to_pmtiles(code=code) -> List[Path]:
+                    bdgs_info = bdgs_infos[code]
+                    if bdgs_info.layers:
+                        bdgs_info.layer_pmtiles_paths = {
+                            layer: graph.results[
+                                f"{code}/pmtiles/{BUILDINGS_LAYER}/{layer}"
+                            ]
+                            for layer in bdgs_info.layers
+                        }
+                    else:
+                        bdgs_info.pmtiles_path = tile_layer(None)
+                    return bdgs_info.get_pmtiles_paths()
+
+                def estimate_bdgs_pmtiles(code=code) -> JobCost:
+                    if bdgs_infos[code].layers:
+                        # The layers were tiled by the subtasks
+                        return JobCost()
+                    return bdgs_pmtiles_cost(None)
+
+                bdgs_pmtiles_deps = [bdgs_task if stream else fgb_task, *admin_tasks]
+                pmtiles_tasks.append(
+                    graph.add(
+                        f"{code}/pmtiles/{BUILDINGS_LAYER}",
+                        TaskKind.Cpu,
+                        bdgs_to_pmtiles,
+                        bdgs_pmtiles_deps,
+                        estimate=estimate_bdgs_pmtiles,
+                        expand=pmtiles_layer_tasks,
+                    )
+                )
+
+                def join_country(code=code) -> Path:
+                    country = Country(
+                        admin_info=CountryAdminInfo(levels=admin_levels[code]),
+                        bdgs_info=bdgs_infos[code],
+                    )
+                    country.pmtiles_path = check(
+                        join_one_pmtiles(
+                            country_pmtiles_inputs(country),
+                            country_pmtiles_dir / f"{code}.pmtiles",
+                            overwrite,
+                            manifest,
+                            join_engine,
+                        )
+                    )
+                    countries_infos[code] = country
+                    if manifest is not None:
+                        manifest.record_country(code, country)
+                    return country.pmtiles_path
+
+                def estimate_join(code=code) -> JobCost:
+                    input_paths = bdgs_infos[code].get_pmtiles_paths() + [
+                        info.pmtiles_path
+                        for info in admin_levels[code].values()
+                        if info.pmtiles_path is not None
+                    ]
+                    return estimate_cost(join_engine.cost_tool, input_paths)
+
+                join_task = graph.add(
+                    f"{code}/join",
+                    TaskKind.Disk,
+                    join_country,
+                    pmtiles_tasks,
+                    estimate=estimate_join,
+                )
+
+                if push_countries:
+
+                    def push_country(code=code) -> bool:
+                        return upload(
+                            countries_infos[code].get_pmtiles_path(),
+                            f"countries/{code}.pmtiles",
+                        )
+
+                    graph.add(
+                        f"{code}/push", TaskKind.Network, push_country, [join_task]
+                    )
+
+            def join_all() -> Path:
+                check(
+                    join_pmtiles_all_countries(
+                        countries_infos={
+                            code: countries_infos[code] for code in country_codes
+                        },
+                        save_path=final_pmtiles_path,
+                        overwrite=overwrite,
+                        manifest=manifest,
+                        engine=join_engine,
+                    )
+                )
+                return final_pmtiles_path
+
+            join_all_task = graph.add(
+                "all_countries/join",
+                TaskKind.Disk,
+                join_all,
+                [f"{code}/join" for code in country_codes],
+                estimate=lambda: estimate_cost(
+                    join_engine.cost_tool,
+                    [c.get_pmtiles_path() for c in countries_infos.values()],
+                ),
+            )
+
+            if push:
+
+                def push_all() -> bool:
+                    return upload(final_pmtiles_path, "all_countries.pmtiles")
+
+                graph.add(
+                    "all_countries/push", TaskKind.Network, push_all, [join_all_task]
+                )
+
+            await graph.run(limits, budget=budget)
+
+    return graph
 
 
 @app.command("make_pmtiles")
@@ -707,12 +1495,125 @@ def make_pmtiles(
             help="Codes of the countries to not process.",
         ),
     ] = [],
+    network_jobs: Annotated[
+        int,
+        typer.Option("--network_jobs", help="Maximum number of concurrent downloads."),
+    ] = 4,
+    cpu_jobs: Annotated[
+        int | None,
+        typer.Option(
+            "--cpu_jobs",
+            help="Maximum number of concurrent ogr2ogr/tippecanoe jobs (default: number of cores).",
+        ),
+    ] = None,
+    disk_jobs: Annotated[
+        int,
+        typer.Option("--disk_jobs", help="Maximum number of concurrent join jobs."),
+    ] = 2,
+    join_engine: Annotated[
+        JoinEngine,
+        typer.Option(
+            "--join_engine",
+            help="Merge the archives natively or with tile-join.",
+        ),
+    ] = JoinEngine.Native,
+    max_connections: Annotated[
+        int,
+        typer.Option(
+            "--max_connections", help="Maximum number of connections to each host."
+        ),
+    ] = 4,
+    segments: Annotated[
+        int,
+        typer.Option(
+            "--segments",
+            help="Number of parallel byte ranges used to download files larger than 1 GB.",
+        ),
+    ] = 4,
+    stream: Annotated[
+        bool,
+        typer.Option(
+            "--stream",
+            help="Tile the buildings straight from the GeoPackage, without FlatGeoBuf.",
+        ),
+    ] = False,
+    stream_readers: Annotated[
+        int,
+        typer.Option(
+            "--stream_readers",
+            help="Number of parallel ogr2ogr readers feeding tippecanoe with --stream.",
+        ),
+    ] = 4,
+    keep_fgb: Annotated[
+        bool,
+        typer.Option("--keep_fgb", help="Still create the FlatGeoBuf with --stream."),
+    ] = False,
+    memory_budget: Annotated[
+        float | None,
+        typer.Option(
+            "--memory_budget",
+            help="RAM in GB that the concurrent jobs can use (default: 80% of the RAM).",
+        ),
+    ] = None,
+    disk_budget: Annotated[
+        float | None,
+        typer.Option(
+            "--disk_budget",
+            help="Scratch disk in GB that the concurrent jobs can use (default: 80% of the free space).",
+        ),
+    ] = None,
+    push_countries: Annotated[
+        bool,
+        typer.Option(
+            "--push_countries",
+            help="Also push the archive of each country to S3.",
+        ),
+    ] = False,
+    part_size: Annotated[
+        int,
+        typer.Option("--part_size", help="Size in MB of the parts of the S3 uploads."),
+    ] = 64,
+    upload_concurrency: Annotated[
+        int,
+        typer.Option(
+            "--upload_concurrency",
+            help="Number of parts of a file uploaded to S3 in parallel.",
+        ),
+    ] = 8,
+    gpkg_cache_size: Annotated[
+        float | None,
+        typer.Option(
+            "--gpkg_cache",
+            help="Size in GB of a cache of extracted GeoPackages shared by the stages (default: read the zips).",
+        ),
+    ] = None,
+    zoom_plans: Annotated[
+        bool,
+        typer.Option(
+            "--zoom_plans",
+            help="Tile the buildings with the plans written by `zoom_planner.py plan_zooms`.",
+        ),
+    ] = False,
+    progress_log: Annotated[
+        Path | None,
+        typer.Option(
+            "--progress_log",
+            help="JSON Lines file to write the progress events of the subprocesses to.",
+        ),
+    ] = None,
     verbose_int: Annotated[int, typer.Option("--verbose", "-v", count=True)] = 0,
 ):
 
     setup_logging(verbose=Verbose.from_int(verbose_int))
 
-    with logging_redirect_tqdm():
+    # The progress log is closed, and its buffered events written, even on failure
+    with ExitStack() as stack, logging_redirect_tqdm():
+        if progress_log is not None:
+            progress_file = stack.enter_context(open(progress_log, "a"))
+            PROGRESS.subscribe(
+                lambda event: progress_file.write(json.dumps(event.to_dict()) + "\n")
+            )
+
         # Get all the country codes
         if country_codes is None:
             country_codes_set = set(
@@ -721,89 +1622,62 @@ def make_pmtiles(
         else:
             country_codes_set = set(country_codes)
 
-        # CZE has multiple layers which makes the process crash
-        if "CZE" in country_codes_set:
-            logging.info(
-                "Removing 'CZE' from the list because its format is not supported yet."
-            )
-            country_codes_set.remove("CZE")
-
         for negative_country_code in negative_country_codes:
             country_codes_set.remove(negative_country_code)
 
-        country_codes = list(country_codes_set)
+        country_codes = sorted(country_codes_set)
 
-        # Download the administrative boundaries
-        admin_dir = data_dir / "admin_boundaries"
-        countries_admin_infos = asyncio.run(
-            download_admin(country_codes, admin_dir, overwrite=False)
-        )
-
-        # Download the buildings
-        bdgs_gpkg_dir = data_dir / "buildings" / "gpkg"
-        bdgs_info = asyncio.run(
-            download_buildings(country_codes, bdgs_gpkg_dir, overwrite=False)
-        )
+        limits = {
+            TaskKind.Network: network_jobs,
+            TaskKind.Cpu: cpu_jobs or default_workers(),
+            TaskKind.Disk: disk_jobs,
+        }
+        logging.info(f"Using at most {limits[TaskKind.Cpu]} CPU jobs.")
 
-        # Convert the buildings to FlatGeoBuf
-        buildings_flatgeobuf_dir = data_dir / "buildings" / "flatgeobuf"
-        results = convert_to_flatgeobufs(
-            buildings_infos=bdgs_info,
-            output_dir=buildings_flatgeobuf_dir,
-            overwrite=False,
+        # Download, convert, tile and join every country as soon as its inputs are
+        # ready, then join all countries together and push the result to the server
+        budget = ResourceBudget.from_system(
+            memory=int(memory_budget * GB) if memory_budget is not None else None,
+            disk=int(disk_budget * GB) if disk_budget is not None else None,
         )
-
-        successes = [p for p, ok in results if ok]
-        failures = [p for p, ok in results if not ok]
-
-        # print("\n=== Conversion summary ===")
-        # print(f"✅ Successfully converted: {len(successes)}")
-        # for p in successes:
-        #     print(f"   • {p.name}")
-
-        # if failures:
-        #     print(f"\n❌ Failed conversions ({len(failures)}):")
-        #     for p in failures:
-        #         print(f"   • {p.name}")
-        # else:
-        #     print("\nAll files converted without error!")
-
-        countries_infos = {}
-        for code in country_codes:
-            countries_infos[code] = Country(
-                admin_info=countries_admin_infos[code], bdgs_info=bdgs_info[code]
+        manifest = BuildManifest.load(data_dir / "build_manifest.json")
+        gpkg_cache = None
+        if gpkg_cache_size is not None:
+            gpkg_cache = GpkgCache(
+                data_dir / "cache" / "gpkg", int(gpkg_cache_size * GB)
+            )
+        graph = asyncio.run(
+            run_pmtiles_pipeline(
+                country_codes,
+                data_dir,
+                limits,
+                overwrite=False,
+                manifest=manifest,
+                budget=budget,
+                max_connections=max_connections,
+                segments=segments,
+                stream=stream,
+                stream_readers=stream_readers,
+                keep_fgb=keep_fgb,
+                join_engine=join_engine,
+                push_countries=push_countries,
+                part_size=part_size * MB,
+                upload_concurrency=upload_concurrency,
+                gpkg_cache=gpkg_cache,
+                zoom_plans_dir=data_dir / "pmtiles" / "plans" if zoom_plans else None,
             )
-
-        # Convert everything to individual PMTiles
-        individual_pmtiles_dir = data_dir / "pmtiles" / "indiv"
-        results = convert_to_pmtiles(
-            countries_infos=countries_infos,
-            output_dir=individual_pmtiles_dir,
-            overwrite=False,
-        )
-
-        # Join everything in each country into one PMTiles
-        country_pmtiles_dir = data_dir / "pmtiles" / "country"
-        results = join_pmtiles_per_country(
-            countries_infos=countries_infos,
-            output_dir=country_pmtiles_dir,
-            overwrite=False,
-        )
-
-        # Join the PMTiles of all countries together
-        final_pmtiles_path = data_dir / "pmtiles" / "all_countries.pmtiles"
-        results = join_pmtiles_all_countries(
-            countries_infos=countries_infos,
-            save_path=final_pmtiles_path,
-            overwrite=False,
         )
-
-        # Push the file to the server
-        push_pmtiles(local_path=final_pmtiles_path, s3_path="all_countries.pmtiles")
+        typer.echo(PROGRESS.format_summary())
+        report = USAGE.report()
+        report_file = report_path(data_dir / "reports" / "runs", report)
+        report.save(report_file)
+        typer.echo(format_report(report))
+        typer.echo(f"Saved the run report to {report_file}.")
+        if gpkg_cache is not None:
+            typer.echo(gpkg_cache.stats().format())
+        if graph.failed:
+            raise typer.Exit(code=1)
 
 
 if __name__ == "__main__":
     app()
-
-# Look at displaying the progress of the subprocesses
-# Handle CZE with its multiple layers
@@ -0,0 +1,217 @@
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterable, List
+
+from tqdm import tqdm
+
+# ogr2ogr -progress prints "0...10...20...", ending with "100 - done."
+OGR_PROGRESS_RE = re.compile(rb"(\d+)(?:\.\.\.| - done)")
+# tippecanoe and tile-join print "  12.3%  10/523/341  " while writing tiles
+TILE_PROGRESS_RE = re.compile(rb"(\d+(?:\.\d+)?)%\s+(\d+)/(\d+)/(\d+)")
+# tippecanoe prints "Read 1.23 million features" while reading its input
+READ_PROGRESS_RE = re.compile(rb"Read (\d+(?:\.\d+)?) million features")
+
+
+@dataclass
+class ProgressEvent:
+    job: str
+    stage: str
+    elapsed: float
+    percent: float | None = None
+    features: int | None = None
+    features_per_s: float | None = None
+    zoom: int | None = None
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+@dataclass
+class JobStats:
+    job: str
+    stage: str
+    input_bytes: int = 0
+    start: float = field(default_factory=time.perf_counter)
+    end: float | None = None
+    features: int | None = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+
+class JobProgress:
+    """
+    Progress of a single job, parsed from the output of its subprocess or updated
+    directly, and shown in a tqdm bar.
+    """
+
+    def __init__(self, reporter: "ProgressReporter", stats: JobStats, tool: str):
+        self.reporter = reporter
+        self.stats = stats
+        self.tool = tool
+        self.percent = 0.0
+        self.zoom: int | None = None
+        self._last_features = (stats.start, 0)
+        self.pbar = tqdm(
+            total=100,
+            desc=f"{stats.stage} {stats.job}",
+            unit="%",
+            leave=False,
+            bar_format="{desc}: {percentage:3.0f}%|{bar}| {elapsed}<{remaining}{postfix}",
+        )
+
+    def _emit(self, features_per_s: float | None = None):
+        event = ProgressEvent(
+            job=self.stats.job,
+            stage=self.stats.stage,
+            elapsed=self.stats.elapsed,
+            percent=self.percent,
+            features=self.stats.features,
+            features_per_s=features_per_s,
+            zoom=self.zoom,
+        )
+        self.reporter.emit(event)
+
+    def parse(self, text: bytes):
+        """Update the progress from a piece of output of the subprocess."""
+        features_per_s = None
+        updated = False
+
+        if self.tool == "ogr2ogr":
+            for match in OGR_PROGRESS_RE.finditer(text):
+                self.percent = float(match.group(1))
+                updated = True
+
+        for match in READ_PROGRESS_RE.finditer(text):
+            features = int(float(match.group(1)) * 1_000_000)
+            now = time.perf_counter()
+            last_time, last_features = self._last_features
+            if now > last_time:
+                features_per_s = (features - last_features) / (now - last_time)
+            self._last_features = (now, features)
+            self.stats.features = features
+            updated = True
+
+        for match in TILE_PROGRESS_RE.finditer(text):
+            self.percent = float(match.group(1))
+            self.zoom = int(match.group(2))
+            updated = True
+
+        if updated:
+            self._refresh(features_per_s)
+
+    def update(self, percent: float):
+        """Update the progress of a job that runs in this process."""
+        self.percent = percent
+        self._refresh()
+
+    def _refresh(self, features_per_s: float | None = None):
+        self.pbar.n = self.percent
+        postfix = {}
+        if self.zoom is not None:
+            postfix["z"] = self.zoom
+        if features_per_s is not None:
+            postfix["features/s"] = f"{features_per_s:,.0f}"
+        self.pbar.set_postfix(postfix, refresh=False)
+        self.pbar.refresh()
+        self._emit(features_per_s)
+
+    def watch(self, stream: IO[bytes], tail: List[bytes], max_tail: int = 64 * 1024):
+        """
+        Read `stream` until it is closed, parsing the progress and keeping the last
+        `max_tail` bytes in `tail` for error messages.
+        """
+        tail_size = 0
+        while chunk := stream.read1(4096):
+            self.parse(chunk)
+            tail.append(chunk)
+            tail_size += len(chunk)
+            while tail_size > max_tail and len(tail) > 1:
+                tail_size -= len(tail.pop(0))
+
+    def close(self):
+        self.stats.end = time.perf_counter()
+        self.pbar.close()
+
+
+class ProgressReporter:
+    """
+    Collect the progress of all subprocesses: one tqdm bar per running job, structured
+    events sent to the subscribers, and the time spent per job for the final summary.
+    """
+
+    def __init__(self):
+        self.jobs: List[JobStats] = []
+        self._listeners: List[Callable[[ProgressEvent], None]] = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, listener: Callable[[ProgressEvent], None]):
+        self._listeners.append(listener)
+
+    def emit(self, event: ProgressEvent):
+        with self._lock:
+            for listener in self._listeners:
+                listener(event)
+
+    def start(
+        self, job: str, stage: str, tool: str, input_paths: Iterable[Path] = ()
+    ) -> JobProgress:
+        stats = JobStats(
+            job=job,
+            stage=stage,
+            input_bytes=sum(p.stat().st_size for p in input_paths if p.exists()),
+        )
+        with self._lock:
+            self.jobs.append(stats)
+        return JobProgress(self, stats, tool)
+
+    def summary(self) -> List[Dict]:
+        """Aggregate the finished jobs per stage, with the slowest job of each stage."""
+        stages: Dict[str, Dict] = {}
+        with self._lock:
+            jobs = [job for job in self.jobs if job.end is not None]
+        for job in jobs:
+            stage = stages.setdefault(
+                job.stage,
+                {
+                    "stage": job.stage,
+                    "jobs": 0,
+                    "seconds": 0.0,
+                    "input_bytes": 0,
+                    "slowest_job": job.job,
+                    "slowest_seconds": 0.0,
+                },
+            )
+            stage["jobs"] += 1
+            stage["seconds"] += job.elapsed
+            stage["input_bytes"] += job.input_bytes
+            if job.elapsed > stage["slowest_seconds"]:
+                stage["slowest_job"] = job.job
+                stage["slowest_seconds"] = job.elapsed
+        for stage in stages.values():
+            stage["mb_per_s"] = (
+                stage["input_bytes"] / 1024**2 / stage["seconds"]
+                if stage["seconds"] > 0
+                else 0.0
+            )
+        return list(stages.values())
+
+    def format_summary(self) -> str:
+        lines = [
+            f"{'Stage':<20} {'Jobs':>5} {'Time (s)':>10} {'MB/s':>8}  Slowest job",
+        ]
+        for stage in self.summary():
+            lines.append(
+                f"{stage['stage']:<20} {stage['jobs']:>5} {stage['seconds']:>10.1f} "
+                f"{stage['mb_per_s']:>8.2f}  {stage['slowest_job']} "
+                f"({stage['slowest_seconds']:.1f} s)"
+            )
+        return "\n".join(lines)
+
+
+# Shared by all the subprocesses of a run
+PROGRESS = ProgressReporter()
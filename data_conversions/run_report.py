@@ -0,0 +1,525 @@
+# External
+import os
+import resource
+import socket
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Annotated, Dict, Iterable, Iterator, List, Tuple
+
+import typer
+from pydantic import BaseModel
+
+# Internal
+from build_manifest import tool_version
+
+app = typer.Typer()
+
+TOOLS = ["ogr2ogr", "tippecanoe", "tile-join"]
+# Seconds between two samples of the disk usage of a running job
+SAMPLE_INTERVAL = 0.5
+# Relative change of a metric beyond which `compare` flags it
+DEFAULT_THRESHOLD = 0.2
+# Stages shorter than this are too noisy to flag their time
+MIN_SECONDS = 5.0
+
+
+class JobUsage(BaseModel):
+    job: str
+    country: str
+    stage: str
+    tool: str
+    ok: bool = True
+    wall_s: float = 0.0
+    user_s: float = 0.0
+    sys_s: float = 0.0
+    # Sum of the peak RSS of the processes of the job, which run together. None for
+    # the jobs that run in this process, whose peak cannot be told apart
+    peak_rss: int | None = None
+    # Peak bytes on disk of the outputs and scratch directories while the job ran
+    peak_disk: int = 0
+    output_bytes: int = 0
+
+
+class StageUsage(BaseModel):
+    """Usage of all the jobs of a stage of a country, or of all countries."""
+
+    country: str
+    stage: str
+    jobs: int = 0
+    failed: int = 0
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    # Largest peaks of a single job, which is what a machine has to fit
+    peak_rss: int | None = None
+    peak_disk: int = 0
+    output_bytes: int = 0
+    slowest_job: str = ""
+    slowest_s: float = 0.0
+
+    def add(self, usage: JobUsage):
+        self.jobs += 1
+        self.failed += not usage.ok
+        self.wall_s += usage.wall_s
+        self.cpu_s += usage.user_s + usage.sys_s
+        if usage.peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, usage.peak_rss)
+        self.peak_disk = max(self.peak_disk, usage.peak_disk)
+        self.output_bytes += usage.output_bytes
+        if usage.wall_s > self.slowest_s:
+            self.slowest_job = usage.job
+            self.slowest_s = usage.wall_s
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.country, self.stage
+
+
+class RunReport(BaseModel):
+    """
+    Resources used by the subprocesses of a run of the pipeline, per job and
+    aggregated per country and stage, with what is needed to compare it to other
+    runs: the machine and the versions of the tools.
+    """
+
+    started: datetime
+    finished: datetime
+    host: str
+    cpus: int
+    memory: int
+    tools: Dict[str, str] = {}
+    stages: List[StageUsage] = []
+    totals: List[StageUsage] = []
+    jobs: List[JobUsage] = []
+
+    @classmethod
+    def load(cls, path: Path) -> "RunReport":
+        return cls.model_validate_json(path.read_text())
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(self.model_dump_json(indent=2))
+        os.replace(tmp_path, path)
+
+
+def job_country(job: str) -> str:
+    """
+    Country of a job from the name of its output, such as CZE-layer.fgb or
+    CYP-ADM1.pmtiles. Country codes never contain a "-" since they are parsed from the
+    names of the GeoPackages.
+    """
+    return job.split(".")[0].split("-")[0]
+
+
+def disk_size(path: Path, prefix: str | None = None) -> int:
+    """
+    Bytes allocated to `path`, recursively if it is a directory. With `prefix`, only
+    the entries of the directory whose name starts with it are counted.
+    """
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except (FileNotFoundError, NotADirectoryError):
+        try:
+            return path.stat().st_blocks * 512
+        except FileNotFoundError:
+            return 0
+    for entry in entries:
+        if prefix is not None and not entry.name.startswith(prefix):
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += disk_size(Path(entry.path))
+            else:
+                total += entry.stat(follow_symlinks=False).st_blocks * 512
+        except FileNotFoundError:
+            # Temporary files come and go while the job runs
+            continue
+    return total
+
+
+def _status_bytes(pid: int | str, field: str) -> int | None:
+    """Value of a memory `field` of /proc/<pid>/status, None if it cannot be read."""
+    try:
+        text = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None
+    for line in text.splitlines():
+        if line.startswith(f"{field}:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+class Sampler:
+    """
+    Sample the bytes on disk of the outputs of a job, along with the temporary files
+    written next to them, and of its scratch directories, keeping the peak. Also
+    samples the peak RSS of the processes of the job while they run.
+    """
+
+    def __init__(
+        self,
+        outputs: Iterable[Path] = (),
+        scratch_dirs: Iterable[Path] = (),
+        interval: float = SAMPLE_INTERVAL,
+    ):
+        self.outputs = list(outputs)
+        self.scratch_dirs = list(scratch_dirs)
+        self.interval = interval
+        self.peak_disk = 0
+        self.peak_rss: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def watch(self, pid: int):
+        with self._lock:
+            self.peak_rss[pid] = 0
+        self.sample_rss(pid)
+
+    def sample_rss(self, pid: int):
+        hwm = _status_bytes(pid, "VmHWM")
+        if hwm is not None:
+            with self._lock:
+                self.peak_rss[pid] = max(self.peak_rss.get(pid, 0), hwm)
+
+    def sample(self):
+        size = sum(disk_size(path.parent, path.name) for path in self.outputs)
+        size += sum(disk_size(path) for path in self.scratch_dirs)
+        self.peak_disk = max(self.peak_disk, size)
+        with self._lock:
+            pids = list(self.peak_rss)
+        for pid in pids:
+            self.sample_rss(pid)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self) -> int:
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+        return self.peak_disk
+
+
+class JobMeter:
+    """Usage of a job being measured, to which its processes are added."""
+
+    def __init__(self, usage: JobUsage, sampler: Sampler):
+        self.usage = usage
+        self.sampler = sampler
+
+    def watch(self, proc: subprocess.Popen):
+        self.sampler.watch(proc.pid)
+
+    def wait(self, proc: subprocess.Popen) -> int:
+        """
+        Wait for a watched process like `Popen.wait`, and add its CPU time and peak
+        RSS to the usage of the job.
+        """
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        self.usage.user_s += rusage.ru_utime
+        self.usage.sys_s += rusage.ru_stime
+        self.usage.peak_rss = (self.usage.peak_rss or 0) + self._peak_rss(
+            proc.pid, rusage
+        )
+        self.usage.ok = self.usage.ok and proc.returncode == 0
+        return proc.returncode
+
+    def _peak_rss(self, pid: int, rusage: resource.struct_rusage) -> int:
+        # ru_maxrss is in KB on Linux, and keeps the RSS the process had before exec,
+        # which is that of this process after the fork. It is the peak of the child
+        # only if it is larger than the peak of this process, otherwise the peak is
+        # the one sampled from /proc while the child ran.
+        maxrss = rusage.ru_maxrss * 1024
+        own_peak = _status_bytes("self", "VmHWM")
+        if own_peak is None or maxrss > own_peak:
+            return maxrss
+        return self.sampler.peak_rss.get(pid, 0)
+
+
+class UsageRecorder:
+    """
+    Collect the usage of the jobs of a run, from the threads that run them, to turn it
+    into a `RunReport` at the end of the run.
+    """
+
+    def __init__(self):
+        self.started = datetime.now(timezone.utc)
+        self.jobs: List[JobUsage] = []
+        self._lock = threading.Lock()
+
+    def record(self, usage: JobUsage):
+        with self._lock:
+            self.jobs.append(usage)
+
+    @contextmanager
+    def measure(
+        self,
+        job: str,
+        stage: str,
+        tool: str,
+        outputs: Iterable[Path] = (),
+        scratch_dirs: Iterable[Path] = (),
+    ) -> Iterator[JobMeter]:
+        """
+        Measure the wall time and disk usage of the job run in the block, and the
+        processes that it waits for through the yielded meter. The job failed if the
+        block raises or one of its processes exits with a non-zero code.
+        """
+        outputs = list(outputs)
+        usage = JobUsage(job=job, country=job_country(job), stage=stage, tool=tool)
+        sampler = Sampler(outputs, scratch_dirs)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            yield JobMeter(usage, sampler)
+        except BaseException:
+            usage.ok = False
+            raise
+        finally:
+            usage.wall_s = time.perf_counter() - start
+            usage.peak_disk = sampler.stop()
+            usage.output_bytes = sum(
+                path.stat().st_size for path in outputs if path.exists()
+            )
+            self.record(usage)
+
+    @contextmanager
+    def measure_thread(
+        self, job: str, stage: str, tool: str, outputs: Iterable[Path] = ()
+    ) -> Iterator[JobUsage]:
+        """Measure a job that runs in the current thread rather than a subprocess."""
+        with self.measure(job, stage, tool, outputs) as meter:
+            before = resource.getrusage(resource.RUSAGE_THREAD)
+            try:
+                yield meter.usage
+            finally:
+                after = resource.getrusage(resource.RUSAGE_THREAD)
+                meter.usage.user_s += after.ru_utime - before.ru_utime
+                meter.usage.sys_s += after.ru_stime - before.ru_stime
+
+    def report(self) -> RunReport:
+        with self._lock:
+            jobs = list(self.jobs)
+        stages: Dict[Tuple[str, str], StageUsage] = {}
+        totals: Dict[str, StageUsage] = {}
+        for usage in jobs:
+            key = (usage.country, usage.stage)
+            stages.setdefault(key, StageUsage(country=usage.country, stage=usage.stage))
+            stages[key].add(usage)
+            totals.setdefault(usage.stage, StageUsage(country="all", stage=usage.stage))
+            totals[usage.stage].add(usage)
+        return RunReport(
+            started=self.started,
+            finished=datetime.now(timezone.utc),
+            host=socket.gethostname(),
+            cpus=os.cpu_count() or 1,
+            memory=os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"),
+            tools={tool: tool_version(tool) for tool in TOOLS},
+            stages=sorted(stages.values(), key=lambda s: s.key),
+            totals=list(totals.values()),
+            jobs=jobs,
+        )
+
+
+def report_path(reports_dir: Path, report: RunReport) -> Path:
+    return reports_dir / f"{report.started:%Y%m%dT%H%M%SZ}.json"
+
+
+def _size(value: float | None) -> str:
+    if value is None:
+        return "-"
+    for unit in ["B", "KB", "MB"]:
+        if value < 1024:
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} GB"
+
+
+def format_stages(stages: List[StageUsage]) -> str:
+    lines = [
+        f"{'Country':<14} {'Stage':<12} {'Jobs':>5} {'Failed':>6} {'Wall (s)':>10} "
+        f"{'CPU (s)':>10} {'Peak RSS':>10} {'Peak disk':>10} {'Output':>10}  Slowest job"
+    ]
+    for stage in stages:
+        lines.append(
+            f"{stage.country:<14} {stage.stage:<12} {stage.jobs:>5} {stage.failed:>6} "
+            f"{stage.wall_s:>10.1f} {stage.cpu_s:>10.1f} {_size(stage.peak_rss):>10} "
+            f"{_size(stage.peak_disk):>10} {_size(stage.output_bytes):>10}  "
+            f"{stage.slowest_job} ({stage.slowest_s:.1f} s)"
+        )
+    return "\n".join(lines)
+
+
+def format_report(report: RunReport) -> str:
+    duration = (report.finished - report.started).total_seconds()
+    lines = [
+        f"Run of {report.started:%Y-%m-%d %H:%M:%S} UTC on {report.host} "
+        f"({report.cpus} CPUs, {_size(report.memory)} RAM), {duration:.0f} s",
+        *(f"{tool}: {version}" for tool, version in report.tools.items()),
+        "",
+        format_stages(report.stages),
+        "",
+        format_stages(report.totals),
+    ]
+    return "\n".join(lines)
+
+
+class StageChange(BaseModel):
+    country: str
+    stage: str
+    metric: str
+    baseline: float
+    current: float
+
+    @property
+    def change(self) -> float:
+        return self.current / self.baseline - 1 if self.baseline > 0 else 0.0
+
+
+def compare_reports(
+    baseline: RunReport, current: RunReport, threshold: float = DEFAULT_THRESHOLD
+) -> List[StageChange]:
+    """
+    Changes of the time, memory and disk of the stages run in both reports, with the
+    totals per stage, that are larger than `threshold` in either direction. The
+    per-job averages are compared, since a rerun skips the artifacts that are up to
+    date.
+    """
+    baseline_stages = {s.key: s for s in baseline.stages + baseline.totals}
+    changes = []
+    for stage in current.stages + current.totals:
+        previous = baseline_stages.get(stage.key)
+        if previous is None or previous.jobs == 0 or stage.jobs == 0:
+            continue
+        metrics = {
+            "peak_rss": (previous.peak_rss or 0, stage.peak_rss or 0),
+            "peak_disk": (previous.peak_disk, stage.peak_disk),
+            "output_bytes": (
+                previous.output_bytes / previous.jobs,
+                stage.output_bytes / stage.jobs,
+            ),
+        }
+        if max(previous.wall_s, stage.wall_s) >= MIN_SECONDS:
+            metrics["wall_s"] = (
+                previous.wall_s / previous.jobs,
+                stage.wall_s / stage.jobs,
+            )
+            metrics["cpu_s"] = (
+                previous.cpu_s / previous.jobs,
+                stage.cpu_s / stage.jobs,
+            )
+        for metric, (before, after) in metrics.items():
+            change = StageChange(
+                country=stage.country,
+                stage=stage.stage,
+                metric=metric,
+                baseline=before,
+                current=after,
+            )
+            if abs(change.change) > threshold:
+                changes.append(change)
+    return changes
+
+
+def format_changes(
+    baseline: RunReport, current: RunReport, changes: List[StageChange]
+) -> str:
+    lines = [
+        f"{tool}: {baseline.tools.get(tool, 'unknown')} → {version}"
+        for tool, version in current.tools.items()
+        if baseline.tools.get(tool) != version
+    ]
+    if not changes:
+        lines.append("No stage changed beyond the threshold.")
+        return "\n".join(lines)
+    lines.append(
+        f"{'Country':<14} {'Stage':<12} {'Metric':<13} {'Baseline':>12} "
+        f"{'Current':>12} {'Change':>8}"
+    )
+    for change in sorted(changes, key=lambda c: -abs(c.change)):
+        if change.metric.endswith("_s"):
+            before, after = f"{change.baseline:.1f} s", f"{change.current:.1f} s"
+        else:
+            before, after = _size(change.baseline), _size(change.current)
+        lines.append(
+            f"{change.country:<14} {change.stage:<12} {change.metric:<13} "
+            f"{before:>12} {after:>12} {change.change:>+8.0%}"
+        )
+    return "\n".join(lines)
+
+
+@app.command("show")
+def show_command(
+    report_path: Annotated[
+        Path,
+        typer.Option("-r", "--report", help="JSON file of a run report.", exists=True),
+    ],
+    jobs: Annotated[
+        bool, typer.Option("--jobs", help="Also list the usage of every job.")
+    ] = False,
+):
+    """Print the usage per country and stage of a run report."""
+    report = RunReport.load(report_path)
+    typer.echo(format_report(report))
+    if jobs:
+        typer.echo("")
+        for usage in sorted(report.jobs, key=lambda u: (u.country, u.stage, u.job)):
+            typer.echo(
+                f"{usage.job:<40} {usage.stage:<12} {usage.tool:<14} "
+                f"{usage.wall_s:>10.1f} {usage.user_s + usage.sys_s:>10.1f} "
+                f"{_size(usage.peak_rss):>10} {_size(usage.peak_disk):>10}"
+                f"{'' if usage.ok else '  failed'}"
+            )
+
+
+@app.command("compare")
+def compare_command(
+    baseline_path: Annotated[
+        Path,
+        typer.Option("-b", "--baseline", help="Run report to compare to.", exists=True),
+    ],
+    report_path: Annotated[
+        Path,
+        typer.Option("-r", "--report", help="Run report to compare.", exists=True),
+    ],
+    threshold: Annotated[
+        float,
+        typer.Option(
+            "--threshold", help="Relative change of a metric that is reported."
+        ),
+    ] = DEFAULT_THRESHOLD,
+    fail: Annotated[
+        bool,
+        typer.Option("--fail", help="Exit with an error if a stage got worse."),
+    ] = False,
+):
+    """
+    Compare the time, memory and disk used per country and stage by two runs, for
+    instance after upgrading tippecanoe or GDAL.
+    """
+    baseline = RunReport.load(baseline_path)
+    current = RunReport.load(report_path)
+    changes = compare_reports(baseline, current, threshold)
+    typer.echo(format_changes(baseline, current, changes))
+    if fail and any(change.change > 0 for change in changes):
+        raise typer.Exit(code=1)
+
+
+# Shared by all the jobs of a run
+USAGE = UsageRecorder()
+
+
+if __name__ == "__main__":
+    app()
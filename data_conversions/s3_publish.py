@@ -0,0 +1,123 @@
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Dict
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from dotenv import dotenv_values
+from tqdm import tqdm
+
+from build_manifest import BuildManifest, file_sha256
+
+S3_ENDPOINT = "https://fsn1.your-objectstorage.com"
+S3_BUCKET = "eubuccodissemination"
+
+MB = 1024**2
+# Metadata key holding the SHA-256 of the content, since multipart ETags are not hashes
+SHA256_METADATA = "sha256"
+
+
+def make_client(env_path: Path = Path(".env"), endpoint_url: str = S3_ENDPOINT):
+    """Create an S3 client with the credentials of the `.env` file."""
+    config = dotenv_values(env_path)
+    return boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=config["ACCESS_KEY"],
+        aws_secret_access_key=config["SECRET_KEY"],
+    )
+
+
+def multipart_etag(path: Path, part_size: int) -> str:
+    """
+    Compute the ETag that S3 gives to `path` when uploaded with parts of `part_size`:
+    the MD5 of the content for a single upload, or the MD5 of the MD5s of the parts
+    followed by the number of parts for a multipart upload.
+    """
+    size = path.stat().st_size
+    if size < part_size:
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "md5").hexdigest()
+
+    digests = []
+    with open(path, "rb") as f:
+        while part := f.read(part_size):
+            digests.append(hashlib.md5(part).digest())
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def _remote_object(client, bucket: str, key: str) -> Dict[str, Any] | None:
+    try:
+        return client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def is_unchanged(
+    client, path: Path, bucket: str, key: str, sha256: str, part_size: int
+) -> bool:
+    """
+    Check if the remote object already has the content of `path`, from the SHA-256
+    stored in its metadata, or else from its ETag.
+    """
+    remote = _remote_object(client, bucket, key)
+    if remote is None:
+        return False
+    if remote["ContentLength"] != path.stat().st_size:
+        return False
+    remote_sha256 = remote.get("Metadata", {}).get(SHA256_METADATA)
+    if remote_sha256 is not None:
+        return remote_sha256 == sha256
+    return remote["ETag"].strip('"') == multipart_etag(path, part_size)
+
+
+def upload_file(
+    client,
+    local_path: Path,
+    key: str,
+    bucket: str = S3_BUCKET,
+    part_size: int = 64 * MB,
+    concurrency: int = 8,
+    manifest: BuildManifest | None = None,
+    force: bool = False,
+) -> bool:
+    """
+    Upload `local_path` to `bucket/key` in parts of `part_size` sent by `concurrency`
+    threads, unless the remote object already has the same content.
+    Returns whether the file was uploaded.
+    """
+    sha256 = (
+        manifest.file_record(local_path).sha256
+        if manifest is not None
+        else file_sha256(local_path)
+    )
+    if not force and is_unchanged(client, local_path, bucket, key, sha256, part_size):
+        logging.info(f"Skipping {key} which is already up to date on S3.")
+        return False
+
+    transfer_config = TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        max_concurrency=concurrency,
+    )
+    with tqdm(
+        total=local_path.stat().st_size,
+        unit="B",
+        unit_scale=True,
+        desc=f"Uploading {key}",
+        leave=False,
+    ) as pbar:
+        client.upload_file(
+            str(local_path),
+            bucket,
+            key,
+            ExtraArgs={"Metadata": {SHA256_METADATA: sha256}},
+            Config=transfer_config,
+            Callback=pbar.update,
+        )
+    logging.info(f"Uploaded {local_path} to {bucket}/{key}.")
+    return True
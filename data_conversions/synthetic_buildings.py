@@ -0,0 +1,394 @@
+# External
+import logging
+import math
+import os
+import time
+import zipfile
+from enum import Enum
+from pathlib import Path
+from typing import Annotated, Dict, Iterator, List
+
+import geopandas as gpd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pyogrio
+import shapely
+import typer
+from tqdm import tqdm
+
+# Internal
+from parquet_index import BBOX_COLUMN, BBOX_TYPE, bbox_array, geo_metadata
+
+app = typer.Typer()
+
+CRS = "EPSG:3035"
+# South-west corner of the generated country in EPSG:3035, in central Europe
+ORIGIN = (4_000_000.0, 2_700_000.0)
+# Rows of every batch, each drawn from its own seed so that any batch can be generated
+# on its own, and the size of the row groups of the GeoParquet
+BATCH_ROWS = 100_000
+
+# Buildings per km² over the whole country, about the average of Europe
+MEAN_DENSITY = 40.0
+# Buildings per km² within two standard deviations of the centre of a city
+CITY_DENSITY = 800.0
+# Share of the buildings spread uniformly over the countryside
+RURAL_SHARE = 0.3
+# Average number of buildings of a city, whose sizes follow Zipf's law
+BUILDINGS_PER_CITY = 20_000
+ZIPF_EXPONENT = 1.1
+# Share of the missing values of the attributes that are not always known
+MISSING_SHARES = {"type": 0.1, "age": 0.3, "height": 0.05}
+TYPES = np.array(["residential", "non-residential"])
+SOURCES = np.array(["osm", "gov", "estimated"])
+# Side of the synthetic ADM1 regions, in metres
+ADM1_SIZE = 150_000.0
+
+SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("id_source", pa.string()),
+        ("type", pa.string()),
+        ("type_source", pa.string()),
+        ("age", pa.int32()),
+        ("height", pa.float64()),
+        ("geometry", pa.binary()),
+    ]
+)
+
+
+class OutputFormat(Enum):
+    Gpkg = "gpkg"
+    GpkgZip = "gpkg.zip"
+    FlatGeobuf = "fgb"
+    GeoParquet = "parquet"
+
+
+def output_paths(data_dir: Path, country_code: str) -> Dict[OutputFormat, Path]:
+    """Paths of the outputs, where the stages of the pipeline look for them."""
+    buildings_dir = data_dir / "buildings"
+    return {
+        OutputFormat.Gpkg: buildings_dir / "gpkg" / f"{country_code}.gpkg",
+        OutputFormat.GpkgZip: buildings_dir / "gpkg" / f"{country_code}.gpkg.zip",
+        OutputFormat.FlatGeobuf: buildings_dir / "flatgeobuf" / f"{country_code}.fgb",
+        OutputFormat.GeoParquet: buildings_dir / "parquet" / f"{country_code}.parquet",
+    }
+
+
+class SyntheticCountry:
+    """
+    Buildings of a square country with the EUBUCCO schema in EPSG:3035, drawn from
+    `seed`. The area grows with the number of rows to keep a realistic density, and
+    most of the buildings are clustered in cities whose sizes follow Zipf's law, with
+    smaller, taller and older buildings in their centres.
+
+    The buildings are generated in batches of `BATCH_ROWS`, each from a seed derived
+    from `seed` and its index, so that memory stays bounded by one batch and the
+    same rows come out whatever is done with them.
+    """
+
+    def __init__(
+        self,
+        country_code: str,
+        rows: int,
+        seed: int = 0,
+        cities: int | None = None,
+    ):
+        self.country_code = country_code
+        self.rows = rows
+        self.seed = seed
+        rng = np.random.default_rng(np.random.SeedSequence(seed))
+
+        side = math.sqrt(rows / MEAN_DENSITY) * 1000
+        self.bounds = (ORIGIN[0], ORIGIN[1], ORIGIN[0] + side, ORIGIN[1] + side)
+
+        n_cities = cities or max(1, rows // BUILDINGS_PER_CITY)
+        weights = 1 / np.arange(1, n_cities + 1) ** ZIPF_EXPONENT
+        self.city_shares = weights / weights.sum() * (1 - RURAL_SHARE)
+        # Two standard deviations around the centre hold the buildings at CITY_DENSITY
+        self.city_sigmas = (
+            np.sqrt(self.city_shares * rows / (4 * math.pi * CITY_DENSITY)) * 1000
+        )
+        self.city_centres = rng.uniform(
+            [self.bounds[0] + 0.05 * side, self.bounds[1] + 0.05 * side],
+            [self.bounds[2] - 0.05 * side, self.bounds[3] - 0.05 * side],
+            size=(n_cities, 2),
+        )
+
+    @property
+    def batches_count(self) -> int:
+        return math.ceil(self.rows / BATCH_ROWS)
+
+    def batch(self, index: int) -> pa.RecordBatch:
+        start = index * BATCH_ROWS
+        n = min(BATCH_ROWS, self.rows - start)
+        rng = np.random.default_rng(
+            np.random.SeedSequence(self.seed, spawn_key=(index,))
+        )
+        xmin, ymin, xmax, ymax = self.bounds
+
+        # -1 for the countryside, the index of the city otherwise
+        city = (
+            rng.choice(
+                len(self.city_shares) + 1, size=n, p=[RURAL_SHARE, *self.city_shares]
+            )
+            - 1
+        )
+        in_city = city >= 0
+        offsets = rng.normal(size=(n, 2))
+        centres = rng.uniform([xmin, ymin], [xmax, ymax], size=(n, 2))
+        centres[in_city] = (
+            self.city_centres[city[in_city]]
+            + offsets[in_city] * self.city_sigmas[city[in_city], None]
+        )
+        centres = np.clip(centres, [xmin, ymin], [xmax, ymax])
+        # 1 at the centre of a city, towards 0 at its outskirts and in the countryside
+        core = np.where(in_city, np.exp(-0.5 * (offsets**2).sum(axis=1)), 0.0)
+
+        # Rotated rectangles, smaller in the cities
+        width = rng.lognormal(np.log(9) - 0.3 * core, 0.35)
+        length = width * rng.uniform(1.0, 2.2, n)
+        angle = rng.uniform(0, np.pi, n)
+        corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1], [-1, -1]]) / 2
+        local_x = corners[None, :, 0] * length[:, None]
+        local_y = corners[None, :, 1] * width[:, None]
+        cos, sin = np.cos(angle)[:, None], np.sin(angle)[:, None]
+        coords = np.stack(
+            [
+                centres[:, 0, None] + local_x * cos - local_y * sin,
+                centres[:, 1, None] + local_x * sin + local_y * cos,
+            ],
+            axis=-1,
+        )
+        geometries = shapely.polygons(coords)
+
+        height = np.round(rng.lognormal(np.log(6) + 1.2 * core, 0.35), 1)
+        age = np.clip(np.round(rng.normal(1965 - 60 * core, 30)), 1600, 2023)
+        types = np.where(rng.random(n) < 0.75 - 0.25 * core, TYPES[0], TYPES[1])
+        missing = {
+            column: rng.random(n) < share for column, share in MISSING_SHARES.items()
+        }
+
+        indices = pa.array(np.arange(start, start + n))
+        return pa.RecordBatch.from_arrays(
+            [
+                pc.binary_join_element_wise(
+                    f"v0.1-{self.country_code}-", pc.cast(indices, pa.string()), ""
+                ),
+                pc.cast(pa.array(rng.integers(1, 10**10, n)), pa.string()),
+                pa.array(types, pa.string(), mask=missing["type"]),
+                pa.array(rng.choice(SOURCES, n), pa.string()),
+                pa.array(age.astype(np.int32), pa.int32(), mask=missing["age"]),
+                pa.array(height, pa.float64(), mask=missing["height"]),
+                pa.array(shapely.to_wkb(geometries), pa.binary()),
+            ],
+            schema=SCHEMA,
+        )
+
+    def batches(self, desc: str | None = None) -> Iterator[pa.RecordBatch]:
+        for index in tqdm(range(self.batches_count), desc=desc, unit="batch"):
+            yield self.batch(index)
+
+
+def write_geoparquet(country: SyntheticCountry, output_path: Path):
+    """Write GeoParquet with a bbox covering column, one row group per batch."""
+    schema = SCHEMA.append(pa.field(BBOX_COLUMN, BBOX_TYPE)).with_metadata(
+        geo_metadata("geometry", CRS, BBOX_COLUMN)
+    )
+    with pq.ParquetWriter(output_path, schema, compression="zstd") as writer:
+        for batch in country.batches(desc=output_path.name):
+            bounds = shapely.bounds(shapely.from_wkb(batch.column("geometry")))
+            writer.write_batch(batch.append_column(BBOX_COLUMN, bbox_array(bounds)))
+
+
+def write_gdal(country: SyntheticCountry, output_path: Path, driver: str):
+    """Stream the batches to a single layer named after the country with GDAL."""
+    reader = pa.RecordBatchReader.from_batches(
+        SCHEMA, country.batches(desc=output_path.name)
+    )
+    pyogrio.write_arrow(
+        reader,
+        output_path,
+        layer=country.country_code,
+        driver=driver,
+        geometry_name="geometry",
+        geometry_type="Polygon",
+        crs=CRS,
+    )
+
+
+def zip_gpkg(gpkg_path: Path, output_path: Path, arcname: str):
+    """Zip a GeoPackage like the EUBUCCO downloads, a single file in the archive."""
+    with zipfile.ZipFile(output_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.write(gpkg_path, arcname=arcname)
+
+
+def write_admin_boundaries(country: SyntheticCountry, admin_dir: Path) -> List[Path]:
+    """
+    Write geoBoundaries-like ADM0, ADM1 and ADM2 GeoJSON in EPSG:4326: the whole
+    country, a grid of regions of about `ADM1_SIZE`, and the Voronoi cells of the
+    cities.
+    """
+    xmin, ymin, xmax, ymax = country.bounds
+    extent = shapely.box(xmin, ymin, xmax, ymax)
+    k = max(2, round((xmax - xmin) / ADM1_SIZE))
+    step = (xmax - xmin) / k
+    regions = {
+        "ADM0": [extent],
+        "ADM1": [
+            shapely.box(
+                xmin + i * step,
+                ymin + j * step,
+                xmin + (i + 1) * step,
+                ymin + (j + 1) * step,
+            )
+            for j in range(k)
+            for i in range(k)
+        ],
+        "ADM2": list(
+            shapely.intersection(
+                shapely.get_parts(
+                    shapely.voronoi_polygons(
+                        shapely.multipoints(country.city_centres), extend_to=extent
+                    )
+                ),
+                extent,
+            )
+        ),
+    }
+
+    admin_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for level, geometries in regions.items():
+        code = country.country_code
+        gdf = gpd.GeoDataFrame(
+            {
+                "shapeID": [f"{code}-{level}-{i}" for i in range(len(geometries))],
+                "shapeName": [f"{code} {level} {i}" for i in range(len(geometries))],
+            },
+            geometry=geometries,
+            crs=CRS,
+        ).to_crs(4326)
+        path = admin_dir / f"{code}-{level}.geojson"
+        gdf.to_file(path, driver="GeoJSON")
+        paths.append(path)
+    return paths
+
+
+def generate(
+    country: SyntheticCountry,
+    paths: Dict[OutputFormat, Path],
+    formats: List[OutputFormat],
+    overwrite: bool = False,
+) -> Dict[OutputFormat, Path]:
+    """
+    Write the buildings of `country` in every format of `formats`, each through a
+    temporary file. The formats are written one after the other from the same
+    batches, rather than holding them. Returns the paths that were written.
+    """
+    written = {}
+    # The zip is made from the GeoPackage, written first if it is asked for
+    gpkg_path = paths[OutputFormat.Gpkg]
+    keep_gpkg = OutputFormat.Gpkg in formats
+    for output_format in sorted(set(formats), key=list(OutputFormat).index):
+        path = paths[output_format]
+        if path.exists() and not overwrite:
+            logging.info(f"Skipping {path} which already exists.")
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # GDAL picks the format from the extension, so it is kept on the temporary file
+        tmp_path = path.with_name(f"tmp-{path.name}")
+        start = time.perf_counter()
+        try:
+            if output_format == OutputFormat.GeoParquet:
+                write_geoparquet(country, tmp_path)
+            elif output_format == OutputFormat.FlatGeobuf:
+                write_gdal(country, tmp_path, "FlatGeobuf")
+            elif output_format == OutputFormat.Gpkg:
+                write_gdal(country, tmp_path, "GPKG")
+            else:
+                source_path = gpkg_path
+                if not keep_gpkg:
+                    source_path = gpkg_path.with_name(f"tmp-{gpkg_path.name}")
+                    write_gdal(country, source_path, "GPKG")
+                zip_gpkg(source_path, tmp_path, gpkg_path.name)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+            if output_format == OutputFormat.GpkgZip and not keep_gpkg:
+                gpkg_path.with_name(f"tmp-{gpkg_path.name}").unlink(missing_ok=True)
+        logging.info(
+            f"Wrote {path} ({path.stat().st_size / 1024**2:.1f} MB) "
+            f"in {time.perf_counter() - start:.1f} s."
+        )
+        written[output_format] = path
+    return written
+
+
+@app.command("generate")
+def generate_command(
+    data_dir: Annotated[
+        Path,
+        typer.Option("-d", "--data_dir", help="Main directory of the data."),
+    ],
+    country_code: Annotated[
+        str,
+        typer.Option("-c", "--country_code", help="Code of the synthetic country."),
+    ] = "SYN",
+    rows: Annotated[
+        int, typer.Option("-n", "--rows", help="Number of buildings.", min=1)
+    ] = 100_000,
+    seed: Annotated[int, typer.Option("--seed", help="Seed of the buildings.")] = 0,
+    cities: Annotated[
+        int | None,
+        typer.Option(
+            "--cities",
+            help=f"Number of cities (default: one per {BUILDINGS_PER_CITY} buildings).",
+        ),
+    ] = None,
+    formats: Annotated[
+        List[OutputFormat],
+        typer.Option("-f", "--format", help="Formats to write (default: all)."),
+    ] = list(OutputFormat),
+    skip_admin: Annotated[
+        bool,
+        typer.Option("--skip_admin", help="Do not write the admin boundaries."),
+    ] = False,
+    overwrite: Annotated[
+        bool, typer.Option("--overwrite", help="Write again the existing files.")
+    ] = False,
+):
+    """
+    Generate a synthetic country with the EUBUCCO schema in `<data_dir>`, laid out like
+    the downloads, so that the stages can be run and benchmarked offline.
+    """
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    country = SyntheticCountry(country_code, rows, seed=seed, cities=cities)
+    xmin, ymin, xmax, ymax = country.bounds
+    logging.info(
+        f"{country_code}: {rows} buildings in {len(country.city_shares)} cities over "
+        f"{(xmax - xmin) / 1000:.0f} x {(ymax - ymin) / 1000:.0f} km."
+    )
+    written = generate(
+        country, output_paths(data_dir, country_code), formats, overwrite
+    )
+    if not skip_admin:
+        written.update(
+            {
+                path.stem: path
+                for path in write_admin_boundaries(
+                    country, data_dir / "admin_boundaries"
+                )
+            }
+        )
+    for name, path in written.items():
+        name = name.value if isinstance(name, OutputFormat) else name
+        typer.echo(f"{name:<12}{path.stat().st_size / 1024**2:>10.1f} MB  {path}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,213 @@
+import asyncio
+import concurrent.futures
+import heapq
+import inspect
+import itertools
+import logging
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Dict, Iterable, List
+
+from tqdm import tqdm
+
+from job_pool import JobCost, ResourceBudget
+
+
+class TaskKind(Enum):
+    Network = "network"
+    Cpu = "cpu"
+    Disk = "disk"
+
+
+@dataclass
+class Task:
+    name: str
+    kind: TaskKind
+    func: Callable[[], Any]
+    deps: List[str] = field(default_factory=list)
+    # Called once the dependencies are done, to admit the task against the budget
+    estimate: Callable[[], JobCost] | None = None
+    # Called once the dependencies are done, to split the task into subtasks that each
+    # take their own slot and run before it, such as one per layer of a country
+    expand: Callable[[], List["Task"]] | None = None
+
+
+class _PrioritySlots:
+    """Asyncio semaphore that wakes up the waiter with the largest priority first."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters: List[tuple[float, int, asyncio.Future[None]]] = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: float):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._counter), fut))
+        await fut
+
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._value += 1
+
+
+class TaskGraph:
+    """
+    Dependency graph of tasks, where each task starts as soon as all its dependencies
+    are done and a slot of its kind (network, CPU, disk) is free.
+
+    Coroutine functions run on the event loop, other callables run in a thread pool.
+    Ready tasks with a cost estimate start largest first, and are also admitted against
+    the RAM/disk budget if there is one.
+    A task whose dependency failed is skipped, as well as everything downstream of it.
+    A task with `expand` only runs once all of its subtasks succeeded, and can read
+    their results.
+    """
+
+    def __init__(self):
+        self.tasks: Dict[str, Task] = {}
+        self.results: Dict[str, Any] = {}
+        self.failed: Dict[str, BaseException] = {}
+        self.skipped: List[str] = []
+
+    def add(
+        self,
+        name: str,
+        kind: TaskKind,
+        func: Callable[[], Any],
+        deps: Iterable[str] = (),
+        estimate: Callable[[], JobCost] | None = None,
+        expand: Callable[[], List[Task]] | None = None,
+    ) -> str:
+        if name in self.tasks:
+            raise ValueError(f"Task {name} was already added to the graph.")
+        self.tasks[name] = Task(
+            name=name,
+            kind=kind,
+            func=func,
+            deps=list(deps),
+            estimate=estimate,
+            expand=expand,
+        )
+        return name
+
+    def _check(self):
+        """Check that all dependencies exist and that there is no cycle."""
+        for task in self.tasks.values():
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise ValueError(f"Task {task.name} depends on unknown task {dep}.")
+
+        state: Dict[str, int] = {}  # 1 = visiting, 2 = done
+
+        for root in self.tasks:
+            if root in state:
+                continue
+            state[root] = 1
+            stack = [(root, iter(self.tasks[root].deps))]
+            while stack:
+                name, deps_iter = stack[-1]
+                dep = next(deps_iter, None)
+                if dep is None:
+                    state[name] = 2
+                    stack.pop()
+                elif state.get(dep) == 1:
+                    raise ValueError(f"Cycle detected in the task graph at {dep}.")
+                elif dep not in state:
+                    state[dep] = 1
+                    stack.append((dep, iter(self.tasks[dep].deps)))
+
+    async def run(
+        self, limits: Dict[TaskKind, int], budget: ResourceBudget | None = None
+    ) -> Dict[str, Any]:
+        """
+        Run the whole graph with at most `limits[kind]` tasks of each kind at once.
+        Returns the results of the tasks that succeeded.
+        """
+        self._check()
+
+        slots = {kind: _PrioritySlots(limits.get(kind, 1)) for kind in TaskKind}
+        loop = asyncio.get_running_loop()
+        pbar = tqdm(total=len(self.tasks), unit="task", desc="Pipeline", leave=True)
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, sum(limits.values()))
+        ) as executor:
+            node_tasks: Dict[str, asyncio.Task[bool]] = {}
+
+            async def run_node(task: Task) -> bool:
+                deps_ok = await asyncio.gather(*(node_tasks[d] for d in task.deps))
+                try:
+                    if not all(deps_ok):
+                        logging.warning(
+                            f"Skipping {task.name} because a dependency failed."
+                        )
+                        self.skipped.append(task.name)
+                        return False
+
+                    if task.expand is not None:
+                        subtasks = task.expand()
+                        for subtask in subtasks:
+                            if subtask.name in self.tasks:
+                                raise ValueError(
+                                    f"Task {subtask.name} was already added to the graph."
+                                )
+                            self.tasks[subtask.name] = subtask
+                            node_tasks[subtask.name] = asyncio.create_task(
+                                run_node(subtask)
+                            )
+                        pbar.total += len(subtasks)
+                        pbar.refresh()
+                        subtasks_ok = await asyncio.gather(
+                            *(node_tasks[subtask.name] for subtask in subtasks)
+                        )
+                        if not all(subtasks_ok):
+                            logging.warning(
+                                f"Skipping {task.name} because a subtask failed."
+                            )
+                            self.skipped.append(task.name)
+                            return False
+
+                    cost = task.estimate() if task.estimate is not None else JobCost()
+                    await slots[task.kind].acquire(cost.size)
+                    try:
+                        logging.debug(f"Starting {task.name} ({task.kind.value}).")
+                        if inspect.iscoroutinefunction(task.func):
+                            result = await task.func()
+                        elif budget is not None and task.estimate is not None:
+                            result = await loop.run_in_executor(
+                                executor, budget.run, cost, task.func
+                            )
+                        else:
+                            result = await loop.run_in_executor(executor, task.func)
+                    finally:
+                        slots[task.kind].release()
+                    self.results[task.name] = result
+                    logging.debug(f"Done with {task.name}.")
+                    return True
+
+                except Exception as exc:
+                    logging.error(f"{task.name} → {exc}")
+                    self.failed[task.name] = exc
+                    return False
+
+                finally:
+                    pbar.update(1)
+
+            for task in self.tasks.values():
+                node_tasks[task.name] = asyncio.create_task(run_node(task))
+            await asyncio.gather(*node_tasks.values())
+
+        pbar.close()
+        if self.failed:
+            logging.error(
+                f"{len(self.failed)} task(s) failed and {len(self.skipped)} were skipped: "
+                f"{', '.join(self.failed)}"
+            )
+        return self.results
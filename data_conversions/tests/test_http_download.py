@@ -0,0 +1,135 @@
+import asyncio
+import json
+import os
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import http_download
+from http_download import HostLimiter, download_file
+
+DATA = os.urandom(300_000)
+
+
+def _app(tmp_path, ranges: bool = True, error: type | None = None):
+    """
+    App serving DATA at /file, with ranges, ETag and If-Range through FileResponse, or
+    ignoring the ranges, or failing with `error`. The method and Range header of every
+    request are recorded.
+    """
+    source = tmp_path / "source.bin"
+    source.write_bytes(DATA)
+    requests = []
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        requests.append((request.method, request.headers.get("Range")))
+        if error is not None:
+            raise error()
+        if ranges:
+            return web.FileResponse(source)
+        return web.Response(body=DATA)
+
+    app = web.Application()
+    app.router.add_route("*", "/file", handler)
+    return app, requests
+
+
+def _download(app, save_path, prepare=None, **kwargs):
+    """Download /file from a local server, after `prepare(session, url)` if given."""
+
+    async def run():
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            url = str(server.make_url("/file"))
+            if prepare is not None:
+                await prepare(session, url)
+            return await download_file(
+                session,
+                url,
+                save_path,
+                desc="test",
+                limiter=HostLimiter(max_connections=4),
+                backoff=0.01,
+                **kwargs,
+            )
+
+    return asyncio.run(run())
+
+
+def test_download_single_stream(tmp_path):
+    app, requests = _app(tmp_path)
+    save_path = tmp_path / "out.bin"
+    assert _download(app, save_path) == save_path
+    assert save_path.read_bytes() == DATA
+    assert requests == [("HEAD", None), ("GET", None)]
+    assert not (tmp_path / "out.bin.part").exists()
+    assert not (tmp_path / "out.bin.part.json").exists()
+
+
+def test_download_resumes_a_partial_file(tmp_path):
+    app, requests = _app(tmp_path)
+    save_path = tmp_path / "out.bin"
+
+    async def interrupted_run(session, url):
+        # What a first run of the same version of the file left after 1000 bytes
+        async with session.head(url) as resp:
+            etag = resp.headers["ETag"]
+        (tmp_path / "out.bin.part").write_bytes(DATA[:1000])
+        (tmp_path / "out.bin.part.json").write_text(
+            json.dumps({"url": url, "total_bytes": len(DATA), "validator": etag})
+        )
+        requests.clear()
+
+    _download(app, save_path, prepare=interrupted_run)
+    assert save_path.read_bytes() == DATA
+    assert requests == [("HEAD", None), ("GET", "bytes=1000-")]
+
+
+def test_download_restarts_a_partial_file_of_another_version(tmp_path):
+    app, requests = _app(tmp_path)
+    save_path = tmp_path / "out.bin"
+    (tmp_path / "out.bin.part").write_bytes(b"x" * 1000)
+    (tmp_path / "out.bin.part.json").write_text(
+        json.dumps({"url": "old", "total_bytes": len(DATA), "validator": '"old"'})
+    )
+    _download(app, save_path)
+    assert save_path.read_bytes() == DATA
+    assert requests == [("HEAD", None), ("GET", None)]
+
+
+def test_download_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(http_download, "SEGMENT_THRESHOLD", 1000)
+    app, requests = _app(tmp_path)
+    save_path = tmp_path / "out.bin"
+    _download(app, save_path, segments=4, chunk_size=1024)
+    assert save_path.read_bytes() == DATA
+    bounds = [len(DATA) * i // 4 for i in range(5)]
+    assert sorted(requests[1:]) == sorted(
+        ("GET", f"bytes={bounds[i]}-{bounds[i + 1] - 1}") for i in range(4)
+    )
+    assert not (tmp_path / "out.bin.part.json").exists()
+
+
+def test_download_segments_fall_back_to_a_stream_without_ranges(tmp_path, monkeypatch):
+    monkeypatch.setattr(http_download, "SEGMENT_THRESHOLD", 1000)
+    app, requests = _app(tmp_path, ranges=False)
+    save_path = tmp_path / "out.bin"
+    _download(app, save_path, segments=4, chunk_size=1024)
+    assert save_path.read_bytes() == DATA
+    assert requests[-1] == ("GET", None)
+    assert not (tmp_path / "out.bin.part.json").exists()
+
+
+def test_download_does_not_retry_client_errors(tmp_path):
+    app, requests = _app(tmp_path, error=web.HTTPNotFound)
+    with pytest.raises(aiohttp.ClientResponseError):
+        _download(app, tmp_path / "out.bin")
+    assert len(requests) == 1
+
+
+def test_download_retries_server_errors(tmp_path):
+    app, requests = _app(tmp_path, error=web.HTTPServiceUnavailable)
+    with pytest.raises(aiohttp.ClientResponseError):
+        _download(app, tmp_path / "out.bin", max_retries=2)
+    assert len(requests) == 3
@@ -0,0 +1,49 @@
+import sys
+import threading
+
+import pytest
+
+from pmtiles_generation import _run_piped_cmds
+
+
+def _run_with_timeout(timeout: float, *args, **kwargs) -> BaseException | None:
+    """Run `_run_piped_cmds` in a thread, failing if it does not return in time."""
+    errors: list[BaseException | None] = [None]
+
+    def target():
+        try:
+            _run_piped_cmds(*args, **kwargs)
+        except BaseException as exc:
+            errors[0] = exc
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "_run_piped_cmds hung"
+    return errors[0]
+
+
+def test_piped_cmds_merge_the_lines_of_the_readers(tmp_path):
+    output = tmp_path / "out.txt"
+    reader = [sys.executable, "-c", "for i in range(1000): print(i)"]
+    writer = [
+        sys.executable,
+        "-c",
+        f"import sys; open({str(output)!r}, 'w').write(sys.stdin.read())",
+    ]
+    assert _run_with_timeout(30, [reader, reader], writer, job="out.txt") is None
+    lines = output.read_text().splitlines()
+    assert sorted(lines) == sorted([str(i) for i in range(1000)] * 2)
+
+
+@pytest.mark.parametrize("code", [0, 3])
+def test_piped_cmds_stop_the_readers_when_the_writer_exits_early(code):
+    reader = [sys.executable, "-c", "while True: print('y' * 100)"]
+    writer = [
+        sys.executable,
+        "-c",
+        f"import sys; sys.stdin.buffer.read(10); sys.exit({code})",
+    ]
+    error = _run_with_timeout(30, [reader, reader], writer, job="early.pmtiles")
+    assert isinstance(error, RuntimeError)
+    assert str(error).startswith(f"Command {' '.join(writer)}")
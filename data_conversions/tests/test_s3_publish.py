@@ -0,0 +1,78 @@
+import os
+
+import boto3
+import pytest
+from boto3.s3.transfer import TransferConfig
+
+from s3_publish import MB, SHA256_METADATA, multipart_etag, upload_file
+
+moto = pytest.importorskip("moto")
+
+BUCKET = "bucket"
+PART_SIZE = 5 * MB
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def local_path(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(2 * PART_SIZE + 1000))
+    return path
+
+
+def _upload(client, path, key="key"):
+    return upload_file(client, path, key, bucket=BUCKET, part_size=PART_SIZE)
+
+
+def test_upload_in_parts(client, local_path):
+    assert _upload(client, local_path)
+    remote = client.head_object(Bucket=BUCKET, Key="key")
+    assert remote["ETag"].strip('"') == multipart_etag(local_path, PART_SIZE)
+    assert remote["ETag"].strip('"').endswith("-3")
+    body = client.get_object(Bucket=BUCKET, Key="key")["Body"].read()
+    assert body == local_path.read_bytes()
+
+
+def test_skip_unchanged_object(client, local_path):
+    assert _upload(client, local_path)
+    assert not _upload(client, local_path)
+
+
+def test_skip_unchanged_object_without_metadata(client, local_path):
+    # Uploaded by another tool, so only the ETag tells that the content is the same
+    config = TransferConfig(
+        multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE
+    )
+    client.upload_file(str(local_path), BUCKET, "key", Config=config)
+    assert not _upload(client, local_path)
+
+
+def test_upload_changed_content(client, local_path):
+    assert _upload(client, local_path)
+    # Same size, so only the hash tells the difference
+    local_path.write_bytes(os.urandom(local_path.stat().st_size))
+    assert _upload(client, local_path)
+    body = client.get_object(Bucket=BUCKET, Key="key")["Body"].read()
+    assert body == local_path.read_bytes()
+
+
+def test_upload_when_the_metadata_differs(client, local_path):
+    client.put_object(
+        Bucket=BUCKET,
+        Key="key",
+        Body=local_path.read_bytes(),
+        Metadata={SHA256_METADATA: "0" * 64},
+    )
+    assert _upload(client, local_path)
+    remote = client.head_object(Bucket=BUCKET, Key="key")
+    assert remote["Metadata"][SHA256_METADATA] != "0" * 64
@@ -14,3 +14,9 @@ def init_db_con(read_only: bool):
     con.sql("LOAD spatial;")
 
     return con
+
+
+def load_h3(con):
+    # Load the H3 community extension
+    con.sql("INSTALL h3 FROM community;")
+    con.sql("LOAD h3;")
@@ -0,0 +1,345 @@
+# External
+import logging
+import math
+from pathlib import Path
+from typing import Annotated, Dict, List
+
+import numpy as np
+import pyogrio
+import shapely
+import typer
+from pydantic import BaseModel
+from pyproj import Transformer
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+# Internal
+from gpkg_cache import GpkgCache, open_gpkg
+from job_pool import GB
+
+app = typer.Typer()
+
+# Half of the extent of the web mercator plane, in metres
+MERCATOR_HALF = 20037508.342789244
+# Resolution of vector tiles
+TILE_EXTENT = 4096
+# Zooms that the buildings can be tiled at
+PLAN_MIN_ZOOM = 8
+PLAN_MAX_ZOOM = 17
+
+DEFAULT_SAMPLE_SIZE = 200_000
+# Features per tile that tippecanoe comfortably fits in 500 KB for buildings
+DEFAULT_TILE_BUDGET = 50_000
+# Median building size, in tile units, from which the buildings are worth showing
+# (min zoom) and from which they are precise enough to be overzoomed (max zoom)
+DEFAULT_MIN_UNITS = 1.0
+DEFAULT_DETAIL_UNITS = 32.0
+
+
+class ZoomStats(BaseModel):
+    zoom: int
+    # Number of tiles with buildings, and estimated buildings per tile. The percentiles
+    # are over the buildings rather than the tiles: p99 is the density of the tile of
+    # the 99th percentile building, so that a few dense cities are not hidden by the
+    # many tiles of the countryside
+    tiles: int
+    p50: float
+    p99: float
+    max: float
+    # Median size of the buildings in tile units
+    median_units: float
+    # Fraction of the buildings of the densest tiles kept by the drop rate
+    keep_fraction: float
+
+
+class ZoomPlan(BaseModel):
+    """
+    Zooms and drop rate of the buildings of a country, estimated from a sample of its
+    buildings. Written as JSON so that it can be reviewed and edited before tiling.
+    """
+
+    country: str
+    features: int
+    sample_size: int
+    min_zoom: int
+    max_zoom: int
+    # All the buildings are kept from the base zoom, and below it the densest tiles
+    # keep `1 / drop_rate` of the buildings of the next zoom
+    base_zoom: int
+    drop_rate: float
+    tile_budget: int
+    zooms: List[ZoomStats] = []
+
+    def flags(self) -> List[str]:
+        """
+        tippecanoe flags that apply the plan, on top of the usual ones, whose
+        --drop-densest-as-needed keeps the tiles that still exceed the budget in it.
+        """
+        return [
+            f"-B{self.base_zoom}",
+            f"-r{self.drop_rate:.2f}",
+            f"--maximum-tile-features={self.tile_budget}",
+            "--drop-polygons",
+        ]
+
+    def save(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(self.model_dump_json(indent=2))
+
+
+def plan_path(plans_dir: Path, country_code: str) -> Path:
+    return plans_dir / f"{country_code}.json"
+
+
+def load_plan(plans_dir: Path, country_code: str) -> ZoomPlan | None:
+    path = plan_path(plans_dir, country_code)
+    if not path.exists():
+        return None
+    return ZoomPlan.model_validate_json(path.read_text())
+
+
+def sample_buildings(
+    input_path: Path, sample_size: int, layer: str | None = None
+) -> tuple[int, np.ndarray, np.ndarray]:
+    """
+    Read about `sample_size` buildings spread over `layer`, or over all the layers of
+    the file, by taking every n-th FID, which SQLite filters without decoding the other
+    rows.
+    Returns the number of features, and the centroids and sizes (largest side of the
+    bbox) of the sample in web mercator metres.
+    """
+    layers = (
+        [layer] if layer is not None else list(pyogrio.list_layers(input_path)[:, 0])
+    )
+    infos = [pyogrio.read_info(input_path, layer=name) for name in layers]
+    features = sum(info["features"] for info in infos)
+    step = max(1, features // sample_size)
+
+    centroids, sizes = [], []
+    for name, info in zip(layers, infos):
+        where = f'"{info["fid_column"] or "fid"}" % {step} = 0' if step > 1 else None
+        _, table = pyogrio.read_arrow(input_path, layer=name, columns=[], where=where)
+
+        geometries = shapely.from_wkb(
+            table.column(info["geometry_name"] or "wkb_geometry")
+        )
+        geometries = geometries[~shapely.is_missing(geometries)]
+        bounds = shapely.bounds(geometries)
+        to_mercator = Transformer.from_crs(info["crs"], "EPSG:3857", always_xy=True)
+        xmin, ymin = to_mercator.transform(bounds[:, 0], bounds[:, 1])
+        xmax, ymax = to_mercator.transform(bounds[:, 2], bounds[:, 3])
+        centroids.append(np.column_stack([(xmin + xmax) / 2, (ymin + ymax) / 2]))
+        sizes.append(np.maximum(np.abs(xmax - xmin), np.abs(ymax - ymin)))
+    return features, np.concatenate(centroids), np.concatenate(sizes)
+
+
+def tile_size(zoom: int) -> float:
+    """Size of a tile at `zoom`, in web mercator metres."""
+    return 2 * MERCATOR_HALF / 2**zoom
+
+
+def _weighted_percentile(counts: np.ndarray, q: float) -> float:
+    """Percentile of the tile densities, with each tile weighted by its buildings."""
+    counts = np.sort(counts)
+    cumulative = np.cumsum(counts)
+    return float(counts[np.searchsorted(cumulative, q / 100 * cumulative[-1])])
+
+
+def zoom_stats(
+    centroids: np.ndarray, sizes: np.ndarray, zoom: int, scale: float
+) -> ZoomStats:
+    """
+    Estimated buildings per tile at `zoom`, each sampled building standing for
+    `scale` buildings.
+    """
+    size = tile_size(zoom)
+    x = np.floor((centroids[:, 0] + MERCATOR_HALF) / size).astype(np.int64)
+    y = np.floor((MERCATOR_HALF - centroids[:, 1]) / size).astype(np.int64)
+    _, counts = np.unique(x * 2**zoom + y, return_counts=True)
+    counts = counts * scale
+    return ZoomStats(
+        zoom=zoom,
+        tiles=len(counts),
+        p50=_weighted_percentile(counts, 50),
+        p99=_weighted_percentile(counts, 99),
+        max=float(counts.max()),
+        median_units=float(np.median(sizes)) / size * TILE_EXTENT,
+        keep_fraction=1.0,
+    )
+
+
+def plan_zooms(
+    country_code: str,
+    input_path: Path,
+    sample_size: int = DEFAULT_SAMPLE_SIZE,
+    tile_budget: int = DEFAULT_TILE_BUDGET,
+    min_units: float = DEFAULT_MIN_UNITS,
+    detail_units: float = DEFAULT_DETAIL_UNITS,
+    layer: str | None = None,
+) -> ZoomPlan:
+    """
+    Plan the tiling of the buildings of a country from a sample of them:
+    - the min zoom is the first one where the median building is `min_units` wide,
+    - the max zoom is the first one where it is `detail_units` wide, beyond which the
+      tiles are overzoomed, or the base zoom if that is higher,
+    - the base zoom is the first one where the tile of the 99th percentile building
+      fits in `tile_budget`, and the drop rate is the lowest that keeps it in the
+      budget at the lower zooms.
+    """
+    features, centroids, sizes = sample_buildings(input_path, sample_size, layer)
+    if len(centroids) == 0:
+        raise ValueError(f"No buildings found in {input_path}.")
+    scale = features / len(centroids)
+    stats = {
+        zoom: zoom_stats(centroids, sizes, zoom, scale)
+        for zoom in range(PLAN_MIN_ZOOM, PLAN_MAX_ZOOM + 1)
+    }
+
+    def first_zoom(condition, default: int) -> int:
+        return next((z for z, s in stats.items() if condition(s)), default)
+
+    min_zoom = first_zoom(lambda s: s.median_units >= min_units, PLAN_MIN_ZOOM)
+    base_zoom = max(min_zoom, first_zoom(lambda s: s.p99 <= tile_budget, PLAN_MAX_ZOOM))
+    max_zoom = max(
+        base_zoom, first_zoom(lambda s: s.median_units >= detail_units, PLAN_MAX_ZOOM)
+    )
+
+    drop_rate = 1.0
+    for zoom in range(min_zoom, base_zoom):
+        drop_rate = max(
+            drop_rate, (stats[zoom].p99 / tile_budget) ** (1 / (base_zoom - zoom))
+        )
+    for zoom, s in stats.items():
+        s.keep_fraction = 1 / drop_rate ** max(0, base_zoom - zoom)
+
+    return ZoomPlan(
+        country=country_code,
+        features=features,
+        sample_size=len(centroids),
+        min_zoom=min_zoom,
+        max_zoom=max_zoom,
+        base_zoom=base_zoom,
+        # Rounded up, so that the flag never keeps more than planned
+        drop_rate=math.ceil(drop_rate * 100) / 100,
+        tile_budget=tile_budget,
+        zooms=[stats[z] for z in range(min_zoom, max_zoom + 1)],
+    )
+
+
+def format_plans(plans: Dict[str, ZoomPlan]) -> str:
+    lines = [
+        f"{'country':<8}{'features':>11}{'min z':>7}{'max z':>7}{'base z':>8}"
+        f"{'rate':>7}{'p99 at min z':>14}"
+    ]
+    for code, plan in plans.items():
+        first = plan.zooms[0] if plan.zooms else None
+        lines.append(
+            f"{code:<8}{plan.features:>11}{plan.min_zoom:>7}{plan.max_zoom:>7}"
+            f"{plan.base_zoom:>8}{plan.drop_rate:>7.2f}"
+            f"{first.p99 if first else 0:>14.0f}"
+        )
+    return "\n".join(lines)
+
+
+@app.command("plan_zooms")
+def plan_zooms_command(
+    data_dir: Annotated[
+        Path,
+        typer.Option(
+            "-d", "--data_dir", help="Main directory of the data.", exists=True
+        ),
+    ],
+    country_codes: Annotated[
+        List[str] | None,
+        typer.Option(
+            "-c",
+            "--country_code",
+            help="Codes of the countries to plan (default: all downloaded ones).",
+        ),
+    ] = None,
+    sample_size: Annotated[
+        int,
+        typer.Option("--sample_size", help="Number of buildings sampled per country."),
+    ] = DEFAULT_SAMPLE_SIZE,
+    tile_budget: Annotated[
+        int,
+        typer.Option(
+            "--tile_budget", help="Buildings per tile kept in the densest tiles."
+        ),
+    ] = DEFAULT_TILE_BUDGET,
+    min_units: Annotated[
+        float,
+        typer.Option(
+            "--min_units",
+            help="Median building size in tile units from which to show the buildings.",
+        ),
+    ] = DEFAULT_MIN_UNITS,
+    detail_units: Annotated[
+        float,
+        typer.Option(
+            "--detail_units",
+            help="Median building size in tile units from which to overzoom.",
+        ),
+    ] = DEFAULT_DETAIL_UNITS,
+    overwrite: Annotated[
+        bool, typer.Option("--overwrite", help="Plan again the existing plans.")
+    ] = False,
+    gpkg_cache_size: Annotated[
+        float | None,
+        typer.Option(
+            "--gpkg_cache",
+            help="Size in GB of a cache of extracted GeoPackages (default: read the zips).",
+        ),
+    ] = None,
+):
+    """
+    Write a zoom plan per country to `<data_dir>/pmtiles/plans/`, to review and then
+    use with `make_pmtiles --zoom_plans`.
+    """
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    gpkg_dir = data_dir / "buildings" / "gpkg"
+    gpkg_paths = {
+        path.name.removesuffix(".gpkg.zip"): path
+        for path in sorted(gpkg_dir.glob("*.gpkg.zip"))
+    }
+    if country_codes is not None:
+        gpkg_paths = {code: gpkg_paths[code] for code in country_codes}
+
+    gpkg_cache = None
+    if gpkg_cache_size is not None:
+        gpkg_cache = GpkgCache(data_dir / "cache" / "gpkg", int(gpkg_cache_size * GB))
+
+    plans_dir = data_dir / "pmtiles" / "plans"
+    plans: Dict[str, ZoomPlan] = {}
+    failed = False
+    with logging_redirect_tqdm():
+        for code, gpkg_path in gpkg_paths.items():
+            if not overwrite and (plan := load_plan(plans_dir, code)) is not None:
+                logging.info(
+                    f"Skipping {plan_path(plans_dir, code)} which already exists."
+                )
+                plans[code] = plan
+                continue
+            try:
+                with open_gpkg(gpkg_path, gpkg_cache) as source_path:
+                    plans[code] = plan_zooms(
+                        code,
+                        source_path,
+                        sample_size=sample_size,
+                        tile_budget=tile_budget,
+                        min_units=min_units,
+                        detail_units=detail_units,
+                    )
+                plans[code].save(plan_path(plans_dir, code))
+            except Exception as exc:
+                logging.error(f"Planning {code} → {exc}")
+                failed = True
+
+    typer.echo(format_plans(plans))
+    if failed:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    app()